@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+import argparse
+from os import listdir, path, stat
+import sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+NEWLINE = ord("\n")
+CARRIAGE_RETURN = ord("\r")
+
+def record_spans(data):
+    """
+    Locate FASTA records in a raw byte buffer.
+
+    Args:
+        data (numpy.ndarray): uint8 view of the file contents
+
+    Returns:
+        tuple: (header_starts, header_ends, record_ends) index arrays, where a
+            header spans data[start:end] (including '>') and the sequence
+            lines span data[end + 1:record_end]
+    """
+    gt = np.flatnonzero(data == ord(">"))
+    header_starts = gt[(gt == 0) | (data[gt - 1] == NEWLINE)]
+    newlines = np.flatnonzero(data == NEWLINE)
+    eol = np.searchsorted(newlines, header_starts)
+    header_ends = np.where(eol < len(newlines),
+                           newlines[np.minimum(eol, len(newlines) - 1)],
+                           len(data))
+    record_ends = np.append(header_starts[1:], len(data))
+    return header_starts, header_ends, record_ends
+
+def record_ids(data, header_starts, header_ends):
+    """Decode record IDs (first word of each header, as SeqIO does)."""
+    ids = []
+    for start, end in zip(header_starts, header_ends):
+        header = data[start + 1:end].tobytes().decode()
+        words = header.split()
+        ids.append(words[0] if words else "")
+    return ids
+
+def scan_alignment(filepath):
+    """
+    Scan the headers of a FASTA file without decoding any sequence.
+
+    Args:
+        filepath (str): Path to the FASTA/alignment file
+
+    Returns:
+        dict: record IDs, alignment length (residues in the first record),
+            byte offset of every record header, file size and mtime
+    """
+    st = stat(filepath)
+    with open(filepath, "rb") as f:
+        data = np.frombuffer(f.read(), dtype=np.uint8)
+    header_starts, header_ends, record_ends = record_spans(data)
+    ids = record_ids(data, header_starts, header_ends)
+    length = 0
+    if ids:
+        first = data[header_ends[0] + 1:record_ends[0]]
+        length = int(np.count_nonzero((first != NEWLINE) & (first != CARRIAGE_RETURN)))
+    return {
+        "ids": ids,
+        "length": length,
+        "offsets": header_starts.astype(np.int64),
+        "size": st.st_size,
+        "mtime": st.st_mtime_ns,
+    }
+
+def default_index_path(alignment_dir, file_suffix=".aln"):
+    """Sidecar index location inside the alignment directory."""
+    return path.join(alignment_dir, f".index{file_suffix}.npz")
+
+def save_index(index, index_path):
+    """
+    Save an index as a compact .npz with one shared taxon table.
+
+    Record IDs are stored as int32 codes into the taxon table and per-file
+    arrays are concatenated, with `record_ptr` marking each file's slice.
+    """
+    files = sorted(index)
+    taxa = sorted({t for f in files for t in index[f]["ids"]})
+    taxon_code = {t: i for i, t in enumerate(taxa)}
+    counts = [len(index[f]["ids"]) for f in files]
+    record_ptr = np.zeros(len(files) + 1, dtype=np.int64)
+    record_ptr[1:] = np.cumsum(counts)
+
+    np.savez(
+        index_path,
+        files=np.array(files, dtype=str),
+        taxa=np.array(taxa, dtype=str),
+        lengths=np.array([index[f]["length"] for f in files], dtype=np.int64),
+        sizes=np.array([index[f]["size"] for f in files], dtype=np.int64),
+        mtimes=np.array([index[f]["mtime"] for f in files], dtype=np.int64),
+        record_ptr=record_ptr,
+        record_taxa=np.array([taxon_code[t] for f in files for t in index[f]["ids"]], dtype=np.int32),
+        record_offsets=np.concatenate([index[f]["offsets"] for f in files]) if files else np.zeros(0, dtype=np.int64),
+    )
+
+def load_index(index_path):
+    """Load an index written by save_index into a {filename: entry} dict."""
+    with np.load(index_path) as npz:
+        taxa = npz["taxa"]
+        record_ptr = npz["record_ptr"]
+        record_taxa = npz["record_taxa"]
+        record_offsets = npz["record_offsets"]
+        index = {}
+        for i, fname in enumerate(npz["files"]):
+            lo, hi = record_ptr[i], record_ptr[i + 1]
+            index[str(fname)] = {
+                "ids": taxa[record_taxa[lo:hi]].tolist(),
+                "length": int(npz["lengths"][i]),
+                "offsets": record_offsets[lo:hi],
+                "size": int(npz["sizes"][i]),
+                "mtime": int(npz["mtimes"][i]),
+            }
+    return index
+
+def index_alignments(alignment_dir, file_suffix=".aln", index_path=None, workers=None, files=None):
+    """
+    Index the alignments in a directory, reusing the sidecar index.
+
+    Only files that are new or whose size/mtime changed are rescanned (in
+    parallel); entries for deleted files are dropped. The updated index is
+    written back to the sidecar.
+
+    Args:
+        alignment_dir (str): Directory containing alignment files
+        file_suffix (str): Alignment file suffix
+        index_path (str): Sidecar location (default: inside alignment_dir)
+        workers (int): Number of worker processes (default: all cores)
+        files (iterable): File names to index (default: every file with file_suffix)
+
+    Returns:
+        dict: {filename: {"ids", "length", "offsets", "size", "mtime"}}
+    """
+    index_path = index_path or default_index_path(alignment_dir, file_suffix)
+    index = load_index(index_path) if path.exists(index_path) else {}
+
+    if files is None:
+        current = sorted(f for f in listdir(alignment_dir) if f.endswith(file_suffix))
+    else:
+        current = sorted(f for f in set(files) if path.exists(path.join(alignment_dir, f)))
+    stale = []
+    for fname in current:
+        st = stat(path.join(alignment_dir, fname))
+        entry = index.get(fname)
+        if entry is None or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime_ns:
+            stale.append(fname)
+
+    removed = set(index) - set(current)
+    for fname in removed:
+        del index[fname]
+
+    if stale:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            scans = executor.map(scan_alignment, [path.join(alignment_dir, f) for f in stale])
+            for fname, entry in zip(stale, scans):
+                index[fname] = entry
+
+    if stale or removed or not path.exists(index_path):
+        save_index(index, index_path)
+    return index
+
+def index_taxa(index):
+    """Sorted list of all record IDs in an index."""
+    return sorted({t for entry in index.values() for t in entry["ids"]})
+
+def read_records(filepath, entry, names):
+    """
+    Read the raw bytes of selected records using the indexed offsets.
+
+    Args:
+        filepath (str): Path to the indexed FASTA file
+        entry (dict): Index entry for the file
+        names (set): Record IDs to keep
+
+    Returns:
+        tuple: (bytes of the selected records in file order, set of IDs found)
+    """
+    offsets = entry["offsets"]
+    ends = np.append(offsets[1:], entry["size"])
+    found = set()
+    chunks = []
+    with open(filepath, "rb") as f:
+        for record_id, start, end in zip(entry["ids"], offsets, ends):
+            if record_id in names:
+                f.seek(start)
+                chunks.append(f.read(end - start))
+                found.add(record_id)
+    return b"".join(chunks), found
+
+def main():
+    parser = argparse.ArgumentParser(description="Index taxa, lengths and record offsets of alignment files")
+    parser.add_argument("-i", "--input", required=True, help="Directory containing alignment files")
+    parser.add_argument("-s", "--suffix", default=".aln", help="Alignment file suffix (default: .aln)")
+    parser.add_argument("--index", default=None, help="Index path (default: <input>/.index<suffix>.npz)")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args()
+
+    if not path.isdir(args.input):
+        sys.exit(f"Error: Input directory {args.input} not found")
+
+    index = index_alignments(args.input, args.suffix, args.index, args.workers)
+    print(f"Indexed {len(index)} files")
+    print(f"Found {len(index_taxa(index))} taxa")
+    print(f"Total alignment length: {sum(e['length'] for e in index.values())} positions")
+
+if __name__ == "__main__":
+    main()
@@ -1,78 +1,167 @@
 import pandas as pd
 import numpy as np
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dist_matrix import DistanceMatrix, open_distance_matrix, align_matrices, matrix_values
+
+def iter_pair_chunks(n, chunk_size=1_000_000):
+    """
+    Yield (rows, cols) index arrays covering all pairs i < j in upper-triangle order.
+
+    Chunks are whole row blocks holding roughly chunk_size pairs, so memory
+    stays flat regardless of n.
+    """
+    start = 0
+    while start < n - 1:
+        # Row i contributes n - i - 1 pairs; grow the block until it holds chunk_size pairs
+        counts = n - 1 - np.arange(start, n - 1)
+        stop = start + max(1, int(np.searchsorted(np.cumsum(counts), chunk_size, side='right')))
+        stop = min(stop, n - 1)
+        block_counts = counts[:stop - start]
+        rows = np.repeat(np.arange(start, stop), block_counts)
+        offsets = np.repeat(np.cumsum(block_counts) - block_counts, block_counts)
+        cols = rows + 1 + (np.arange(len(rows)) - offsets)
+        yield rows, cols
+        start = stop
+
+def pair_values(dm, indices, rows, cols):
+    """Distances of aligned pairs (rows, cols) from a DistanceMatrix or a dense array."""
+    if isinstance(dm, DistanceMatrix):
+        return dm.pair(indices[rows], indices[cols])
+    return dm[indices[rows], indices[cols]]
+
+def query_pairs(matrices, ranges, outfile, names=None, phyla=None, phylum_pairs=None,
+                exclude=None, chunk_size=1_000_000, out_format='tsv'):
+    """
+    Stream accession pairs whose distances fall in given ranges across several matrices.
+
+    Matrices are aligned on their common accessions, then all pairs are
+    scanned in fixed-size chunks of the upper triangle. Matching pairs are
+    formatted and written chunk by chunk, so memory does not grow with the
+    number of pairs.
+
+    Args:
+        matrices (list): DistanceMatrix objects (or legacy DataFrames)
+        ranges (list): (min, max) inclusive bounds per matrix, or None for no constraint
+        outfile (str): Output path (.tsv, or Parquet when out_format='parquet')
+        names (list): Column name per matrix (default: DM1, DM2, ...)
+        phyla (dict): 15-character accession -> phylum, needed for phylum_pairs
+        phylum_pairs (iterable): (phylum, phylum) pairs to keep, in any order
+        exclude (iterable): Accessions to drop before pairing, e.g. outliers
+        chunk_size (int): Approximate number of pairs evaluated per chunk
+        out_format (str): 'tsv' or 'parquet'
+
+    Returns:
+        int: Number of matching pairs written
+    """
+    names = names or [f"DM{k + 1}" for k in range(len(matrices))]
+    accessions, indices = align_matrices(matrices, exclude=exclude)
+    # Legacy frames are materialized once, stores are read pair-wise from the memmap
+    sources = []
+    for dm, idx in zip(matrices, indices):
+        if isinstance(dm, DistanceMatrix):
+            sources.append((dm, idx))
+        else:
+            sources.append((matrix_values(dm, idx), np.arange(len(idx))))
+
+    allowed_codes = None
+    if phylum_pairs is not None:
+        unique_phyla = sorted({phyla.get(acc, "Unknown") for acc in accessions} |
+                              {p for pair in phylum_pairs for p in pair})
+        code = {p: i for i, p in enumerate(unique_phyla)}
+        phylum_idx = np.array([code[phyla.get(acc, "Unknown")] for acc in accessions], dtype=np.int64)
+        n_phyla = len(unique_phyla)
+        allowed_codes = np.array([min(code[a], code[b]) * n_phyla + max(code[a], code[b])
+                                  for a, b in phylum_pairs], dtype=np.int64)
+
+    writer = None
+    n_found = 0
+    try:
+        for rows, cols in iter_pair_chunks(len(accessions), chunk_size):
+            mask = np.ones(len(rows), dtype=bool)
+            if allowed_codes is not None:
+                pi, pj = phylum_idx[rows], phylum_idx[cols]
+                mask &= np.isin(np.minimum(pi, pj) * n_phyla + np.maximum(pi, pj), allowed_codes)
+
+            for (source, idx), value_range in zip(sources, ranges):
+                # Each predicate is only evaluated on the pairs that survived the previous ones
+                if value_range is None:
+                    continue
+                keep = np.flatnonzero(mask)
+                v = pair_values(source, idx, rows[keep], cols[keep])
+                mask[keep] = (v >= value_range[0]) & (v <= value_range[1])
+
+            keep = np.flatnonzero(mask)
+            if not len(keep):
+                continue
+            chunk = pd.DataFrame({
+                'Acc1': accessions[rows[keep]],
+                'Acc2': accessions[cols[keep]],
+            })
+            for (source, idx), name in zip(sources, names):
+                chunk[f'{name}_dist'] = pair_values(source, idx, rows[keep], cols[keep])
+            n_found += len(chunk)
+
+            if out_format == 'parquet':
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(outfile, table.schema)
+                writer.write_table(table)
+            else:
+                chunk.to_csv(outfile, sep='\t', index=False, float_format='%.4f',
+                             mode='w' if writer is None else 'a', header=writer is None)
+                writer = True
+    finally:
+        if out_format == 'parquet' and writer is not None:
+            writer.close()
+
+    # Always leave a (possibly empty) result with a header behind
+    if writer is None:
+        empty = pd.DataFrame(columns=['Acc1', 'Acc2'] + [f'{name}_dist' for name in names])
+        if out_format == 'parquet':
+            empty.to_parquet(outfile, index=False)
+        else:
+            empty.to_csv(outfile, sep='\t', index=False)
+    return n_found
 
 def filter_dm_pairs(dm1, dm2, dm1_range=(0.5, 1.0), dm2_range=(1.0, 1.5), outfile='filtered_pairs.txt'):
     """
     Filter pairs of accessions based on their distances in two distance matrices.
-    
+
     Args:
-        dm1, dm2: pandas DataFrames containing distance matrices
+        dm1, dm2: DistanceMatrix objects (or legacy DataFrames) containing distance matrices
         dm1_range: tuple of (min, max) distance for first matrix
         dm2_range: tuple of (min, max) distance for second matrix
         outfile: path to output file
+
+    Returns:
+        int: Number of pairs written
     """
-    # Clean up and standardize accession IDs
-    dm1.iloc[:, 0] = dm1.iloc[:, 0].str[:15]
-    dm2.iloc[:, 0] = dm2.iloc[:, 0].str[:15]
-    
-    # Get common entries
-    dm1_order = dm1.iloc[:, 0].tolist()
-    dm2_order = dm2.iloc[:, 0].tolist()
-    common_entries = list(set(dm1_order) & set(dm2_order))
-    
-    # Filter and reorder matrices
-    keep_indices_dm1 = [i for i, acc in enumerate(dm1_order) if acc in common_entries]
-    keep_indices_dm2 = [i for i, acc in enumerate(dm2_order) if acc in common_entries]
-    
-    dm1 = dm1.iloc[keep_indices_dm1].reset_index(drop=True)
-    dm2 = dm2.iloc[keep_indices_dm2].reset_index(drop=True)
-    
-    # Get accessions and numerical matrices
-    accessions = dm1.iloc[:, 0].tolist()
-    dm1_array = dm1.iloc[:, 1:].to_numpy()
-    dm2_array = dm2.iloc[:, 1:].to_numpy()
-    
-    # Get upper triangle indices
-    rows, cols = np.triu_indices(dm1_array.shape[0], k=1)
-    
-    # Extract distances
-    dm1_flat = dm1_array[rows, cols]
-    dm2_flat = dm2_array[rows, cols]
-    
-    # Apply distance constraints
-    mask = ((dm1_flat >= dm1_range[0]) & (dm1_flat <= dm1_range[1]) &
-           (dm2_flat >= dm2_range[0]) & (dm2_flat <= dm2_range[1]))
-    
-    # Get filtered pairs
-    filtered_pairs = []
-    for idx in np.where(mask)[0]:
-        acc1 = accessions[rows[idx]]
-        acc2 = accessions[cols[idx]]
-        d1 = dm1_flat[idx]
-        d2 = dm2_flat[idx]
-        filtered_pairs.append((acc1, acc2, d1, d2))
-    
-    # Write to file
-    with open(outfile, 'w') as f:
-        f.write("Acc1\tAcc2\tDM1_dist\tDM2_dist\n")
-        for acc1, acc2, d1, d2 in filtered_pairs:
-            f.write(f"{acc1}\t{acc2}\t{d1:.4f}\t{d2:.4f}\n")
-    
-    print(f"Found {len(filtered_pairs)} pairs matching the criteria")
+    n_found = query_pairs([dm1, dm2], [dm1_range, dm2_range], outfile)
+
+    print(f"Found {n_found} pairs matching the criteria")
     print(f"Results written to {outfile}")
-    
-    return filtered_pairs
+
+    return n_found
 
 if __name__ == '__main__':
     # Example usage
     dm1_path = '/zhome/85/8/203063/a3_fungi/full_dist_mats/new/full_mat_LYS20.csv'
-    dm2_path = '/zhome/85/8/203063/a3_fungi/full_dist_mats/new/full_mat_LYS4.csv'    
-    dm1 = pd.read_csv(dm1_path, sep=r'\s+', header=None, skiprows=1)
-    dm2 = pd.read_csv(dm2_path, sep=r'\s+', header=None, skiprows=1)
-    
+    dm2_path = '/zhome/85/8/203063/a3_fungi/full_dist_mats/new/full_mat_LYS4.csv'
+    dm1 = open_distance_matrix(dm1_path)
+    dm2 = open_distance_matrix(dm2_path)
+
     # Example: find pairs where dm1 distance is between 0.5 and 1.0
     # and dm2 distance is between 1.0 and 1.5
-    filter_dm_pairs(dm1, dm2, 
+    filter_dm_pairs(dm1, dm2,
                    dm1_range=(1.5, 3),
                    dm2_range=(0, 1.5),
                    outfile='/zhome/85/8/203063/a3_fungi/data/filtered_pairs.txt')
+
+    # Any number of matrices and a phylum restriction can be combined, e.g.
+    # query_pairs([dm1, dm2], [(1.5, 3), (0, 1.5)], 'pairs.tsv', names=['LYS20', 'LYS4'],
+    #             phyla=phyla, phylum_pairs=[('Ascomycota', 'Basidiomycota')])
@@ -1,15 +1,23 @@
 #!/usr/bin/env python
 
 import argparse
-from os import listdir, path
+import hashlib
+from os import listdir, path, replace
 from Bio import SeqIO
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 import sys
 import numpy as np
+import pandas as pd
 from numba import jit
 from concurrent.futures import ProcessPoolExecutor
 from functools import partial
+from taxa_io import read_taxa_file
+from alignment_index import (NEWLINE, CARRIAGE_RETURN, record_spans, record_ids,
+                             index_alignments, index_taxa, read_records)
+
+FASTA_LINE_WIDTH = 60
+GAP = ord("-")
 
 @jit(nopython=True)
 def concatenate_sequences(seq_array, missing_array, seq_len):
@@ -27,18 +35,17 @@ def process_alignment_file(fname, alignment_dir, taxa_dict, missing_char, file_s
     filepath = path.join(alignment_dir, fname)
     local_alignments = taxa_dict.copy()
     
-    # Get sequence length and process records
-    first_record = next(SeqIO.parse(filepath, "fasta"))
-    seq_len = len(first_record.seq)
-    
-    # Convert sequences to numpy arrays for faster processing
-    missing_seq = np.array([ord(missing_char)] * seq_len, dtype=np.int8)
-    
-    # Process all sequences in the file
+    # Process all sequences in the file, taking the length from the first record
+    seq_len = None
     with open(filepath) as f:
         for record in SeqIO.parse(f, "fasta"):
             seq_array = np.array([ord(c) for c in str(record.seq)], dtype=np.int8)
             local_alignments[str(record.id)] = seq_array
+            if seq_len is None:
+                seq_len = len(seq_array)
+    
+    # Convert sequences to numpy arrays for faster processing
+    missing_seq = np.array([ord(missing_char)] * (seq_len or 0), dtype=np.int8)
     
     # Fill missing sequences
     for taxon in local_alignments:
@@ -91,14 +98,429 @@ def build_supermatrix(alignment_dir, taxa_list, missing_char="?", file_suffix=".
 
     return final_alignments, partitions
 
+def residue_mask(data, header_starts, header_ends):
+    """Boolean mask selecting residue bytes (not headers, not line breaks)."""
+    edges = np.zeros(len(data) + 1, dtype=np.int8)
+    edges[header_starts] += 1
+    edges[np.minimum(header_ends + 1, len(data))] -= 1
+    in_header = np.cumsum(edges[:-1]) > 0
+    return ~in_header & (data != NEWLINE) & (data != CARRIAGE_RETURN)
+
+def parse_alignment_bytes(data, source="alignment"):
+    """
+    Parse aligned FASTA bytes into record IDs and a uint8 matrix.
+
+    Args:
+        data (numpy.ndarray): uint8 view of one or more FASTA records
+        source (str): Name used in error messages
+
+    Returns:
+        tuple: (ids, matrix) where matrix has shape (n_records, alignment_length)
+    """
+    header_starts, header_ends, _ = record_spans(data)
+    ids = record_ids(data, header_starts, header_ends)
+    if not ids:
+        return ids, np.empty((0, 0), dtype=np.uint8)
+
+    mask = residue_mask(data, header_starts, header_ends)
+    counts = np.add.reduceat(mask, header_starts, dtype=np.intp)
+    if np.any(counts != counts[0]):
+        raise ValueError(f"{source}: sequences are not all the same length")
+    return ids, data[mask].reshape(len(ids), counts[0])
+
+def read_alignment_bytes(filepath):
+    """Read an aligned FASTA file straight into (ids, uint8 matrix)."""
+    with open(filepath, "rb") as f:
+        data = np.frombuffer(f.read(), dtype=np.uint8)
+    return parse_alignment_bytes(data, filepath)
+
+def file_digest(filepath=None, raw=None):
+    """Content hash of an alignment file (or of its already-read bytes)."""
+    if raw is None:
+        with open(filepath, "rb") as f:
+            raw = f.read()
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def select_taxa(taxa, keep=None, exclude=None):
+    """
+    Restrict taxa to a keep-set and drop excluded ones.
+
+    Matching uses the first 15 characters of the accession, as elsewhere in
+    the pipeline.
+    """
+    keep = None if keep is None else {t[:15] for t in keep}
+    exclude = {t[:15] for t in exclude or ()}
+    return sorted(t for t in taxa
+                  if (keep is None or t[:15] in keep) and t[:15] not in exclude)
+
+# Per-worker state for the streaming builder, set once by init_stream_worker
+_stream_matrix = None
+_stream_taxon_rows = None
+
+def init_stream_worker(matrix_path, shape, taxa_list, mode="r+"):
+    """Open the shared supermatrix memmap in a worker process."""
+    global _stream_matrix, _stream_taxon_rows
+    _stream_matrix = np.memmap(matrix_path, dtype=np.uint8, mode=mode, shape=shape)
+    _stream_taxon_rows = {taxon: i for i, taxon in enumerate(taxa_list)}
+
+def fill_partition(task):
+    """Write one alignment into its column block of the shared supermatrix."""
+    filepath, start, seq_len, missing_byte = task
+    with open(filepath, "rb") as f:
+        raw = f.read()
+    ids, block = parse_alignment_bytes(np.frombuffer(raw, dtype=np.uint8), filepath)
+    if block.shape[1] != seq_len:
+        raise ValueError(f"{filepath}: expected length {seq_len}, found {block.shape[1]}")
+
+    keep = np.fromiter((t in _stream_taxon_rows for t in ids), dtype=bool, count=len(ids))
+    rows = np.fromiter((_stream_taxon_rows[t] for t in ids if t in _stream_taxon_rows), dtype=np.intp)
+    present = np.zeros(_stream_matrix.shape[0], dtype=bool)
+    present[rows] = True
+    columns = _stream_matrix[:, start:start + seq_len]
+    columns[~present] = missing_byte
+    columns[rows] = block[keep]
+    _stream_matrix.flush()
+    return file_digest(raw=raw)
+
+def fill_taxa_rows(task):
+    """Write selected taxa of an unchanged alignment, reading only their records."""
+    filepath, entry, start, seq_len, taxa, missing_byte = task
+    raw, _ = read_records(filepath, entry, set(taxa))
+    ids, block = parse_alignment_bytes(np.frombuffer(raw, dtype=np.uint8), filepath)
+    rows = np.array([_stream_taxon_rows[t] for t in taxa], dtype=np.intp)
+    _stream_matrix[rows, start:start + seq_len] = missing_byte
+    if ids:
+        found = np.array([_stream_taxon_rows[t] for t in ids], dtype=np.intp)
+        _stream_matrix[found, start:start + seq_len] = block
+    _stream_matrix.flush()
+    return filepath
+
+def plan_partitions(index, file_suffix):
+    """Lay out partitions in filename order; returns (files, partitions, total_length)."""
+    alignment_files = sorted(index)
+    partitions = []
+    start = 1
+    for fname in alignment_files:
+        seq_len = index[fname]["length"]
+        partitions.append([fname.replace(file_suffix, ""), start, start + seq_len - 1])
+        start += seq_len
+    return alignment_files, partitions, start - 1
+
+def build_state_path(matrix_path):
+    """Location of the incremental build state next to the matrix."""
+    return f"{matrix_path}.state.npz"
+
+def save_build_state(matrix_path, taxa_list, alignment_files, partitions, index, digests, missing_char):
+    """Record what the matrix was built from, for later incremental updates."""
+    np.savez(
+        build_state_path(matrix_path),
+        taxa=np.array(taxa_list, dtype=str),
+        files=np.array(alignment_files, dtype=str),
+        starts=np.array([p[1] - 1 for p in partitions], dtype=np.int64),
+        lengths=np.array([p[2] - p[1] + 1 for p in partitions], dtype=np.int64),
+        sizes=np.array([index[f]["size"] for f in alignment_files], dtype=np.int64),
+        mtimes=np.array([index[f]["mtime"] for f in alignment_files], dtype=np.int64),
+        digests=np.array(digests, dtype=str),
+        missing=np.array(missing_char),
+    )
+
+def load_build_state(matrix_path):
+    """Load the build state written by save_build_state."""
+    with np.load(build_state_path(matrix_path)) as npz:
+        files = npz["files"].tolist()
+        return {
+            "taxa": npz["taxa"].tolist(),
+            "missing": str(npz["missing"]),
+            "files": {
+                fname: {
+                    "start": int(npz["starts"][i]),
+                    "length": int(npz["lengths"][i]),
+                    "size": int(npz["sizes"][i]),
+                    "mtime": int(npz["mtimes"][i]),
+                    "digest": str(npz["digests"][i]),
+                }
+                for i, fname in enumerate(files)
+            },
+        }
+
+def build_supermatrix_stream(alignment_dir, matrix_path, missing_char="?", file_suffix=".aln",
+                             workers=None, keep=None, exclude=None):
+    """
+    Build the supermatrix as a memory-mapped uint8 matrix on disk.
+
+    Alignment lengths and taxa come from the directory index, so every
+    partition's column offset is known before allocation; workers then fill
+    their column blocks in place, so no per-taxon strings are ever built.
+
+    Args:
+        alignment_dir (str): Directory containing alignment files
+        matrix_path (str): Path of the memory-mapped matrix to create
+        missing_char (str): Character used for taxa absent from an alignment
+        file_suffix (str): Alignment file suffix
+        workers (int): Number of worker processes (default: all cores)
+        keep (set): Accessions to keep (default: all taxa in the alignments)
+        exclude (set): Accessions to drop, e.g. outliers
+
+    Returns:
+        tuple: (matrix, taxa_list, partitions)
+    """
+    index = index_alignments(alignment_dir, file_suffix, workers=workers)
+    alignment_files, partitions, total_length = plan_partitions(index, file_suffix)
+    filepaths = [path.join(alignment_dir, f) for f in alignment_files]
+    taxa_list = select_taxa(index_taxa(index), keep, exclude)
+    shape = (len(taxa_list), total_length)
+
+    matrix = np.memmap(matrix_path, dtype=np.uint8, mode="w+", shape=shape)
+    del matrix
+
+    missing_byte = ord(missing_char)
+    tasks = [(fp, p[1] - 1, p[2] - p[1] + 1, missing_byte) for fp, p in zip(filepaths, partitions)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_stream_worker,
+                             initargs=(matrix_path, shape, taxa_list)) as executor:
+        digests = list(executor.map(fill_partition, tasks))
+
+    save_build_state(matrix_path, taxa_list, alignment_files, partitions, index, digests, missing_char)
+    matrix = np.memmap(matrix_path, dtype=np.uint8, mode="r", shape=shape)
+    return matrix, taxa_list, partitions
+
+def update_supermatrix_stream(alignment_dir, matrix_path, missing_char="?", file_suffix=".aln",
+                              workers=None, keep=None, exclude=None):
+    """
+    Update a previously streamed supermatrix in place of a full rebuild.
+
+    Partitions whose alignment content is unchanged are copied column-block
+    wise from the previous matrix; only changed or new alignments are
+    re-read, and for unchanged alignments only the records of newly added
+    taxa are read (via the index offsets). Dropped alignments and taxa are
+    simply not copied. Falls back to a full build without a previous state.
+
+    Args:
+        Same as build_supermatrix_stream.
+
+    Returns:
+        tuple: (matrix, taxa_list, partitions)
+    """
+    if not (path.exists(matrix_path) and path.exists(build_state_path(matrix_path))):
+        print("No previous build state found, building from scratch...")
+        return build_supermatrix_stream(alignment_dir, matrix_path, missing_char, file_suffix,
+                                        workers, keep, exclude)
+
+    state = load_build_state(matrix_path)
+    if state["missing"] != missing_char:
+        print("Missing data character changed, building from scratch...")
+        return build_supermatrix_stream(alignment_dir, matrix_path, missing_char, file_suffix,
+                                        workers, keep, exclude)
+
+    old_taxa = state["taxa"]
+    old_files = state["files"]
+    old_shape = (len(old_taxa), sum(f["length"] for f in old_files.values()))
+    old_matrix = np.memmap(matrix_path, dtype=np.uint8, mode="r", shape=old_shape)
+
+    index = index_alignments(alignment_dir, file_suffix, workers=workers)
+    alignment_files, partitions, total_length = plan_partitions(index, file_suffix)
+    taxa_list = select_taxa(index_taxa(index), keep, exclude)
+    shape = (len(taxa_list), total_length)
+
+    # Taxa kept from the previous build and their row positions in both matrices
+    old_rows = {t: i for i, t in enumerate(old_taxa)}
+    kept_new = np.array([i for i, t in enumerate(taxa_list) if t in old_rows], dtype=np.intp)
+    kept_old = np.array([old_rows[taxa_list[i]] for i in kept_new], dtype=np.intp)
+    added_taxa = [t for t in taxa_list if t not in old_rows]
+
+    # An alignment is unchanged if its stat matches, or failing that its content hash
+    digests = []
+    changed = []
+    for fname in alignment_files:
+        entry = index[fname]
+        old = old_files.get(fname)
+        digest = None
+        if old is not None and old["length"] == entry["length"]:
+            if old["size"] == entry["size"] and old["mtime"] == entry["mtime"]:
+                digest = old["digest"]
+            else:
+                digest = file_digest(path.join(alignment_dir, fname))
+                if digest != old["digest"]:
+                    digest = None
+        digests.append(digest)
+        changed.append(digest is None)
+
+    print(f"Reusing {changed.count(False)} partitions, rebuilding {changed.count(True)}")
+    print(f"Taxa: {len(kept_new)} kept, {len(added_taxa)} added, {len(old_taxa) - len(kept_new)} removed")
+
+    tmp_path = f"{matrix_path}.tmp"
+    matrix = np.memmap(tmp_path, dtype=np.uint8, mode="w+", shape=shape)
+    for fname, p, is_changed in zip(alignment_files, partitions, changed):
+        if is_changed:
+            continue
+        old_start = old_files[fname]["start"]
+        seq_len = p[2] - p[1] + 1
+        matrix[kept_new, p[1] - 1:p[2]] = old_matrix[:, old_start:old_start + seq_len][kept_old]
+    matrix.flush()
+    del matrix, old_matrix
+
+    missing_byte = ord(missing_char)
+    rebuild_tasks = []
+    row_tasks = []
+    for fname, p, is_changed in zip(alignment_files, partitions, changed):
+        filepath = path.join(alignment_dir, fname)
+        if is_changed:
+            rebuild_tasks.append((filepath, p[1] - 1, p[2] - p[1] + 1, missing_byte))
+        elif added_taxa:
+            row_tasks.append((filepath, index[fname], p[1] - 1, p[2] - p[1] + 1, added_taxa, missing_byte))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_stream_worker,
+                             initargs=(tmp_path, shape, taxa_list)) as executor:
+        rebuilt = iter(list(executor.map(fill_partition, rebuild_tasks)))
+        for _ in executor.map(fill_taxa_rows, row_tasks):
+            pass
+    digests = [next(rebuilt) if d is None else d for d in digests]
+
+    replace(tmp_path, matrix_path)
+    save_build_state(matrix_path, taxa_list, alignment_files, partitions, index, digests, missing_char)
+    matrix = np.memmap(matrix_path, dtype=np.uint8, mode="r", shape=shape)
+    return matrix, taxa_list, partitions
+
+def partition_stats(task):
+    """
+    Occupancy and gap counts for one partition of the shared supermatrix.
+
+    Returns:
+        tuple: (present, gaps, missing, keep) where present/gaps/missing are
+            per-taxon arrays and keep marks columns whose gap fraction among
+            present taxa is at most max_gap (all columns if max_gap is None)
+    """
+    start, seq_len, missing_byte, max_gap = task
+    block = np.asarray(_stream_matrix[:, start:start + seq_len])
+    is_missing = block == missing_byte
+    is_gap = block == GAP
+    missing = is_missing.sum(axis=1, dtype=np.int64)
+    gaps = is_gap.sum(axis=1, dtype=np.int64)
+    present = missing < seq_len
+
+    keep = np.ones(seq_len, dtype=bool)
+    n_present = np.count_nonzero(present)
+    if max_gap is not None and n_present:
+        keep = is_gap[present].sum(axis=0) <= max_gap * n_present
+    return present, gaps, missing, keep
+
+def supermatrix_stats(matrix_path, shape, taxa_list, partitions, missing_char="?", max_gap=None, workers=None):
+    """
+    Per-partition and per-taxon occupancy, gap and missing-data fractions.
+
+    Gap fractions are taken over the cells of taxa present in a partition;
+    missing fractions over all cells. With max_gap set, columns whose gap
+    fraction among present taxa exceeds it are marked for trimming.
+
+    Args:
+        matrix_path (str): Path of the memory-mapped supermatrix
+        shape (tuple): Matrix shape
+        taxa_list (list): Row order of the matrix
+        partitions (list): [name, start, end] entries (1-based, inclusive)
+        missing_char (str): Missing data character
+        max_gap (float): Maximum gap fraction of a kept column (default: no trimming)
+        workers (int): Number of worker processes (default: all cores)
+
+    Returns:
+        tuple: (partition_df, taxon_df, keep_columns) where keep_columns is
+            an index array of the retained supermatrix columns
+    """
+    missing_byte = ord(missing_char)
+    tasks = [(p[1] - 1, p[2] - p[1] + 1, missing_byte, max_gap) for p in partitions]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_stream_worker,
+                             initargs=(matrix_path, shape, taxa_list, "r")) as executor:
+        results = list(executor.map(partition_stats, tasks))
+
+    n_taxa = len(taxa_list)
+    taxon_present = np.zeros(n_taxa, dtype=np.int64)
+    taxon_gaps = np.zeros(n_taxa, dtype=np.int64)
+    taxon_missing = np.zeros(n_taxa, dtype=np.int64)
+    rows = []
+    keep_columns = []
+    for p, (present, gaps, missing, keep) in zip(partitions, results):
+        seq_len = p[2] - p[1] + 1
+        n_present = int(np.count_nonzero(present))
+        taxon_present += present
+        taxon_gaps += gaps
+        taxon_missing += missing
+        keep_columns.append(np.flatnonzero(keep) + p[1] - 1)
+        rows.append({
+            "partition": p[0],
+            "start": p[1],
+            "end": p[2],
+            "length": seq_len,
+            "n_present": n_present,
+            "occupancy": n_present / n_taxa if n_taxa else 0.0,
+            "gap_fraction": gaps.sum() / (n_present * seq_len) if n_present and seq_len else 0.0,
+            "missing_fraction": missing.sum() / (n_taxa * seq_len) if n_taxa and seq_len else 0.0,
+            "trimmed_length": int(np.count_nonzero(keep)),
+        })
+
+    total_length = shape[1]
+    taxon_cells = total_length - taxon_missing
+    partition_df = pd.DataFrame(rows)
+    taxon_df = pd.DataFrame({
+        "taxon": taxa_list,
+        "n_partitions": taxon_present,
+        "occupancy": taxon_present / len(partitions) if partitions else 0.0,
+        "gap_fraction": np.divide(taxon_gaps, taxon_cells, out=np.zeros(n_taxa), where=taxon_cells > 0),
+        "missing_fraction": taxon_missing / total_length if total_length else 0.0,
+    })
+    keep_columns = np.concatenate(keep_columns) if keep_columns else np.zeros(0, dtype=np.intp)
+    return partition_df, taxon_df, keep_columns
+
+def trimmed_partitions(partition_df):
+    """Partition table after column trimming; fully trimmed partitions are dropped."""
+    partitions = []
+    start = 1
+    for name, seq_len in zip(partition_df["partition"], partition_df["trimmed_length"]):
+        if seq_len:
+            partitions.append([name, start, start + seq_len - 1])
+            start += seq_len
+    return partitions
+
+def wrap_row(row, width=FASTA_LINE_WIDTH):
+    """Return a sequence row as bytes broken into lines of `width` residues."""
+    n_full = len(row) // width
+    lines = np.empty((n_full, width + 1), dtype=np.uint8)
+    lines[:, :width] = row[:n_full * width].reshape(n_full, width)
+    lines[:, width] = NEWLINE
+    out = lines.tobytes()
+    tail = row[n_full * width:]
+    if len(tail):
+        out += tail.tobytes() + b"\n"
+    return out
+
+def write_fasta_stream(matrix, taxa_list, fasta_out, columns=None):
+    """Write the supermatrix (optionally only `columns`) as FASTA, one row at a time."""
+    with open(fasta_out, "wb") as f:
+        for taxon, row in zip(taxa_list, matrix):
+            if columns is not None:
+                row = row[columns]
+            f.write(f">{taxon}\n".encode())
+            f.write(wrap_row(row))
+
+def write_phylip_stream(matrix, taxa_list, phylip_out, columns=None):
+    """Write the supermatrix (optionally only `columns`) as sequential relaxed PHYLIP."""
+    id_width = max(len(t) for t in taxa_list) + 1
+    n_columns = matrix.shape[1] if columns is None else len(columns)
+    with open(phylip_out, "wb") as f:
+        f.write(f" {matrix.shape[0]} {n_columns}\n".encode())
+        for taxon, row in zip(taxa_list, matrix):
+            if columns is not None:
+                row = row[columns]
+            f.write(taxon.ljust(id_width).encode())
+            f.write(row.tobytes())
+            f.write(b"\n")
+
+def write_partitions(partitions, partition_out):
+    """Write the partition table in the `name = start-end;` format."""
+    with open(partition_out, "w") as f:
+        for p in partitions:
+            f.write(f"{p[0]} = {p[1]}-{p[2]};\n")
+
 def get_all_taxa(alignment_dir, file_suffix=".aln"):
-    """Get all unique taxa names from alignment files."""
-    taxa = set()
-    for fname in listdir(alignment_dir):
-        if fname.endswith(file_suffix):
-            for record in SeqIO.parse(path.join(alignment_dir, fname), "fasta"):
-                taxa.add(str(record.id))
-    return sorted(list(taxa))
+    """Get all unique taxa names from the alignment directory index."""
+    return index_taxa(index_alignments(alignment_dir, file_suffix))
 
 def main():
     parser = argparse.ArgumentParser(description="Build supermatrix from alignment files")
@@ -106,11 +528,59 @@ def main():
     parser.add_argument("-o", "--output", required=True, help="Output prefix for supermatrix files")
     parser.add_argument("-s", "--suffix", default=".aln", help="Alignment file suffix (default: .aln)")
     parser.add_argument("-m", "--missing", default="?", help="Missing data character (default: ?)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Build a memory-mapped byte matrix and stream outputs from it")
+    parser.add_argument("--matrix", default=None,
+                        help="Path of the memory-mapped matrix in --stream mode (default: <output>.u8)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Update the previous --stream build, re-reading only changed alignments and added taxa")
+    parser.add_argument("--taxa", default=None,
+                        help="Only keep these taxa (CSV with an Accession column, or one accession per line)")
+    parser.add_argument("--exclude", default=None,
+                        help="Drop these taxa, e.g. data/outliers_set.txt (one accession per line)")
+    parser.add_argument("--stats", action="store_true",
+                        help="Write per-partition and per-taxon occupancy/gap tables (--stream mode)")
+    parser.add_argument("--max-gap", type=float, default=None,
+                        help="Trim columns whose gap fraction among present taxa exceeds this (--stream mode)")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Number of worker processes")
     args = parser.parse_args()
 
     if not path.isdir(args.input):
         sys.exit(f"Error: Input directory {args.input} not found")
 
+    if args.stream or args.incremental:
+        matrix_path = args.matrix or f"{args.output}.u8"
+        keep = read_taxa_file(args.taxa) if args.taxa else None
+        exclude = read_taxa_file(args.exclude) if args.exclude else None
+        build = update_supermatrix_stream if args.incremental else build_supermatrix_stream
+        print("Building memory-mapped supermatrix...")
+        matrix, taxa_list, partitions = build(
+            args.input, matrix_path, args.missing, args.suffix, args.workers, keep, exclude)
+        print(f"Found {len(taxa_list)} taxa")
+        print(f"Supermatrix length: {matrix.shape[1]} positions")
+        print(f"Number of partitions: {len(partitions)}")
+
+        columns = None
+        if args.stats or args.max_gap is not None:
+            partition_df, taxon_df, keep_columns = supermatrix_stats(
+                matrix_path, matrix.shape, taxa_list, partitions, args.missing, args.max_gap, args.workers)
+            if args.stats:
+                partition_df.to_csv(f"{args.output}.partition_stats.csv", index=False)
+                taxon_df.to_csv(f"{args.output}.taxon_stats.csv", index=False)
+                print(f"Wrote occupancy tables: {args.output}.partition_stats.csv, {args.output}.taxon_stats.csv")
+            if args.max_gap is not None:
+                columns = keep_columns
+                partitions = trimmed_partitions(partition_df)
+                print(f"Trimmed supermatrix length: {len(columns)} positions")
+
+        write_fasta_stream(matrix, taxa_list, args.output, columns)
+        print(f"Wrote FASTA format: {args.output}")
+        write_phylip_stream(matrix, taxa_list, f"{args.output}.phylip", columns)
+        print(f"Wrote PHYLIP format: {args.output}.phylip")
+        write_partitions(partitions, f"{args.output}.partitions")
+        print(f"Wrote partitions file: {args.output}.partitions")
+        return
+
     # Get list of all taxa
     print("Identifying taxa from alignment files...")
     taxa_list = get_all_taxa(args.input, args.suffix)
@@ -147,9 +617,7 @@ def main():
 
     # Write partitions
     partition_out = f"{args.output}.partitions"
-    with open(partition_out, "w") as f:
-        for p in partitions:
-            f.write(f"{p[0]} = {p[1]}-{p[2]};\n")
+    write_partitions(partitions, partition_out)
     print(f"Wrote partitions file: {partition_out}")
 
 if __name__ == "__main__":
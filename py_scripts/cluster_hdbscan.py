@@ -1,36 +1,42 @@
+import os
+import time
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from itertools import product
 from sklearn.decomposition import PCA
 from sklearn.cluster import HDBSCAN
-import umap
 import multiprocessing as mp
-import re  # Import regex module
+from hdbscan_tree import mutual_reachability_mst, single_linkage, condense_tree, select_clusters
+from dist_matrix import open_distance_matrix
+from umap_cache import umap_embedding, knn_graph
+from knn_graph import knn_to_sparse, connect_components
+from duplicates import load_duplicate_map, propagate_to_duplicates
 
-def run_hdbscan(GENE_NAME):
+ENZYME_TREE_DIR = '/work3/s233201/enzyme_out_3/enzyme_trees'
+CLUSTER_DIR = '/zhome/85/8/203063/a3_fungi/clusters'
+
+def run_hdbscan(GENE_NAME, cluster_on_knn=False):
     # Load embeddings from distance matrix
-    distance_matrix = pd.read_csv(f'/work3/s233201/enzyme_out_3/enzyme_trees/{GENE_NAME}/tree_iq_multi_LGI.mldist', 
-                                sep=r'\s+',
-                                header=None,
-                                skiprows=1)
-    log_path = f'/work3/s233201/enzyme_out_3/enzyme_trees/{GENE_NAME}/tree_iq_multi_LGI.log'
-    log_file = open(log_path, 'r')
-    log_lines = log_file.readlines()
-    log_file.close()
-
-    accessions = distance_matrix.iloc[:, 0].values
-    dm = distance_matrix.iloc[:, 1:].values
+    dm = open_distance_matrix(f'{ENZYME_TREE_DIR}/{GENE_NAME}/tree_iq_multi_LGI.mldist')
+    log_path = f'{ENZYME_TREE_DIR}/{GENE_NAME}/tree_iq_multi_LGI.log'
+
     print(dm.shape)
 
     print('Running UMAP')
-    # Perform UMAP dimensionality reduction with precomputed distances
-    reducer = umap.UMAP(n_neighbors=100, min_dist=0, n_components=10, metric='precomputed', random_state=42)
-    dm_reduced = reducer.fit_transform(dm)
+    # Perform UMAP dimensionality reduction with precomputed distances (cached, shares the kNN graph with the 2D run)
+    accessions, dm_reduced = umap_embedding(dm, n_components=10, n_neighbors=100, min_dist=0, random_state=42)
 
     print('Running HDBSCAN')
-    # Initialize and fit HDBSCAN
-    clusterer = HDBSCAN(min_cluster_size=5, min_samples=20, metric='l2', cluster_selection_epsilon=0.5, cluster_selection_method='leaf')
-    cluster_labels = clusterer.fit_predict(dm_reduced)
+    if cluster_on_knn:
+        # Cluster the tree distances directly on the cached kNN graph (sparse, O(n * k) memory)
+        indices, distances = knn_graph(dm, 100)
+        clusterer = HDBSCAN(min_cluster_size=5, min_samples=20, metric='precomputed', cluster_selection_epsilon=0.5, cluster_selection_method='leaf')
+        cluster_labels = clusterer.fit_predict(connect_components(knn_to_sparse(indices, distances), dm))
+    else:
+        # Same tree and selection code as the sweep (min_cluster_size=5, min_samples=20, epsilon=0.5, leaf)
+        linkage = single_linkage(*mutual_reachability_mst(dm_reduced, 20))
+        cluster_labels, _, _ = select_clusters(condense_tree(linkage, 5), 'leaf', 0.5)
 
     # Print clustering statistics
     n_clusters = len(set(cluster_labels)) - (1 if -1 in cluster_labels else 0)
@@ -42,8 +48,7 @@ def run_hdbscan(GENE_NAME):
     print(f"Percentage of points clustered: {(1 - n_noise/len(cluster_labels))*100:.2f}%")
 
     # Create 2D UMAP projection for visualization
-    reducer_2d = umap.UMAP(n_neighbors=100, min_dist=0.1, n_components=2, metric='precomputed', random_state=42)
-    vis_dm = reducer_2d.fit_transform(dm)
+    _, vis_dm = umap_embedding(dm, n_components=2, n_neighbors=100, min_dist=0.1, random_state=42)
 
     # Create scatter plot with matching style
     plt.figure(figsize=(15, 10))
@@ -59,43 +64,137 @@ def run_hdbscan(GENE_NAME):
     plt.savefig(f'/zhome/85/8/203063/a3_fungi/figures/clusters/5_20_05_leaf/{GENE_NAME}_clusters.png', dpi=300, bbox_inches='tight')
     plt.close()
 
-    # Create cluster DataFrame for original accessions
-    cluster_df = pd.DataFrame({
-        'sequence_idx': accessions,
-        'cluster': cluster_labels
-    })
-
-    # Parse log lines to append duplicates with their corresponding clusters
-    duplicates = []
-    for line in log_lines:
-        m = re.search(r"NOTE:\s+(\S+)\s+\(identical to\s+(\S+)\)", line)
-        if m:
-            dup, orig = m.groups()
-            # Lookup cluster from original accession in the original order
-            cluster_val = None
-            for idx, acc in enumerate(accessions):
-                if acc == orig:
-                    cluster_val = cluster_labels[idx]
-                    break
-            if cluster_val is None:
-                cluster_val = -1
-            duplicates.append({'sequence_idx': dup, 'cluster': cluster_val})
-    if duplicates:
-        duplicate_df = pd.DataFrame(duplicates)
-        cluster_df = pd.concat([cluster_df, duplicate_df], ignore_index=True)
-        cluster_df = cluster_df.drop_duplicates(subset=['sequence_idx'], keep='first')
-        cluster_df = cluster_df.rename(columns={'sequence_idx': 'accession'})
+    # Duplicates removed by IQ-TREE get their representative's cluster (-1 if it was not clustered)
+    clusters = propagate_to_duplicates(pd.Series(cluster_labels, index=accessions, name='cluster'),
+                                       load_duplicate_map(log_path), fill_value=-1)
+    cluster_df = clusters.rename_axis('accession').reset_index()
     # Save cluster assignments
-    cluster_df.to_csv(f'/zhome/85/8/203063/a3_fungi/clusters/5_20_05_leaf/{GENE_NAME.lower()}_dm_clusters.csv', index=False)
+    cluster_df.to_csv(f'{CLUSTER_DIR}/5_20_05_leaf/{GENE_NAME.lower()}_dm_clusters.csv', index=False)
+
+def setting_name(min_cluster_size, min_samples, epsilon, method):
+    """Folder-style name of one HDBSCAN setting, e.g. 5_20_05_leaf."""
+    return f"{min_cluster_size}_{min_samples}_{str(epsilon).replace('.', '')}_{method}"
+
+def sweep_gene(task):
+    """
+    Cluster one gene for every combination of HDBSCAN parameters.
+
+    The 10-D UMAP reduction is read from the embedding cache (computed once
+    per gene), the mutual-reachability single-linkage tree is built once per
+    min_samples, condensed once per min_cluster_size, and every
+    epsilon/method combination is selected from that shared condensed tree
+    (hdbscan_tree, which gives the same labels as HDBSCAN.fit_predict).
+
+    Args:
+        task (tuple): (gene_name, min_samples list, min_cluster_size list,
+            epsilon list, method list, output directory)
+
+    Returns:
+        list: One summary dict per setting; a setting that fails has its
+            error in the 'error' column and no labels column
+    """
+    gene_name, min_samples_list, min_cluster_sizes, epsilons, methods, out_dir = task
+    start = time.perf_counter()
+    dm = open_distance_matrix(f'{ENZYME_TREE_DIR}/{gene_name}/tree_iq_multi_LGI.mldist')
+    log_path = f'{ENZYME_TREE_DIR}/{gene_name}/tree_iq_multi_LGI.log'
+    accessions, dm_reduced = umap_embedding(dm, n_components=10, n_neighbors=100, min_dist=0, random_state=42)
+
+    summary = []
+    labels_by_setting = {}
+    for min_samples in min_samples_list:
+        # Only the mutual-reachability single-linkage tree depends on min_samples
+        linkage = single_linkage(*mutual_reachability_mst(dm_reduced, min_samples))
+
+        for min_cluster_size in min_cluster_sizes:
+            condensed = condense_tree(linkage, min_cluster_size)
+            for epsilon, method in product(epsilons, methods):
+                name = setting_name(min_cluster_size, min_samples, epsilon, method)
+                row = {
+                    'gene': gene_name,
+                    'setting': name,
+                    'min_cluster_size': min_cluster_size,
+                    'min_samples': min_samples,
+                    'epsilon': epsilon,
+                    'method': method,
+                    'n_points': len(accessions),
+                    'error': '',
+                }
+                try:
+                    labels, probabilities, stabilities = select_clusters(condensed, method, epsilon)
+                except Exception as e:
+                    print(f"FAILED {gene_name} {name}: {e!r}")
+                    summary.append({**row, 'error': repr(e)})
+                    continue
+                n_noise = int((labels == -1).sum())
+                labels_by_setting[name] = labels
+                summary.append({
+                    **row,
+                    'n_clusters': len(stabilities),
+                    'noise_fraction': n_noise / len(labels),
+                    'largest_cluster': int(np.bincount(labels[labels >= 0]).max()) if len(stabilities) else 0,
+                    'total_stability': stabilities.sum(),
+                    'median_stability': np.median(stabilities) if len(stabilities) else 0.0,
+                    'mean_probability': probabilities[labels >= 0].mean() if len(stabilities) else 0.0,
+                })
+
+    labels_df = pd.DataFrame(labels_by_setting, index=pd.Index(accessions, name='accession'))
+    labels_df = propagate_to_duplicates(labels_df, load_duplicate_map(log_path), fill_value=-1)
+    labels_df.reset_index().to_csv(os.path.join(out_dir, f'{gene_name.lower()}_sweep_labels.csv'), index=False)
+    n_failed = sum(1 for row in summary if row['error'])
+    print(f"{gene_name}: {len(summary) - n_failed} settings in {time.perf_counter() - start:.1f} s"
+          + (f", {n_failed} FAILED" if n_failed else ""))
+    return summary
+
+def run_sweep(gene_names, min_samples=(5, 10, 20, 50), min_cluster_sizes=(5, 10, 20, 50),
+              epsilons=(0.0, 0.25, 0.5, 1.0), methods=('eom', 'leaf'), out_dir=f'{CLUSTER_DIR}/sweep',
+              workers=None):
+    """
+    HDBSCAN parameter sweep over several genes in a process pool.
+
+    Writes one labels table per gene (a column per setting, duplicates
+    included) and a single summary table with cluster counts, noise
+    fraction and stability.
+
+    Args:
+        gene_names (list): Genes to cluster
+        min_samples (iterable): min_samples values
+        min_cluster_sizes (iterable): min_cluster_size values
+        epsilons (iterable): cluster_selection_epsilon values
+        methods (iterable): Cluster selection methods ('eom', 'leaf')
+        out_dir (str): Output directory
+        workers (int): Worker processes (default: min(genes, cores))
+
+    Returns:
+        pandas.DataFrame: Summary table, one row per gene and setting
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = [(gene, list(min_samples), sorted(min_cluster_sizes), list(epsilons), list(methods), out_dir)
+             for gene in gene_names]
+    workers = workers or max(1, min(len(tasks), mp.cpu_count()))
+    with mp.Pool(workers) as pool:
+        rows = [row for summary in pool.imap_unordered(sweep_gene, tasks) for row in summary]
+
+    summary_df = pd.DataFrame(rows).sort_values(['gene', 'min_samples', 'min_cluster_size', 'epsilon', 'method'])
+    summary_path = os.path.join(out_dir, 'sweep_summary.csv')
+    summary_df.to_csv(summary_path, index=False)
+    print(f"Wrote {len(summary_df)} settings to {summary_path}")
+    failed = summary_df[summary_df['error'] != '']
+    if len(failed):
+        print(f"{len(failed)} settings FAILED (see the 'error' column):")
+        print(failed[['gene', 'setting', 'error']].to_string(index=False))
+    return summary_df
 
 if __name__ == '__main__':
     gene_names = ['LYS1', 'LYS2', 'LYS4', 'LYS9', 'LYS12', 'LYS20', 'ARO8', 'ACO2']
-    
-    # Create a process pool with number of CPUs available
-    num_cpus = mp.cpu_count()
-    print(f"Running with {num_cpus} processes")
-    
-    with mp.Pool(num_cpus) as pool:
-        # Map the run_hdbscan function to all genes in parallel
-        pool.map(run_hdbscan, gene_names)
+    sweep = False  # Set to True to sweep HDBSCAN parameters instead of the single 5_20_05_leaf run
+
+    if sweep:
+        run_sweep(gene_names)
+    else:
+        # Create a process pool with number of CPUs available
+        num_cpus = mp.cpu_count()
+        print(f"Running with {num_cpus} processes")
 
+        with mp.Pool(num_cpus) as pool:
+            # Map the run_hdbscan function to all genes in parallel
+            pool.map(run_hdbscan, gene_names)
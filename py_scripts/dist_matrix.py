@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import itertools
+import os
+from os import path
+import numpy as np
+import pandas as pd
+
+STORE_SUFFIX = ".dmat"
+
+def store_paths(prefix):
+    """Paths of the condensed matrix (.npy) and accession index (.txt) of a store."""
+    return f"{prefix}.npy", f"{prefix}.txt"
+
+def default_store_prefix(src):
+    """Store prefix used for a text matrix when none is given (next to the source)."""
+    return f"{src}{STORE_SUFFIX}"
+
+def condensed_index(i, j, n):
+    """Position of pair (i, j), i != j, in the condensed upper triangle."""
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    return i * n - i * (i + 1) // 2 + (j - i - 1)
+
+def convert_text_matrix(src, prefix=None):
+    """
+    Convert an IQ-TREE .mldist or full_mat_*.csv matrix into a binary store.
+
+    Both formats have one header line followed by one row per accession
+    (`accession d_1 ... d_n`). Rows are streamed, so peak memory is one row
+    plus the float32 condensed upper triangle, which is written to disk as a
+    memory-mappable .npy. Both files are written under temporary names and
+    moved into place (accessions first, .npy last), so an interrupted
+    conversion never leaves a partial store that looks complete.
+
+    Args:
+        src (str): Path to the text matrix
+        prefix (str): Store prefix (default: <src>.dmat)
+
+    Returns:
+        str: Store prefix
+    """
+    prefix = prefix or default_store_prefix(src)
+    npy_path, acc_path = store_paths(prefix)
+    npy_tmp, acc_tmp = f"{npy_path}.part", f"{acc_path}.part"
+
+    with open(src) as f:
+        # The header is either the matrix size (.mldist) or the column names (csv),
+        # so the size is taken from the first data row instead
+        f.readline()
+        first = f.readline()
+        n = len(first.split()) - 1
+        condensed = np.lib.format.open_memmap(npy_tmp, mode="w+", dtype=np.float32,
+                                              shape=(n * (n - 1) // 2,))
+        accessions = []
+        offset = 0
+        for line in itertools.chain([first], f):
+            if not line.strip():
+                continue
+            name, values = line.split(maxsplit=1)
+            row = np.array(values.split(), dtype=np.float64)
+            if len(row) != n:
+                raise ValueError(f"{src}: row {name} has {len(row)} values, expected {n}")
+            accessions.append(name)
+            row_len = n - len(accessions)
+            condensed[offset:offset + row_len] = row[len(accessions):]
+            offset += row_len
+        condensed.flush()
+        del condensed
+
+    if len(accessions) != n:
+        raise ValueError(f"{src}: found {len(accessions)} rows, expected {n}")
+    with open(acc_tmp, "w") as f:
+        f.write("\n".join(accessions) + "\n")
+    os.replace(acc_tmp, acc_path)
+    os.replace(npy_tmp, npy_path)
+    return prefix
+
+class DistanceMatrix:
+    """
+    Symmetric distance matrix backed by a memory-mapped condensed float32 array.
+
+    Opening is cheap: only the accession index is read, and rows, pairs or
+    sub-matrices are assembled from the condensed triangle on demand.
+    """
+
+    def __init__(self, prefix):
+        npy_path, acc_path = store_paths(prefix)
+        self.prefix = prefix
+        self.condensed = np.load(npy_path, mmap_mode="r")
+        with open(acc_path) as f:
+            self.accessions = np.array([line.rstrip("\n") for line in f if line.strip()])
+        self.n = len(self.accessions)
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def shape(self):
+        return (self.n, self.n)
+
+    def pair(self, i, j):
+        """Distance(s) between index arrays i and j (0 on the diagonal)."""
+        i, j = np.asarray(i), np.asarray(j)
+        same = i == j
+        k = condensed_index(i, j, self.n)
+        return np.where(same, 0.0, self.condensed[np.where(same, 0, k)]).astype(np.float32)
+
+    def row(self, i, columns=None):
+        """Distances from accession i to all (or the given) accessions."""
+        j = np.arange(self.n) if columns is None else np.asarray(columns)
+        return self.pair(np.full(len(j), i), j)
+
+    def rows(self, start, stop):
+        """Dense block of rows start..stop-1 against all accessions."""
+        return self.block(np.arange(start, stop), np.arange(self.n))
+
+    def block(self, rows, columns):
+        """Dense (len(rows), len(columns)) block of distances between two index arrays."""
+        rows, columns = np.asarray(rows), np.asarray(columns)
+        shape = (len(rows), len(columns))
+        return self.pair(np.broadcast_to(rows[:, None], shape), np.broadcast_to(columns[None, :], shape))
+
+    def square(self, indices=None, dtype=np.float32):
+        """Dense matrix over all accessions or over the given index array."""
+        indices = np.arange(self.n) if indices is None else np.asarray(indices)
+        out = np.empty((len(indices), len(indices)), dtype=dtype)
+        for r, i in enumerate(indices):
+            out[r] = self.row(i, indices)
+        return out
+
+    def digest(self, chunk=1 << 24):
+        """Content hash of the accessions and distances, independent of file paths and mtimes."""
+        h = hashlib.blake2b(digest_size=16)
+        h.update("\n".join(self.accessions.tolist()).encode())
+        for start in range(0, len(self.condensed), chunk):
+            h.update(np.ascontiguousarray(self.condensed[start:start + chunk]).tobytes())
+        return h.hexdigest()
+
+    def to_frame(self):
+        """DataFrame in the legacy `read_csv(sep=r'\\s+', header=None, skiprows=1)` layout."""
+        df = pd.DataFrame(self.square(dtype=np.float64), columns=range(1, self.n + 1))
+        df.insert(0, 0, self.accessions.astype(object))
+        return df
+
+def open_distance_matrix(src, prefix=None):
+    """
+    Open a distance matrix, converting a text matrix to a store on first use.
+
+    Args:
+        src (str): Text matrix (.mldist / full_mat csv) or an existing store prefix
+        prefix (str): Store prefix for the converted matrix (default: <src>.dmat)
+
+    Returns:
+        DistanceMatrix
+    """
+    if path.exists(store_paths(src)[0]):
+        return DistanceMatrix(src)
+    prefix = prefix or default_store_prefix(src)
+    npy_path, acc_path = store_paths(prefix)
+    stale = not (path.exists(npy_path) and path.exists(acc_path)) or \
+        min(path.getmtime(npy_path), path.getmtime(acc_path)) < path.getmtime(src)
+    if stale:
+        print(f"Converting {src} to binary store {prefix}...")
+        convert_text_matrix(src, prefix)
+    return DistanceMatrix(prefix)
+
+def matrix_keys(dm, prefix_len=15):
+    """Accession join keys of a DistanceMatrix or legacy frame (accessions in column 0)."""
+    accessions = dm.accessions if isinstance(dm, DistanceMatrix) else dm.iloc[:, 0].astype(str).to_numpy()
+    return pd.Series(accessions, dtype=object).str[:prefix_len].to_numpy(dtype=str)
+
+def align_matrices(matrices, names=None, exclude=None, prefix_len=15):
+    """
+    Align any number of distance matrices on their common accessions.
+
+    Accessions are matched on their first `prefix_len` characters with a
+    sort join; when a key occurs more than once in a matrix its first row is
+    used. The common order follows the first matrix.
+
+    Args:
+        matrices (list): DistanceMatrix objects or legacy frames
+        names (list): Matrix names, used to report accessions missing from a matrix
+        exclude (iterable): Accessions to drop, e.g. outliers or removal lists
+        prefix_len (int): Number of accession characters used as the join key
+
+    Returns:
+        tuple: (common accession keys, [row index array per matrix]) so that
+            matrix_values(matrices[k], indices[k]) are all aligned
+    """
+    keys = [matrix_keys(dm, prefix_len) for dm in matrices]
+    sorted_keys = [np.unique(k, return_index=True) for k in keys]
+
+    common = sorted_keys[0][0]
+    for uniq, _ in sorted_keys[1:]:
+        common = np.intersect1d(common, uniq, assume_unique=True)
+
+    if names is not None:
+        for name, (uniq, _) in zip(names[1:], sorted_keys[1:]):
+            missing = np.setdiff1d(sorted_keys[0][0], uniq, assume_unique=True)
+            if len(missing):
+                print(f"Warning: Following entries are missing from {name}:")
+                print(set(missing.tolist()))
+                print("Removing these entries from all matrices...")
+
+    if exclude is not None:
+        exclude = np.array([acc.strip()[:prefix_len] for acc in exclude], dtype=str)
+        common = common[~np.isin(common, exclude)]
+
+    uniq0, first0 = sorted_keys[0]
+    common = common[np.argsort(first0[np.searchsorted(uniq0, common)], kind="stable")]
+    indices = [first[np.searchsorted(uniq, common)] for uniq, first in sorted_keys]
+    return common, indices
+
+def matrix_values(dm, indices):
+    """Dense sub-matrix of a DistanceMatrix or legacy frame over the given rows/columns."""
+    if isinstance(dm, DistanceMatrix):
+        return dm.square(indices)
+    return dm.iloc[:, 1:].to_numpy()[np.ix_(indices, indices)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert .mldist / full_mat text matrices to binary stores")
+    parser.add_argument("inputs", nargs="+", help="Text distance matrices")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Store prefix (single input only; default: <input>.dmat)")
+    args = parser.parse_args()
+
+    if args.output and len(args.inputs) > 1:
+        parser.error("--output can only be used with a single input")
+
+    for src in args.inputs:
+        prefix = convert_text_matrix(src, args.output)
+        dm = DistanceMatrix(prefix)
+        print(f"Wrote {prefix} ({dm.n} accessions)")
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,158 @@
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
-from numba import jit
+import io
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from dist_matrix import open_distance_matrix, store_paths
 
-@jit(nopython=True)
-def fill_distance_matrix(n_total, idx_map_unique1, idx_map_unique2, mat_dist):
-    """Fill distance matrix using numba acceleration"""
-    full_mat = np.zeros((n_total, n_total))
-    for i in range(n_total):
-        for j in range(i):  # Only fill lower triangle
-            idx1 = idx_map_unique1[i]
-            idx2 = idx_map_unique2[j]
-            dist = mat_dist[idx1, idx2]
-            full_mat[i, j] = dist
-            full_mat[j, i] = dist  # Mirror
-    return full_mat
+DUPLICATE_NOTE = re.compile(r"NOTE:\s+(\S+)\s+\(identical to\s+(\S+)\)")
+
+@lru_cache(maxsize=None)
+def _parse_duplicate_notes(log_file, mtime):
+    # mtime is only part of the cache key, so an updated log is parsed again
+    with open(log_file, 'r') as f:
+        pairs = DUPLICATE_NOTE.findall(f.read())
+    dup_map = pd.Series([orig for _, orig in pairs], index=[dup for dup, _ in pairs], dtype=object)
+    return dup_map[~dup_map.index.duplicated()]
+
+def load_duplicate_map(log_file):
+    """
+    Duplicate -> representative Series from the `NOTE: X (identical to Y)` lines of an IQ-TREE log.
+
+    The log is parsed with one regex pass and cached per path and
+    modification time, so repeated calls in a process are free. The Series
+    is shared between callers and must not be modified in place.
+    """
+    return _parse_duplicate_notes(os.path.abspath(log_file), os.path.getmtime(log_file))
+
+def propagate_to_duplicates(values, dup_map, fill_value=None):
+    """
+    Give every duplicate sequence the value of its representative.
+
+    Args:
+        values (pandas.Series or pandas.DataFrame): Values indexed by accession,
+            e.g. cluster labels of the unique sequences
+        dup_map (pandas.Series or dict): Duplicate -> representative
+        fill_value: Value for duplicates whose representative is not in values
+            (default: leave missing)
+
+    Returns:
+        Same type as values, with one row appended per duplicate not already present
+    """
+    dup_map = pd.Series(dup_map, dtype=object) if isinstance(dup_map, dict) else dup_map
+    dup_map = dup_map[~dup_map.index.isin(values.index)]
+    dup_values = values.reindex(dup_map.to_numpy())
+    dup_values.index = dup_map.index.rename(values.index.name)
+    if fill_value is not None:
+        dup_values = dup_values.fillna(fill_value).astype(values.dtypes)
+    return pd.concat([values, dup_values])
+
+def read_fasta_headers(in_fasta):
+    """Read the header lines (without '>') of a FASTA file in order."""
+    headers = []
+    with open(in_fasta, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                headers.append(line.strip()[1:])
+    return headers
+
+def read_phylip_names(phylip_file):
+    """Read the sequence names of a sequential PHYLIP file without loading the sequences."""
+    names = []
+    with open(phylip_file, 'r') as f:
+        f.readline()
+        for line in f:
+            if line.strip():
+                names.append(line.split(maxsplit=1)[0])
+    return names
+
+class ExpandedDistanceMatrix:
+    """
+    Lazy view of a distance matrix with IQ-TREE's identical sequences put back.
+
+    Only the unique-sequence matrix and an int32 `rep` array mapping every
+    original sequence to its representative row are kept; rows, pairs,
+    condensed vectors and dense matrices are produced on demand, so identical
+    sequences never cost quadratic memory.
+    """
+
+    def __init__(self, unique, unique_headers, headers, dup_to_unique):
+        """
+        Args:
+            unique (DistanceMatrix or numpy.ndarray): Unique-sequence distances
+            unique_headers (list): Row order of the unique matrix
+            headers (list): Original sequence names, in output order
+            dup_to_unique (dict or pandas.Series): Duplicate name -> representative name
+        """
+        self.unique = unique
+        self.headers = list(headers)
+        self.n = len(self.headers)
+        names = pd.Series(self.headers, dtype=object)
+        representatives = names.map(dup_to_unique).fillna(names)
+        rep = pd.Index(unique_headers).get_indexer(representatives)
+        if (rep < 0).any():
+            raise KeyError(representatives[rep < 0].iloc[0])
+        self.rep = rep.astype(np.int32)
+
+    @classmethod
+    def from_files(cls, in_fasta, mat_dist_name, log_file):
+        """Build the view from the original FASTA, the IQ-TREE .mldist (or its store) and log."""
+        unique = open_distance_matrix(mat_dist_name)
+        return cls(unique, unique.accessions.tolist(), read_fasta_headers(in_fasta),
+                   load_duplicate_map(log_file))
+
+    def __len__(self):
+        return self.n
+
+    def _unique_pair(self, a, b):
+        if isinstance(self.unique, np.ndarray):
+            return self.unique[a, b].astype(np.float32)
+        return self.unique.pair(a, b)
+
+    def pair(self, i, j):
+        """Distance(s) between original sequences i and j (index arrays)."""
+        i, j = np.asarray(i), np.asarray(j)
+        return np.where(i == j, np.float32(0), self._unique_pair(self.rep[i], self.rep[j]))
+
+    def row(self, i, columns=None):
+        """Distances from sequence i to all (or the given) sequences."""
+        j = np.arange(self.n) if columns is None else np.asarray(columns)
+        return self.pair(np.full(len(j), i), j)
+
+    def rows(self, start, stop):
+        """Dense block of rows [start, stop) against all sequences."""
+        block = np.empty((stop - start, self.n), dtype=np.float32)
+        for r, i in enumerate(range(start, stop)):
+            block[r] = self.row(i)
+        return block
+
+    def condensed(self):
+        """Condensed upper triangle over all original sequences."""
+        out = np.empty(self.n * (self.n - 1) // 2, dtype=np.float32)
+        offset = 0
+        for i in range(self.n - 1):
+            row = self.row(i, np.arange(i + 1, self.n))
+            out[offset:offset + len(row)] = row
+            offset += len(row)
+        return out
+
+    def square(self, indices=None, dtype=np.float32):
+        """Dense matrix over all sequences or over the given index array."""
+        indices = np.arange(self.n) if indices is None else np.asarray(indices)
+        out = np.empty((len(indices), len(indices)), dtype=dtype)
+        for r, i in enumerate(indices):
+            out[r] = self.row(i, indices)
+        return out
+
+    def to_frame(self):
+        """Materialize as the DataFrame written by manage_duplicates."""
+        df_full = pd.DataFrame(self.square(dtype=np.float64), index=self.headers, columns=self.headers)
+        df_full.reset_index(inplace=True)
+        df_full.rename(columns={'index': ''}, inplace=True)
+        return df_full
 
 def manage_duplicates(in_fasta, unique_fasta, mat_dist, log_file):
     """
@@ -24,69 +161,93 @@ def manage_duplicates(in_fasta, unique_fasta, mat_dist, log_file):
     Args:
         in_fasta (str): Path to original FASTA file with duplicates
         unique_fasta (str): Path to FASTA file with duplicates removed
-        mat_dist (numpy.ndarray): Distance matrix for unique sequences
+        mat_dist (numpy.ndarray or DistanceMatrix): Distance matrix for unique sequences
         log_file (str): Path to IQ-TREE log file containing duplicate information
     
     Returns:
         pandas.DataFrame: Updated distance matrix including duplicates
     """
-    # Read the unique sequences to get the base mapping
-    unique_seqs = pd.read_csv(unique_fasta, sep='\s+', header=None, skiprows=1)
-    unique_headers = unique_seqs[0].tolist()
-    
-    # Create duplicate mapping from log file
-    dup_to_unique = {}
-    with open(log_file, 'r') as f:
-        for line in f:
-            m = re.search(r"NOTE:\s+(\S+)\s+\(identical to\s+(\S+)\)", line)
-            if m:
-                dup, orig = m.groups()
-                dup_to_unique[dup] = orig
-    
-    # Add non-duplicate sequences to the mapping
-    for header in unique_headers:
-        dup_to_unique[header] = header
-    
-    # Read original headers from FASTA
-    headers = []
-    with open(in_fasta, 'r') as f:
-        for line in f:
-            if line.startswith('>'):
-                headers.append(line.strip()[1:])
-    
-    # Create index mappings for numba
-    unique_header_to_idx = {h: i for i, h in enumerate(unique_headers)}
-    idx_map_unique1 = np.array([unique_header_to_idx[dup_to_unique[h]] for h in headers])
-    idx_map_unique2 = np.array([unique_header_to_idx[dup_to_unique[h]] for h in headers])
-    
-    # Generate full matrix
-    n_total = len(headers)
-    full_mat = fill_distance_matrix(n_total, idx_map_unique1, idx_map_unique2, mat_dist)
-    
-    # Create DataFrame with accessions
-    df_full = pd.DataFrame(full_mat, index=headers, columns=headers)
-    df_full.reset_index(inplace=True)
-    df_full.rename(columns={'index': ''}, inplace=True)
-    
-    return df_full
+    view = ExpandedDistanceMatrix(mat_dist, read_phylip_names(unique_fasta),
+                                  read_fasta_headers(in_fasta), load_duplicate_map(log_file))
+    return view.to_frame()
+
+def write_expanded_text(view, output_path, block_rows=256):
+    """
+    Write an expanded view in the legacy `to_csv(sep=' ')` layout, one row block at a time.
+
+    Distances are written with 9 significant digits, enough to reproduce the
+    float32 values exactly, so small distances are not rounded to 0.
+    """
+    with open(output_path, 'w') as f:
+        f.write(' ' + ' '.join(view.headers) + '\n')
+        for start in range(0, view.n, block_rows):
+            stop = min(start + block_rows, view.n)
+            buf = io.StringIO()
+            np.savetxt(buf, view.rows(start, stop), fmt='%.9g', delimiter=' ')
+            lines = buf.getvalue().splitlines()
+            f.write(''.join(f"{name} {line}\n" for name, line in zip(view.headers[start:stop], lines)))
+
+def write_expanded_store(view, prefix, block_rows=256):
+    """
+    Write an expanded view as a binary distance-matrix store, one row block at a time.
+
+    Both files are written under temporary names and moved into place
+    (accessions first, .npy last), so an interrupted run never leaves a
+    partial store that looks complete.
+    """
+    npy_path, acc_path = store_paths(prefix)
+    npy_tmp, acc_tmp = f"{npy_path}.part", f"{acc_path}.part"
+    condensed = np.lib.format.open_memmap(npy_tmp, mode='w+', dtype=np.float32,
+                                          shape=(view.n * (view.n - 1) // 2,))
+    offset = 0
+    for start in range(0, view.n, block_rows):
+        stop = min(start + block_rows, view.n)
+        block = view.rows(start, stop)
+        for r, i in enumerate(range(start, stop)):
+            row = block[r, i + 1:]
+            condensed[offset:offset + len(row)] = row
+            offset += len(row)
+    condensed.flush()
+    del condensed
+    with open(acc_tmp, 'w') as f:
+        f.write('\n'.join(view.headers) + '\n')
+    os.replace(acc_tmp, acc_path)
+    os.replace(npy_tmp, npy_path)
+
+def expand_gene(task):
+    """Expand one gene's matrix and stream it to disk; run in a worker process."""
+    gene_name, in_fasta, mat_dist_name, log_file, output_path, output_format, block_rows = task
+    view = ExpandedDistanceMatrix.from_files(in_fasta, mat_dist_name, log_file)
+    if output_format == 'binary':
+        write_expanded_store(view, output_path, block_rows)
+    else:
+        write_expanded_text(view, output_path, block_rows)
+    return gene_name, view.n, len(view.unique)
+
+def expand_genes(tasks, workers=None):
+    """Expand several genes concurrently; peak memory is one row block per worker."""
+    # Convert the .mldist files up front so workers only memory-map the stores
+    for task in tasks:
+        open_distance_matrix(task[2])
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for gene_name, n_total, n_unique in executor.map(expand_gene, tasks):
+            print(f"{gene_name}: {n_unique} unique -> {n_total} sequences")
 
-def enzyme_matrices():
+def enzyme_matrices(output_format='text', block_rows=256, workers=None):
 
     gene_names = ["LYS20", "ACO2", "LYS4", "LYS12", "ARO8", "LYS2", "LYS9", "LYS1"]
+    base_dir = '/work3/s233201/enzyme_out_7/enzyme_trees'
+    out_dir = '/zhome/85/8/203063/a3_fungi/full_dist_mats/fast'
+    tasks = []
     for gene_name in gene_names:
-        base_dir = '/work3/s233201/enzyme_out_7/enzyme_trees'
         in_fasta = f'/work3/s233201/enzyme_out_7/{gene_name}.fasta'
-        unique_fasta = f'{base_dir}/{gene_name}/tree_iq_multi_LGI.uniqueseq.phy'
         mat_dist_name = f'{base_dir}/{gene_name}/tree_iq_multi_LGI.mldist'
         log_file = f'{base_dir}/{gene_name}/tree_iq_multi_LGI.log'
+        # Binary output is a dist_matrix store prefix, text keeps the full_mat csv name
+        output_path = f'{out_dir}/full_mat_{gene_name}' + ('.dmat' if output_format == 'binary' else '.csv')
+        tasks.append((gene_name, in_fasta, mat_dist_name, log_file, output_path, output_format, block_rows))
 
-        mat_dist = pd.read_csv(mat_dist_name, sep=r'\s+', header=None, skiprows=1)
-        mat_dist = mat_dist.iloc[:, 1:].to_numpy()
-        
-        full_mat = manage_duplicates(in_fasta, unique_fasta, mat_dist, log_file)
-        output_path = f'/zhome/85/8/203063/a3_fungi/full_dist_mats/fast/full_mat_{gene_name}.csv'
-        full_mat.to_csv(output_path, sep=' ', index=False)
-        print(full_mat.shape)
+    expand_genes(tasks, workers)
 
 def single_matrix():
 
@@ -110,8 +271,7 @@ def single_matrix():
 
     # output_path = f'/zhome/85/8/203063/a3_fungi/full_dist_mats/busco_phyl_4.csv'
 
-    mat_dist = pd.read_csv(mat_dist_name, sep=r'\s+', header=None, skiprows=1)
-    mat_dist = mat_dist.iloc[:, 1:].to_numpy()
+    mat_dist = open_distance_matrix(mat_dist_name)
 
     full_mat = manage_duplicates(in_fasta, unique_fasta, mat_dist, log_file)
     
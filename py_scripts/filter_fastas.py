@@ -1,21 +1,15 @@
-from Bio import SeqIO
 import os
 import pandas as pd
+from alignment_index import index_alignments, read_records, scan_alignment
 
-def filter_fasta(fasta_path, names, output_path):
-    # Keep track of found sequences
-    found_names = set()
+def filter_fasta(fasta_path, names, output_path, entry=None):
+    # Copy the kept records straight from their indexed byte offsets
+    if entry is None:
+        entry = scan_alignment(fasta_path)
+    records, found_names = read_records(fasta_path, entry, set(names))
     
-    # Filter sequences and write directly to output file
-    sequences = SeqIO.parse(fasta_path, "fasta")
-    filtered_sequences = []
-    
-    for seq in sequences:
-        if seq.id in names:
-            filtered_sequences.append(seq)
-            found_names.add(seq.id)
-    
-    SeqIO.write(filtered_sequences, output_path, "fasta")
+    with open(output_path, 'wb') as f:
+        f.write(records)
     
     # Report missing sequences
     missing_names = set(names) - found_names
@@ -38,12 +32,16 @@ def main():
     out_dir = os.path.join(main_dir, 'filtered_fastas')
     os.makedirs(out_dir, exist_ok=True)
 
+    # Header offsets of just these inputs are cached next to the outputs, so reruns only rescan changed files
+    index = index_alignments(main_dir, '.fasta', index_path=os.path.join(out_dir, '.index.fasta.npz'),
+                             files=[file_name + '.fasta' for file_name in file_names])
+
     # Process each file and track total missing sequences
     total_missing = 0
     for file_name in file_names:
         input_path = os.path.join(main_dir, file_name+'.fasta')
         output_path = os.path.join(out_dir, file_name+'_filtered.fasta')
-        missing = filter_fasta(input_path, names, output_path)
+        missing = filter_fasta(input_path, names, output_path, index.get(file_name+'.fasta'))
         total_missing += missing
     
     print(f"\nTotal missing sequences across all files: {total_missing}")
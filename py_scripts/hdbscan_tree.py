@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+CONDENSED_DTYPE = np.dtype([
+    ("parent", np.intp),
+    ("child", np.intp),
+    ("value", np.float64),
+    ("cluster_size", np.intp),
+])
+
+def core_distances(X, min_samples):
+    """Distance of every point to its min_samples-th nearest neighbour, the point itself included."""
+    nbrs = NearestNeighbors(n_neighbors=min_samples).fit(X)
+    return nbrs.kneighbors(X, min_samples)[0][:, -1]
+
+def squared_distances(X, i):
+    """
+    Squared Euclidean distances from point i to all points.
+
+    Features are accumulated one at a time, in the same order and rounding
+    as sklearn's distance metric, so ties in mutual reachability (which are
+    common, as many edges take a core distance) break the same way.
+    """
+    diff = X[:, 0] - X[i, 0]
+    acc = diff * diff
+    for k in range(1, X.shape[1]):
+        diff = X[:, k] - X[i, k]
+        acc += diff * diff
+    return acc
+
+def mutual_reachability_mst(X, min_samples):
+    """
+    Minimum spanning tree of the Euclidean mutual-reachability graph (Prim, as in HDBSCAN).
+
+    Memory is O(n): each step computes one row of distances from the node
+    just added to the tree.
+
+    Args:
+        X (numpy.ndarray): (n, d) points
+        min_samples (int): Neighbours defining the core distance
+
+    Returns:
+        tuple: (sources, targets, distances) of the n - 1 edges, in the order they were added
+    """
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    n = len(X)
+    core = core_distances(X, min_samples)
+    in_tree = np.zeros(n, dtype=bool)
+    min_reach = np.full(n, np.inf)
+    source = np.zeros(n, dtype=np.intp)
+    sources = np.empty(n - 1, dtype=np.intp)
+    targets = np.empty(n - 1, dtype=np.intp)
+    distances = np.empty(n - 1)
+
+    current = 0
+    for i in range(n - 1):
+        in_tree[current] = True
+        min_reach[current] = np.inf
+        d = np.sqrt(squared_distances(X, current))
+        reach = np.maximum(np.maximum(d, core), core[current])
+        better = (reach < min_reach) & ~in_tree
+        min_reach[better] = reach[better]
+        source[better] = current
+        # Ties go to the lowest index, as in sklearn's Prim implementation
+        current = int(np.argmin(min_reach))
+        sources[i], targets[i], distances[i] = source[current], current, min_reach[current]
+    return sources, targets, distances
+
+def single_linkage(sources, targets, distances):
+    """
+    Single-linkage tree (scipy linkage layout) of a spanning tree.
+
+    Returns:
+        tuple: (left, right, distance, size) arrays of the n - 1 merges; merge
+            k creates node n + k
+    """
+    n = len(sources) + 1
+    # Same (default) sort as sklearn, so equal distances merge in the same order
+    order = np.argsort(distances)
+    parent = np.full(2 * n - 1, -1, dtype=np.intp)
+    size = np.concatenate((np.ones(n, dtype=np.intp), np.zeros(n - 1, dtype=np.intp)))
+    left = np.empty(n - 1, dtype=np.intp)
+    right = np.empty(n - 1, dtype=np.intp)
+
+    def find(x):
+        root = x
+        while parent[root] != -1:
+            root = parent[root]
+        while x != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for k, e in enumerate(order.tolist()):
+        a, b = find(sources[e]), find(targets[e])
+        left[k], right[k] = a, b
+        parent[a] = parent[b] = n + k
+        size[n + k] = size[a] + size[b]
+    return left, right, distances[order], size[n:]
+
+def condense_tree(linkage, min_cluster_size):
+    """
+    Condensed tree of a single-linkage tree: splits into two parts of at least
+    min_cluster_size make new clusters, smaller parts fall out as points.
+
+    Clusters are numbered n, n + 1, ... in breadth-first order, as in sklearn
+    and the hdbscan package, so children always have larger ids than parents.
+
+    Args:
+        linkage (tuple): single_linkage output
+        min_cluster_size (int): Smallest cluster size (at least 2)
+
+    Returns:
+        numpy.ndarray: CONDENSED_DTYPE rows (parent, child, lambda, size); a
+            point's row holds the lambda at which it fell out of its cluster
+    """
+    left, right, distance, size = linkage
+    n = len(left) + 1
+    root = 2 * n - 2
+
+    def node_size(node):
+        return 1 if node < n else size[node - n]
+
+    # Cluster label of every node, and the lambda at which it fell out (if it did)
+    label = np.empty(2 * n - 1, dtype=np.intp)
+    fallen = np.full(2 * n - 1, np.nan)
+    label[root] = n
+    next_label = n + 1
+    rows = []
+    queue = [root]
+    while queue:
+        next_queue = []
+        for node in queue:
+            if node < n:
+                if not np.isnan(fallen[node]):
+                    rows.append((label[node], node, fallen[node], 1))
+                continue
+            children = (left[node - n], right[node - n])
+            next_queue.extend(children)
+            if not np.isnan(fallen[node]):
+                for child in children:
+                    label[child], fallen[child] = label[node], fallen[node]
+                continue
+            lam = 1.0 / distance[node - n] if distance[node - n] > 0 else np.inf
+            big = [node_size(child) >= min_cluster_size for child in children]
+            for child, is_big in zip(children, big):
+                if all(big):
+                    label[child] = next_label
+                    next_label += 1
+                    rows.append((label[node], label[child], lam, node_size(child)))
+                elif is_big:
+                    # The cluster carries on through its only large child
+                    label[child] = label[node]
+                else:
+                    label[child], fallen[child] = label[node], lam
+        queue = next_queue
+    return np.array(rows, dtype=CONDENSED_DTYPE)
+
+def cluster_stability(condensed):
+    """
+    Stability of every condensed-tree cluster: the sum of (lambda - lambda_birth) * size over its children.
+
+    Identical points split at lambda = inf; such lambdas are capped at the
+    largest finite one so stabilities stay finite.
+
+    Returns:
+        numpy.ndarray: Stability indexed by cluster id (entries below the root are 0)
+    """
+    parent, child = condensed['parent'], condensed['child']
+    value = condensed['value']
+    finite = np.isfinite(value)
+    value = np.where(finite, value, value[finite].max() if finite.any() else 0.0)
+    births = np.zeros(max(parent.max(), child.max()) + 1)
+    births[child] = value
+    births[parent.min()] = 0.0
+    return np.bincount(parent, weights=(value - births[parent]) * condensed['cluster_size'],
+                       minlength=len(births))
+
+def select_clusters(condensed, method='eom', epsilon=0.0):
+    """
+    Flat clustering of a condensed tree, following HDBSCAN's selection rules.
+
+    The root is never selected (allow_single_cluster=False). With epsilon > 0,
+    selected clusters born below that distance are replaced by their closest
+    ancestor born above it, as in cluster_selection_epsilon.
+
+    Args:
+        condensed (numpy.ndarray): condense_tree output
+        method (str): 'eom' (excess of mass) or 'leaf'
+        epsilon (float): cluster_selection_epsilon
+
+    Returns:
+        tuple: (labels with -1 for noise, membership probabilities, stability of
+            each selected cluster in label order)
+    """
+    parent, child, value = condensed['parent'], condensed['child'], condensed['value']
+    root = parent.min()
+    n_points = root
+    stability = cluster_stability(condensed)
+
+    is_cluster_row = condensed['cluster_size'] > 1
+    cluster_parent = dict(zip(child[is_cluster_row].tolist(), parent[is_cluster_row].tolist()))
+    birth_lambda = dict(zip(child[is_cluster_row].tolist(), value[is_cluster_row].tolist()))
+    cluster_children = {}
+    for c, p in cluster_parent.items():
+        cluster_children.setdefault(p, []).append(c)
+    nodes = sorted(cluster_parent)
+
+    def descendants(node):
+        stack, out = list(cluster_children.get(node, [])), []
+        while stack:
+            node = stack.pop()
+            out.append(node)
+            stack.extend(cluster_children.get(node, []))
+        return out
+
+    if method == 'eom':
+        subtree = stability.copy()
+        selected = set()
+        # Children have larger ids than their parents, so this visits children first
+        for node in reversed(nodes):
+            below = sum(subtree[c] for c in cluster_children.get(node, []))
+            if below > subtree[node]:
+                subtree[node] = below
+            else:
+                selected.add(node)
+                selected.difference_update(descendants(node))
+    elif method == 'leaf':
+        selected = {node for node in nodes if node not in cluster_children}
+    else:
+        raise ValueError(f"Unknown cluster selection method: {method}")
+
+    if epsilon > 0:
+        chosen, processed = set(), set()
+        for node in sorted(selected):
+            if node in processed:
+                continue
+            # Climb while the cluster is born below epsilon, stopping below the root
+            while 1.0 / birth_lambda[node] < epsilon and cluster_parent[node] != root:
+                node = cluster_parent[node]
+            chosen.add(node)
+            processed.update(descendants(node))
+        selected = chosen - processed
+
+    # Every condensed-tree node inherits the label of its closest selected ancestor (or itself)
+    clusters = sorted(selected)
+    node_label = np.full(root + len(nodes) + 1, -1, dtype=np.intp)
+    for label, node in enumerate(clusters):
+        node_label[node] = label
+    for node in nodes:
+        if node_label[node] < 0:
+            node_label[node] = node_label[cluster_parent[node]]
+
+    points = ~is_cluster_row
+    labels = np.full(n_points, -1, dtype=np.intp)
+    labels[child[points]] = node_label[parent[points]]
+
+    # Membership strength: the point's lambda relative to the largest lambda in its cluster
+    deaths = np.zeros(len(node_label))
+    np.maximum.at(deaths, parent, value)
+    probabilities = np.zeros(n_points)
+    point_lambda = np.empty(n_points)
+    point_lambda[child[points]] = value[points]
+    clustered = labels >= 0
+    max_lambda = deaths[np.asarray(clusters, dtype=np.intp)[labels[clustered]]]
+    lam = point_lambda[clustered]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        probabilities[clustered] = np.where((max_lambda == 0) | np.isinf(lam), 1.0,
+                                            np.minimum(lam, max_lambda) / max_lambda)
+    return labels, probabilities, stability[np.asarray(clusters, dtype=np.intp)]
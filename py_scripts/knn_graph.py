@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+import argparse
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from dist_matrix import open_distance_matrix
+
+def block_knn(block, start, k):
+    """
+    k nearest neighbours of the rows of one distance block, by partial sort.
+
+    Each row's own point is forced to the first position, as in UMAP's own
+    search, even when identical sequences give other points a distance of 0.
+    With start=None the rows are new points that are not among the columns.
+
+    Args:
+        block (numpy.ndarray): (rows, n) distances of rows start..start+rows-1
+        start (int): Index of the block's first row, or None
+        k (int): Number of neighbours (including the point itself)
+
+    Returns:
+        tuple: (int32 indices, float32 distances), both (rows, k)
+    """
+    d = np.array(block, dtype=np.float32)
+    if start is not None:
+        local = np.arange(len(d))
+        d[local, start + local] = -1
+    idx = np.argpartition(d, k - 1, axis=1)[:, :k]
+    part = np.take_along_axis(d, idx, axis=1)
+    order = np.argsort(part, axis=1, kind="stable")
+    idx = np.take_along_axis(idx, order, axis=1).astype(np.int32)
+    dists = np.maximum(np.take_along_axis(part, order, axis=1), 0).astype(np.float32)
+    return idx, dists
+
+def streamed_knn(dm, n_neighbors, block_rows=1024):
+    """
+    Exact kNN graph of a distance matrix, read in row blocks.
+
+    Only one (block_rows, n) block is in memory at a time, so the cost is
+    O(n * block_rows + n * k) rather than O(n^2).
+
+    Args:
+        dm: DistanceMatrix or ExpandedDistanceMatrix (anything with rows(start, stop))
+        n_neighbors (int): Number of neighbours (including the point itself)
+        block_rows (int): Rows per block
+
+    Returns:
+        tuple: (int32 indices, float32 distances), both (n, n_neighbors)
+    """
+    n = len(dm)
+    k = min(n_neighbors, n)
+    indices = np.empty((n, k), dtype=np.int32)
+    distances = np.empty((n, k), dtype=np.float32)
+    for start in range(0, n, block_rows):
+        stop = min(start + block_rows, n)
+        indices[start:stop], distances[start:stop] = block_knn(dm.rows(start, stop), start, k)
+    return indices, distances
+
+def knn_to_sparse(indices, distances):
+    """
+    Symmetric sparse distance matrix holding the kNN edges in both directions.
+
+    Suitable as a sparse `metric='precomputed'` input for UMAP and HDBSCAN;
+    pairs that are not neighbours either way are absent (treated as far).
+    """
+    n, k = indices.shape
+    rows = np.repeat(np.arange(n), k)
+    cols = indices.ravel()
+    keep = (cols >= 0) & (cols != rows)
+    # Zero distances (identical sequences) would vanish from the sparse structure
+    values = np.maximum(distances.ravel()[keep], np.finfo(np.float32).tiny)
+    graph = sparse.csr_matrix((values, (rows[keep], cols[keep])), shape=(n, n))
+    return graph.maximum(graph.T).tocsr()
+
+def connect_components(graph, dm, block_rows=1024):
+    """
+    Add the shortest edges needed to make a sparse kNN graph connected.
+
+    Well-separated groups can leave the kNN graph in several pieces, which
+    HDBSCAN rejects. Each pass streams the matrix once and adds, for every
+    component, its shortest edge to another component (Boruvka), so at most
+    log2(components) passes are needed.
+
+    Args:
+        graph (scipy.sparse.csr_matrix): Symmetric kNN distance graph
+        dm: Distance matrix with rows(start, stop)
+        block_rows (int): Rows per block
+
+    Returns:
+        scipy.sparse.csr_matrix: Connected symmetric graph
+    """
+    n_comp, labels = csgraph.connected_components(graph, directed=False)
+    while n_comp > 1:
+        best = np.full(n_comp, np.inf)
+        best_edge = np.zeros((n_comp, 2), dtype=np.int64)
+        for start in range(0, len(dm), block_rows):
+            stop = min(start + block_rows, len(dm))
+            block = np.array(dm.rows(start, stop), dtype=np.float64)
+            block[labels[start:stop, None] == labels[None, :]] = np.inf
+            j = block.argmin(axis=1)
+            d = block[np.arange(len(block)), j]
+            for r in np.flatnonzero(d < best[labels[start:stop]]):
+                c = labels[start + r]
+                if d[r] < best[c]:
+                    best[c] = d[r]
+                    best_edge[c] = (start + r, j[r])
+        rows, cols = best_edge[:, 0], best_edge[:, 1]
+        values = np.maximum(best, np.finfo(np.float32).tiny)
+        extra = sparse.csr_matrix((values, (rows, cols)), shape=graph.shape)
+        graph = graph.maximum(extra).maximum(extra.T).tocsr()
+        n_comp, labels = csgraph.connected_components(graph, directed=False)
+    return graph
+
+def save_knn(path, indices, distances):
+    """Save a kNN graph as compact int32/float32 arrays."""
+    np.savez(path, indices=indices.astype(np.int32), distances=distances.astype(np.float32))
+
+def load_knn(path, n_neighbors=None):
+    """Load a kNN graph, optionally pruned to its first n_neighbors columns."""
+    with np.load(path) as npz:
+        indices, distances = npz["indices"], npz["distances"]
+    if n_neighbors is not None:
+        indices, distances = indices[:, :n_neighbors], distances[:, :n_neighbors]
+    return indices, distances
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract kNN graphs from distance matrices in row blocks")
+    parser.add_argument("inputs", nargs="+", help="Text distance matrices or store prefixes")
+    parser.add_argument("-k", "--n-neighbors", type=int, default=100, help="Neighbours per point, including itself")
+    parser.add_argument("-b", "--block-rows", type=int, default=1024, help="Rows per block")
+    parser.add_argument("-o", "--output", default=None, help="Output .npz (single input only; default: <store>.knn<k>.npz)")
+    args = parser.parse_args()
+
+    if args.output and len(args.inputs) > 1:
+        parser.error("--output can only be used with a single input")
+
+    for src in args.inputs:
+        dm = open_distance_matrix(src)
+        indices, distances = streamed_knn(dm, args.n_neighbors, args.block_rows)
+        out = args.output or f"{dm.prefix}.knn{args.n_neighbors}.npz"
+        save_knn(out, indices, distances)
+        print(f"Wrote {out} ({indices.shape[0]} points, k={indices.shape[1]})")
+
+if __name__ == "__main__":
+    main()
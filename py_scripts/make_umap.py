@@ -1,35 +1,132 @@
 import argparse
-from umap import UMAP
+import os
+import time
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-from ete3 import Tree
+from umap_cache import umap_embedding, aligned_embeddings, append_embedding
+from tree_arrays import tree_edge_collection
 import multiprocessing
 from functools import partial
 
-def process_gene_data(gene_name):
-    """Process single gene and return UMAP coordinates and taxa information"""
+TAXA_CSV = '/zhome/85/8/203063/a3_fungi/data_out/taxa_non_filtered.csv'
+
+def gene_mldist_path(gene_name):
+    return f'/work3/s233201/enzyme_out_3/enzyme_trees/{gene_name}/tree_iq_multi_LGI.mldist'
+
+def appended_mldist_path(gene_name, append_dir):
+    """Rebuilt matrix of a gene holding the original accessions plus newly added assemblies."""
+    return os.path.join(append_dir, gene_name, 'tree_iq_multi_LGI.mldist')
+
+def load_phylum_map(taxa_csv=TAXA_CSV):
+    """Phylum per 15-character accession, read once and shared with every gene job."""
+    taxa_df = pd.read_csv(taxa_csv)
+    taxa_df['Accession_short'] = taxa_df['Accession'].str[:15]
+    return taxa_df.drop_duplicates('Accession_short').set_index('Accession_short')['Phylum']
+
+# Per-worker state, set once by init_gene_worker
+_phylum_map = None
+_thread_limit = None
+
+def init_gene_worker(phylum_map, n_threads):
+    """Share the taxa table with a worker and cap its numba/BLAS threads."""
+    global _phylum_map, _thread_limit
+    _phylum_map = phylum_map
+    import numba
+    from threadpoolctl import threadpool_limits
+    numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+    _thread_limit = threadpool_limits(limits=n_threads)
+
+def process_gene_data(gene_name, phylum_map=None, append_dir=None):
+    """
+    Process single gene and return UMAP coordinates, taxa information and run time.
+
+    With append_dir, accessions added in the gene's rebuilt matrix there are
+    projected into the cached embedding instead of refitting it.
+    """
+    start = time.perf_counter()
+    phylum_map = _phylum_map if phylum_map is None else phylum_map
     try:
-        taxa_df = pd.read_csv('/zhome/85/8/203063/a3_fungi/data_out/taxa_non_filtered.csv')
-        mldist_name = f'/work3/s233201/enzyme_out_3/enzyme_trees/{gene_name}/tree_iq_multi_LGI.mldist'
-        
-        distance_matrix = pd.read_csv(mldist_name, sep='\s+', header=None, skiprows=1)
-        distance_matrix = distance_matrix.to_numpy()
-        accessions = distance_matrix[:, 0]
-        distance_matrix = distance_matrix[:, 1:]
-        
-        taxa_df['Accession_short'] = taxa_df['Accession'].str[:15]
-        accessions_short = np.array([acc[:15] for acc in accessions])
-        taxa_df = taxa_df[taxa_df['Accession_short'].isin(accessions_short)].copy()
-        taxa_df = taxa_df.set_index('Accession_short').loc[accessions_short].reset_index()
+        if phylum_map is None:
+            phylum_map = load_phylum_map()
+        if append_dir:
+            accessions, embedding, is_new = append_embedding(gene_mldist_path(gene_name),
+                                                             appended_mldist_path(gene_name, append_dir),
+                                                             n_components=2, random_state=42,
+                                                             min_dist=0.1, n_neighbors=100)
+            print(f"{gene_name}: placed {is_new.sum()} new accessions into the existing embedding")
+        else:
+            accessions, embedding = umap_embedding(gene_mldist_path(gene_name), n_components=2, random_state=42,
+                                                   min_dist=0.1, n_neighbors=100)
         
-        if distance_matrix.size > 0 and len(taxa_df) == len(accessions):
-            reducer = UMAP(n_components=2, metric='precomputed', random_state=42, min_dist=0.1, n_neighbors=100)
-            embedding = reducer.fit_transform(distance_matrix)
-            return gene_name, embedding, taxa_df['Phylum'].values
+        phyla = phylum_map.reindex([acc[:15] for acc in accessions])
+        if len(accessions) > 0 and not phyla.isna().any():
+            return gene_name, embedding, phyla.values, time.perf_counter() - start
+        print(f"Error processing {gene_name}: {phyla.isna().sum()} accessions missing from the taxa table")
     except Exception as e:
         print(f"Error processing {gene_name}: {str(e)}")
-        return None
+    return None
+
+def run_gene_jobs(gene_names, workers=None, append_dir=None):
+    """
+    Embed several genes in parallel without oversubscribing the cores.
+
+    The taxa table is read once and handed to each worker at start-up,
+    numba/BLAS threads are capped so workers x threads matches the core
+    count, and the largest matrices are started first so the slowest jobs
+    do not end up running alone at the end.
+
+    Args:
+        gene_names (list): Genes to embed
+        workers (int): Worker processes (default: min(genes, cores))
+        append_dir (str): Directory of rebuilt matrices whose new accessions are
+            appended to the cached embeddings (see process_gene_data)
+
+    Returns:
+        list: (gene_name, embedding, phyla) in gene_names order, failed genes omitted
+    """
+    n_cores = multiprocessing.cpu_count()
+    workers = workers or max(1, min(len(gene_names), n_cores))
+    n_threads = max(1, n_cores // workers)
+    phylum_map = load_phylum_map()
+
+    def matrix_size(gene):
+        src = gene_mldist_path(gene)
+        return os.path.getsize(src) if os.path.exists(src) else 0
+    ordered = sorted(gene_names, key=matrix_size, reverse=True)
+
+    print(f"Running {len(ordered)} genes on {workers} workers x {n_threads} threads")
+    with multiprocessing.Pool(workers, initializer=init_gene_worker, initargs=(phylum_map, n_threads)) as pool:
+        job = partial(process_gene_data, append_dir=append_dir)
+        results = {r[0]: r for r in pool.imap_unordered(job, ordered) if r is not None}
+
+    for gene in ordered:
+        if gene in results:
+            print(f"{gene}: {len(results[gene][1])} accessions in {results[gene][3]:.1f} s")
+        else:
+            print(f"{gene}: failed")
+    return [results[gene][:3] for gene in gene_names if gene in results]
+
+def joint_gene_embeddings(gene_names, mode='aligned', reference=None):
+    """
+    Embed all genes in one comparable frame on their common accessions.
+
+    Args:
+        gene_names (list): Genes to embed
+        mode (str): 'aligned' (AlignedUMAP) or 'reference' (initialised from the reference embedding)
+        reference (str): Reference matrix for mode='reference', e.g. the BUSCO tree
+
+    Returns:
+        list: (gene_name, embedding, phyla) in gene_names order
+    """
+    start = time.perf_counter()
+    accessions, embeddings = aligned_embeddings([gene_mldist_path(g) for g in gene_names], n_components=2,
+                                                mode=mode, reference=reference, random_state=None,
+                                                min_dist=0.1, n_neighbors=100)
+    phyla = load_phylum_map().reindex([acc[:15] for acc in accessions]).fillna('Other').values
+    print(f"Joint {mode} embedding of {len(gene_names)} genes on {len(accessions)} common accessions "
+          f"in {time.perf_counter() - start:.1f} s")
+    return [(gene, embedding, phyla) for gene, embedding in zip(gene_names, embeddings)]
 
 def make_umap(gene_name, use_subplots=False, ax=None):
     # Toggle tree visualization here
@@ -43,21 +140,14 @@ def make_umap(gene_name, use_subplots=False, ax=None):
         #taxa_df = pd.read_csv('/work3/s233201/enzyme_out/final_iq.mldist')
         
         mldist_name = f'/work3/s233201/enzyme_out_6/enzyme_trees/{gene_name}/tree_iq_multi_LGI.mldist'
-        tree_name = f'/work3/s233201/enzyme_out_6/enzyme_trees/{gene_names}tree_iq_multi_LGI.treefile'
+        tree_name = f'/work3/s233201/enzyme_out_6/enzyme_trees/{gene_name}/tree_iq_multi_LGI.treefile'
 
         #mldist_name = '/work3/s233201/output_phyl_busco_1/tree_iq_multi_LGI.mldist'
         #tree_name = '/work3/s233201/output_phyl_busco_1/tree_iq_multi_LGI.treefile'
         
-        # Read the distance matrix, skipping header
-        distance_matrix = pd.read_csv(mldist_name, 
-                                    sep='\s+',
-                                    header=None,
-                                    skiprows=1)
-        
-        # Convert to numpy array and drop first column (which contains accessions)
-        distance_matrix = distance_matrix.to_numpy()
-        accessions = distance_matrix[:, 0]
-        distance_matrix = distance_matrix[:, 1:]
+        # Cached embedding of the distance matrix (computed on first use)
+        accessions, embedding = umap_embedding(mldist_name, n_components=2, random_state=42,
+                                               min_dist=0.1, n_neighbors=100)
         
         # Filter and align taxa_df with distance matrix accessions using first 15 characters
         taxa_df['Accession_short'] = taxa_df['Accession'].str[:15]
@@ -65,19 +155,10 @@ def make_umap(gene_name, use_subplots=False, ax=None):
         taxa_df = taxa_df[taxa_df['Accession_short'].isin(accessions_short)].copy()
         taxa_df = taxa_df.set_index('Accession_short').loc[accessions_short].reset_index()
         
-        print(f"Matrix shape: {distance_matrix.shape}")
+        print(f"Matrix shape: {(len(accessions), len(accessions))}")
         print(f"Number of matching taxa: {len(taxa_df)}")
         
-        if distance_matrix.size > 0 and len(taxa_df) == len(accessions):
-            # Create UMAP object
-            reducer = UMAP(
-                n_components=2,
-                metric='precomputed',
-                random_state=42,
-                min_dist=0.1,
-                n_neighbors=100
-            )
-            embedding = reducer.fit_transform(distance_matrix)
+        if len(accessions) > 0 and len(taxa_df) == len(accessions):
                 
             # Create a mapping from node names to UMAP coordinates
             name_to_idx = {acc[:15]: i for i, acc in enumerate(accessions)}
@@ -88,20 +169,7 @@ def make_umap(gene_name, use_subplots=False, ax=None):
             
             # First plot edges from the tree (with low opacity) if enabled
             if SHOW_TREE:
-                tree = Tree(tree_name, format=1)
-            
-                for node in tree.traverse():
-                    if not node.is_leaf():
-                        leaves = node.get_leaves()
-                        for i in range(len(leaves)-1):
-                            leaf1 = leaves[i].name[:15]
-                            leaf2 = leaves[i+1].name[:15]
-                            if leaf1 in name_to_idx and leaf2 in name_to_idx:
-                                idx1 = name_to_idx[leaf1]
-                                idx2 = name_to_idx[leaf2]
-                                plt.plot([embedding[idx1, 0], embedding[idx2, 0]],
-                                    [embedding[idx1, 1], embedding[idx2, 1]],
-                                    color='gray', alpha=0.1, linewidth=0.5)
+                ax.add_collection(tree_edge_collection(tree_name, name_to_idx, embedding))
 
             # Define phylum colors using ColorBrewer
             PHYLUM_COLORS = {
@@ -152,12 +220,16 @@ def make_umap(gene_name, use_subplots=False, ax=None):
 if __name__ == '__main__':
     gene_names = ["LYS20", "ACO2", "LYS4", "LYS12", "ARO8", "LYS2", "LYS9", "LYS1"]
     use_subplots = True  # Toggle for subplot vs separate plots
+    joint_mode = None  # 'aligned' or 'reference' for panels sharing one coordinate frame
+    reference_mldist = '/work3/s233201/output_phyl_busco_3/tree_iq_LGI_fast.mldist'
+    append_dir = None  # e.g. '/work3/s233201/enzyme_out_6/enzyme_trees' to place new assemblies without refitting
     
     if use_subplots:
-        # Process all genes in parallel to get data
-        with multiprocessing.Pool() as pool:
-            results = pool.map(process_gene_data, gene_names)
-        results = [r for r in results if r is not None]
+        if joint_mode:
+            results = joint_gene_embeddings(gene_names, joint_mode, reference_mldist)
+        else:
+            # Process all genes in parallel to get data
+            results = run_gene_jobs(gene_names, append_dir=append_dir)
         
         # Create subplot grid
         n_rows = 2
@@ -1,37 +1,27 @@
-from umap.umap_ import UMAP
 import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+from umap_cache import umap_embedding
 
 try:
     # Read taxa data
     taxa_df = pd.read_csv('/zhome/85/8/203063/a3_fungi/data_out/taxa_non_filtered.csv')
        
-    # Read the distance matrix, skipping header
-    distance_matrix = pd.read_csv('/work3/s233201/output_phyl_busco/tree_iq_multi_LGI.mldist', 
-                                sep='\s+',
-                                header=None,
-                                skiprows=1)
-    
-    # Convert to numpy array and drop first column (which contains accessions)
-    distance_matrix = distance_matrix.to_numpy()
-    accessions = np.array([acc[:15] for acc in distance_matrix[:, 0]])  # Trim to 15 chars
-    distance_matrix = distance_matrix[:, 1:]
+    # Cached 3D embedding of the distance matrix (UMAP defaults: 15 neighbours, unseeded)
+    accessions, embedding = umap_embedding('/work3/s233201/output_phyl_busco/tree_iq_multi_LGI.mldist',
+                                           n_components=3, n_neighbors=15, random_state=None)
+    accessions = np.array([acc[:15] for acc in accessions])  # Trim to 15 chars
     
     # Filter and align taxa_df with distance matrix accessions
     taxa_df['Accession_trim'] = taxa_df['Accession'].str[:15]  # Add trimmed column
     taxa_df = taxa_df[taxa_df['Accession_trim'].isin(accessions)].copy()
     taxa_df = taxa_df.set_index('Accession_trim').loc[accessions].reset_index()
     
-    print(f"Matrix shape: {distance_matrix.shape}")
+    print(f"Matrix shape: {(len(accessions), len(accessions))}")
     print(f"Number of matching taxa: {len(taxa_df)}")
     
-    if distance_matrix.size > 0 and len(taxa_df) == len(accessions):
-        # Create 3D UMAP
-        reducer = UMAP(n_components=3, metric='precomputed')
-        embedding = reducer.fit_transform(distance_matrix)
-        
+    if len(accessions) > 0 and len(taxa_df) == len(accessions):
         # Create dataframe for plotting
         plot_df = pd.DataFrame({
             'UMAP1': embedding[:, 0],
@@ -1,8 +1,8 @@
-from umap import UMAP
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-from ete3 import Tree
+from umap_cache import umap_embedding
+from tree_arrays import tree_edge_collection
 import multiprocessing
 
 
@@ -12,19 +12,15 @@ def process_gene_data(gene_name):
         taxa_df = pd.read_csv('/zhome/85/8/203063/a3_fungi/data_out/taxa_non_filtered.csv')
         mldist_name = f'/work3/s233201/enzyme_out_3/enzyme_trees/{gene_name}/tree_iq_multi_LGI.mldist'
         
-        distance_matrix = pd.read_csv(mldist_name, sep='\s+', header=None, skiprows=1)
-        distance_matrix = distance_matrix.to_numpy()
-        accessions = distance_matrix[:, 0]
-        distance_matrix = distance_matrix[:, 1:]
+        accessions, embedding = umap_embedding(mldist_name, n_components=2, random_state=42,
+                                               min_dist=0.1, n_neighbors=100)
         
         taxa_df['Accession_short'] = taxa_df['Accession'].str[:15]
         accessions_short = np.array([acc[:15] for acc in accessions])
         taxa_df = taxa_df[taxa_df['Accession_short'].isin(accessions_short)].copy()
         taxa_df = taxa_df.set_index('Accession_short').loc[accessions_short].reset_index()
         
-        if distance_matrix.size > 0 and len(taxa_df) == len(accessions):
-            reducer = UMAP(n_components=2, metric='precomputed', random_state=42, min_dist=0.1, n_neighbors=100)
-            embedding = reducer.fit_transform(distance_matrix)
+        if len(accessions) > 0 and len(taxa_df) == len(accessions):
             return gene_name, embedding, taxa_df['Phylum'].values
     except Exception as e:
         print(f"Error processing {gene_name}: {str(e)}")
@@ -47,16 +43,9 @@ def make_umap(use_subplots=False, ax=None):
         #mldist_name = '/work3/s233201/output_phyl_busco_1/tree_iq_multi_LGI.mldist'
         #tree_name = '/work3/s233201/output_phyl_busco_1/tree_iq_multi_LGI.treefile'
         
-        # Read the distance matrix, skipping header
-        distance_matrix = pd.read_csv(mldist_name, 
-                                    sep='\s+',
-                                    header=None,
-                                    skiprows=1)
-        
-        # Convert to numpy array and drop first column (which contains accessions)
-        distance_matrix = distance_matrix.to_numpy()
-        accessions = distance_matrix[:, 0]
-        distance_matrix = distance_matrix[:, 1:]
+        # Cached embedding of the distance matrix (computed on first use)
+        accessions, embedding = umap_embedding(mldist_name, n_components=2, random_state=42,
+                                               min_dist=0.1, n_neighbors=100)
         
         # Filter and align taxa_df with distance matrix accessions using first 15 characters
         taxa_df['Accession_short'] = taxa_df['Accession'].str[:15]
@@ -64,19 +53,10 @@ def make_umap(use_subplots=False, ax=None):
         taxa_df = taxa_df[taxa_df['Accession_short'].isin(accessions_short)].copy()
         taxa_df = taxa_df.set_index('Accession_short').loc[accessions_short].reset_index()
         
-        print(f"Matrix shape: {distance_matrix.shape}")
+        print(f"Matrix shape: {(len(accessions), len(accessions))}")
         print(f"Number of matching taxa: {len(taxa_df)}")
         
-        if distance_matrix.size > 0 and len(taxa_df) == len(accessions):
-            # Create UMAP object
-            reducer = UMAP(
-                n_components=2,
-                metric='precomputed',
-                random_state=42,
-                min_dist=0.1,
-                n_neighbors=100
-            )
-            embedding = reducer.fit_transform(distance_matrix)
+        if len(accessions) > 0 and len(taxa_df) == len(accessions):
                 
             # Create a mapping from node names to UMAP coordinates
             name_to_idx = {acc[:15]: i for i, acc in enumerate(accessions)}
@@ -86,20 +66,7 @@ def make_umap(use_subplots=False, ax=None):
             
             # First plot edges from the tree (with low opacity) if enabled
             if SHOW_TREE:
-                tree = Tree(tree_name, format=1)
-            
-                for node in tree.traverse():
-                    if not node.is_leaf():
-                        leaves = node.get_leaves()
-                        for i in range(len(leaves)-1):
-                            leaf1 = leaves[i].name[:15]
-                            leaf2 = leaves[i+1].name[:15]
-                            if leaf1 in name_to_idx and leaf2 in name_to_idx:
-                                idx1 = name_to_idx[leaf1]
-                                idx2 = name_to_idx[leaf2]
-                                plt.plot([embedding[idx1, 0], embedding[idx2, 0]],
-                                    [embedding[idx1, 1], embedding[idx2, 1]],
-                                    color='gray', alpha=0.1, linewidth=0.5)
+                ax.add_collection(tree_edge_collection(tree_name, name_to_idx, embedding))
 
             # Define phylum colors using ColorBrewer
             PHYLUM_COLORS = {
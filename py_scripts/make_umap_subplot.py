@@ -1,12 +1,13 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-from umap import UMAP
-from ete3 import Tree
+from tree_arrays import tree_edge_collection
+from umap_cache import umap_embedding, aligned_embeddings
 
 def make_umap_subplot():
     # Configuration
     SHOW_TREE = False  # Set to True to show phylogenetic tree edges
+    ALIGNED = False  # Set to True to embed both inputs jointly (AlignedUMAP) on their common accessions
     OUTPUT_PATH = '/zhome/85/8/203063/a3_fungi/figures/busco_aaa_comparison.png'
 
     # Input files for the two plots
@@ -40,12 +41,18 @@ def make_umap_subplot():
     try:
         taxa_df = pd.read_csv('/zhome/85/8/203063/a3_fungi/data_out/taxa_non_filtered.csv')
 
-        for ax, input_data in zip(axes, inputs):
-            # Read and process distance matrix
-            distance_matrix = pd.read_csv(input_data['mldist'], sep='\s+', header=None, skiprows=1)
-            distance_matrix = distance_matrix.to_numpy()
-            accessions = distance_matrix[:, 0]
-            distance_matrix = distance_matrix[:, 1:]
+        if ALIGNED:
+            common_accessions, aligned = aligned_embeddings([input_data['mldist'] for input_data in inputs],
+                                                            n_components=2, random_state=None,
+                                                            min_dist=0.1, n_neighbors=100)
+
+        for panel, (ax, input_data) in enumerate(zip(axes, inputs)):
+            # Cached embedding of the distance matrix (computed on first use)
+            if ALIGNED:
+                accessions, embedding = common_accessions, aligned[panel]
+            else:
+                accessions, embedding = umap_embedding(input_data['mldist'], n_components=2, random_state=42,
+                                                       min_dist=0.1, n_neighbors=100)
 
             # Process taxa data
             taxa_df['Accession_short'] = taxa_df['Accession'].str[:15]
@@ -53,27 +60,11 @@ def make_umap_subplot():
             plot_taxa_df = taxa_df[taxa_df['Accession_short'].isin(accessions_short)].copy()
             plot_taxa_df = plot_taxa_df.set_index('Accession_short').loc[accessions_short].reset_index()
 
-            if distance_matrix.size > 0 and len(plot_taxa_df) == len(accessions):
-                # Create UMAP embedding
-                reducer = UMAP(n_components=2, metric='precomputed', random_state=42, 
-                             min_dist=0.1, n_neighbors=100)
-                embedding = reducer.fit_transform(distance_matrix)
-
+            if len(accessions) > 0 and len(plot_taxa_df) == len(accessions):
                 # Plot tree edges if enabled
                 if SHOW_TREE:
                     name_to_idx = {acc[:15]: i for i, acc in enumerate(accessions)}
-                    tree = Tree(input_data['tree'], format=1)
-                    for node in tree.traverse():
-                        if not node.is_leaf():
-                            leaves = node.get_leaves()
-                            for i in range(len(leaves)-1):
-                                leaf1 = leaves[i].name[:15]
-                                leaf2 = leaves[i+1].name[:15]
-                                if leaf1 in name_to_idx and leaf2 in name_to_idx:
-                                    idx1, idx2 = name_to_idx[leaf1], name_to_idx[leaf2]
-                                    ax.plot([embedding[idx1, 0], embedding[idx2, 0]],
-                                          [embedding[idx1, 1], embedding[idx2, 1]],
-                                          color='gray', alpha=0.1, linewidth=0.5)
+                    ax.add_collection(tree_edge_collection(input_data['tree'], name_to_idx, embedding))
 
                 # Plot points for each phylum
                 for phylum in sorted(plot_taxa_df['Phylum'].unique()):
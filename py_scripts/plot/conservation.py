@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import hashlib
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from build_supermatrix import parse_alignment_bytes
+
+# Column count tables have one slot per symbol: A-Z, gap, anything else, padding
+N_SYMBOLS = 32
+N_LETTERS = 26
+GAP_CODE = 26
+OTHER_CODE = 27
+LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+# Directory for cached count tables (None keeps them next to the alignments)
+COUNTS_CACHE_DIR = None
+# Cached tables kept per alignment (one per outlier set), oldest removed first
+MAX_CACHED_TABLES = 4
+
+# The 20 standard amino acids and their BLOSUM62 background frequencies,
+# as used for the Jensen-Shannon score of Capra & Singh (2007)
+AMINO_ACIDS = "ARNDCQEGHILKMFPSTWYV"
+BLOSUM62_BACKGROUND = np.array([
+    0.078, 0.051, 0.041, 0.052, 0.024, 0.034, 0.059, 0.083, 0.025, 0.062,
+    0.092, 0.056, 0.024, 0.044, 0.043, 0.059, 0.055, 0.014, 0.034, 0.072,
+])
+AMINO_ACID_CODES = np.array([ord(aa) - ord("A") for aa in AMINO_ACIDS])
+
+def symbol_codes():
+    """Byte -> symbol code lookup table (case-insensitive letters, '-' and '.' as gaps)."""
+    codes = np.full(256, OTHER_CODE, dtype=np.uint8)
+    codes[ord("A"):ord("Z") + 1] = np.arange(N_LETTERS)
+    codes[ord("a"):ord("z") + 1] = np.arange(N_LETTERS)
+    codes[ord("-")] = GAP_CODE
+    codes[ord(".")] = GAP_CODE
+    return codes
+
+SYMBOL_CODES = symbol_codes()
+
+def accession_of(record_id):
+    """Accession part of a record ID (the text before '|', if any)."""
+    return record_id.split('|')[0]
+
+def keep_rows(ids, exclude=None):
+    """Mask of records whose full ID and accession are both outside the exclude set."""
+    if not exclude:
+        return np.ones(len(ids), dtype=bool)
+    return np.array([rid not in exclude and accession_of(rid) not in exclude for rid in ids], dtype=bool)
+
+def load_alignment(filepath, exclude=None):
+    """
+    Read an aligned FASTA file into symbol codes, without per-record objects.
+
+    Args:
+        filepath (str): Aligned FASTA file
+        exclude (set): Record IDs or accessions to drop, e.g. outliers
+
+    Returns:
+        tuple: (kept record IDs, contiguous uint8 code matrix of shape (n, L))
+    """
+    with open(filepath, "rb") as f:
+        ids, matrix = parse_alignment_bytes(np.frombuffer(f.read(), dtype=np.uint8), filepath)
+    keep = keep_rows(ids, exclude)
+    ids = [rid for rid, k in zip(ids, keep) if k]
+    return ids, SYMBOL_CODES[matrix[keep]]
+
+def iter_alignment_blocks(filepath, exclude=None, chunk_bytes=8 << 20):
+    """
+    Stream an aligned FASTA file as blocks of symbol codes, holding one chunk of records at a time.
+
+    Args:
+        filepath (str): Aligned FASTA file
+        exclude (set): Record IDs or accessions to drop, e.g. outliers
+        chunk_bytes (int): Bytes read per chunk; a block holds the complete records it contains
+
+    Yields:
+        tuple: (kept record IDs, (rows, L) uint8 code matrix) per block
+    """
+    length = None
+    remainder = b""
+    with open(filepath, "rb") as f:
+        while True:
+            chunk = f.read(chunk_bytes)
+            buffer = remainder + chunk
+            # Cut after the last complete record; keep the rest for the next chunk
+            cut = buffer.rfind(b"\n>") + 1 if chunk else len(buffer)
+            if cut <= 0:
+                if not buffer:
+                    break
+                remainder = buffer
+                continue
+            block, remainder = buffer[:cut], buffer[cut:]
+            ids, matrix = parse_alignment_bytes(np.frombuffer(block, dtype=np.uint8), filepath)
+            if ids:
+                if length is None:
+                    length = matrix.shape[1]
+                elif matrix.shape[1] != length:
+                    raise ValueError(f"{filepath}: sequences are not all the same length")
+                keep = keep_rows(ids, exclude)
+                yield [rid for rid, k in zip(ids, keep) if k], SYMBOL_CODES[matrix[keep]]
+            if not chunk:
+                break
+
+def alignment_rows(filepath, accessions, chunk_bytes=8 << 20):
+    """
+    Code rows of the first record containing each accession, streamed until all are found.
+
+    Args:
+        filepath (str): Aligned FASTA file
+        accessions (iterable): Accessions to look up (substrings of the record IDs)
+        chunk_bytes (int): Bytes read per chunk
+
+    Returns:
+        dict: Accession -> (L,) uint8 code row; accessions not found are left out
+    """
+    rows = {}
+    pending = list(accessions)
+    for ids, codes in iter_alignment_blocks(filepath, chunk_bytes=chunk_bytes):
+        for i, rid in enumerate(ids):
+            for acc in pending:
+                if acc in rid:
+                    rows[acc] = codes[i].copy()
+            pending = [acc for acc in pending if acc not in rows]
+            if not pending:
+                return rows
+    return rows
+
+def residue_numbers(codes):
+    """
+    1-based ungapped residue number of every alignment cell, by a cumulative sum over each row.
+
+    Args:
+        codes (numpy.ndarray): (n, L) uint8 symbol codes
+
+    Returns:
+        numpy.ndarray: (n, L) int32 residue numbers, 0 at gaps
+    """
+    residues = codes != GAP_CODE
+    return np.where(residues, np.cumsum(residues, axis=1, dtype=np.int32), 0)
+
+def group_counts(codes, groups, n_groups, block_rows=1024):
+    """
+    Column count tables of several row groups (e.g. phyla) in one bincount pass.
+
+    Args:
+        codes (numpy.ndarray): (n, L) uint8 symbol codes
+        groups (numpy.ndarray): Group index of every row, in [0, n_groups)
+        n_groups (int): Number of groups
+        block_rows (int): Rows per bincount, bounding the temporary index array
+
+    Returns:
+        numpy.ndarray: (n_groups, L, N_SYMBOLS) int32 counts
+    """
+    n, length = codes.shape
+    size = length * N_SYMBOLS
+    offsets = np.arange(length, dtype=np.intp) * N_SYMBOLS
+    groups = np.asarray(groups, dtype=np.intp) * size
+    counts = np.zeros(n_groups * size, dtype=np.int64)
+    for start in range(0, n, block_rows):
+        stop = min(start + block_rows, n)
+        index = codes[start:stop] + offsets + groups[start:stop, None]
+        counts += np.bincount(index.ravel(), minlength=n_groups * size)
+    return counts.reshape(n_groups, length, N_SYMBOLS).astype(np.int32)
+
+def streamed_group_counts(filepath, groups_of, n_groups, exclude=None, chunk_bytes=8 << 20):
+    """
+    Column count tables of several row groups, accumulated over a streamed alignment.
+
+    Args:
+        filepath (str): Aligned FASTA file
+        groups_of (callable): Maps a block's record IDs to their group indices
+            (negative to leave a record out)
+        n_groups (int): Number of groups
+        exclude (set): Record IDs or accessions to drop, e.g. outliers
+        chunk_bytes (int): Bytes read per chunk
+
+    Returns:
+        numpy.ndarray: (n_groups, L, N_SYMBOLS) int64 counts
+    """
+    counts = None
+    for ids, codes in iter_alignment_blocks(filepath, exclude, chunk_bytes):
+        if counts is None:
+            counts = np.zeros((n_groups, codes.shape[1], N_SYMBOLS), dtype=np.int64)
+        groups = np.asarray(groups_of(ids), dtype=np.intp)
+        member = groups >= 0
+        if member.any():
+            counts += group_counts(codes[member], groups[member], n_groups)
+    if counts is None:
+        return np.zeros((n_groups, 0, N_SYMBOLS), dtype=np.int64)
+    return counts
+
+def column_counts(codes, block_rows=1024):
+    """
+    Count every symbol in every column with one bincount per row block.
+
+    Args:
+        codes (numpy.ndarray): (n, L) uint8 symbol codes
+        block_rows (int): Rows per bincount, bounding the temporary index array
+
+    Returns:
+        numpy.ndarray: (L, N_SYMBOLS) int32 counts
+    """
+    return group_counts(codes, np.zeros(len(codes), dtype=np.intp), 1, block_rows)[0]
+
+def _ratio(numerator, denominator):
+    numerator = np.asarray(numerator, dtype=np.float64)
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+
+def gap_fraction(counts):
+    """Fraction of gaps per column."""
+    return _ratio(counts[:, GAP_CODE], counts.sum(axis=1))
+
+def max_frequency(counts, count_gaps=True):
+    """
+    Frequency of the most common residue per column.
+
+    Args:
+        counts (numpy.ndarray): Column count table
+        count_gaps (bool): Divide by all sequences (gappy columns score low)
+            rather than by the residues present in the column
+
+    Returns:
+        numpy.ndarray: Scores in [0, 1]
+    """
+    residues = counts[:, :N_LETTERS]
+    total = counts.sum(axis=1) if count_gaps else residues.sum(axis=1)
+    return _ratio(residues.max(axis=1), total)
+
+def shannon_entropy(counts):
+    """Shannon entropy (bits) of the residue distribution per column, gaps excluded."""
+    residues = counts[:, :N_LETTERS].astype(np.float64)
+    p = _ratio(residues, residues.sum(axis=1, keepdims=True))
+    logs = np.log2(p, out=np.zeros_like(p), where=p > 0)
+    return 0.0 - (p * logs).sum(axis=1)
+
+def jensen_shannon(counts, background=BLOSUM62_BACKGROUND, pseudocount=1e-6, gap_penalty=True):
+    """
+    Jensen-Shannon divergence between each column's amino-acid distribution and a background.
+
+    Args:
+        counts (numpy.ndarray): Column count table
+        background (numpy.ndarray): Background frequencies in AMINO_ACIDS order
+        pseudocount (float): Added to every amino-acid count
+        gap_penalty (bool): Scale scores by the fraction of non-gap sequences
+
+    Returns:
+        numpy.ndarray: Scores in [0, 1] (higher is more conserved)
+    """
+    aa = counts[:, AMINO_ACID_CODES] + pseudocount
+    p = aa / aa.sum(axis=1, keepdims=True)
+    q = background / background.sum()
+    r = 0.5 * (p + q)
+    scores = 0.5 * (p * np.log2(p / r)).sum(axis=1) + 0.5 * (q * np.log2(q / r)).sum(axis=1)
+    if gap_penalty:
+        scores *= 1 - gap_fraction(counts)
+    return scores
+
+def top_residues(counts, top_k=3):
+    """
+    Most common residues per column and their share of the residues present.
+
+    Ties are broken alphabetically.
+
+    Args:
+        counts (numpy.ndarray): Column count table
+        top_k (int): Number of residues per column
+
+    Returns:
+        tuple: ((L, top_k) array of letters, '-' where fewer residues occur,
+            (L, top_k) float frequencies)
+    """
+    residues = counts[:, :N_LETTERS]
+    order = np.argsort(-residues, axis=1, kind="stable")[:, :top_k]
+    top = np.take_along_axis(residues, order, axis=1)
+    frequencies = _ratio(top, residues.sum(axis=1, keepdims=True))
+    letters = np.where(top > 0, np.array(list(LETTERS))[order], '-')
+    return letters, frequencies
+
+def consensus_sequence(counts):
+    """Most common residue of every column ('-' for all-gap columns) as a string."""
+    return ''.join(top_residues(counts, 1)[0][:, 0])
+
+def column_scores(counts, top_k=3):
+    """
+    All per-column statistics of a count table as a DataFrame (1-based positions).
+
+    Scores, gap fraction, the consensus residue and the top_k residues with
+    their frequencies all come from the same count table.
+    """
+    letters, frequencies = top_residues(counts, max(top_k, 1))
+    scores = pd.DataFrame({
+        'max_frequency': max_frequency(counts, count_gaps=True),
+        'max_frequency_residues': max_frequency(counts, count_gaps=False),
+        'entropy': shannon_entropy(counts),
+        'jensen_shannon': jensen_shannon(counts),
+        'gap_fraction': gap_fraction(counts),
+        'consensus': letters[:, 0],
+    }, index=pd.RangeIndex(1, len(counts) + 1, name='position'))
+    for k in range(top_k):
+        scores[f'top{k + 1}'] = letters[:, k]
+        scores[f'top{k + 1}_frequency'] = frequencies[:, k]
+    return scores
+
+def _short_hash(text):
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+def counts_cache_prefix(filepath, cache_dir=None):
+    """Common prefix of an alignment's cached count tables, next to it or in cache_dir."""
+    if cache_dir is None:
+        return filepath
+    # Alignments with the same name in different directories must not share tables
+    name = os.path.basename(filepath)
+    return os.path.join(cache_dir, f"{name}.{_short_hash(os.path.abspath(filepath))}")
+
+def counts_cache_path(filepath, exclude=None, cache_dir=None):
+    """
+    Cache file of a count table, keyed on the alignment's size/mtime and the exclude set.
+
+    The name is <prefix>.counts_<stamp>_<exclude hash>.npy, so tables of an
+    older version of the alignment can be recognised by their stamp.
+    """
+    st = os.stat(filepath)
+    stamp = _short_hash(f"{st.st_size}:{st.st_mtime_ns}")
+    key = _short_hash("\n".join(sorted(exclude or ())))
+    return f"{counts_cache_prefix(filepath, cache_dir)}.counts_{stamp}_{key}.npy"
+
+def prune_counts_cache(cache_path, keep=MAX_CACHED_TABLES):
+    """
+    Remove an alignment's out-of-date cached tables.
+
+    Tables from another version of the alignment (different stamp) are
+    removed, and of the current version only the `keep` newest are kept.
+    Files that cannot be removed are left alone.
+    """
+    prefix, name = cache_path.rsplit(".counts_", 1)
+    stamp = name.split("_", 1)[0]
+    current = []
+    for path in glob.glob(f"{glob.escape(prefix)}.counts_*.npy"):
+        if path.rsplit(".counts_", 1)[1].split("_", 1)[0] == stamp:
+            current.append(path)
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    current.sort(key=lambda path: (path == cache_path, os.path.getmtime(path)), reverse=True)
+    for path in current[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def save_counts_cache(cache_path, counts):
+    """
+    Write a count table atomically (temporary file, then os.replace) and prune old tables.
+
+    Returns:
+        bool: Whether the table was cached; on a read-only or full directory
+            a warning is printed and nothing is left behind
+    """
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            np.save(f, counts)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Warning: could not cache counts at {cache_path}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+    prune_counts_cache(cache_path)
+    return True
+
+def alignment_counts(filepath, exclude=None, cache=True, cache_dir=None):
+    """
+    Column count table of an alignment with excluded records removed, cached on disk.
+
+    An unreadable cache file is ignored and rewritten; when the cache cannot
+    be written the table is still returned.
+
+    Args:
+        filepath (str): Aligned FASTA file
+        exclude (set): Record IDs or accessions to drop, e.g. outliers
+        cache (bool): Read and write the cached table
+        cache_dir (str): Directory for the cache (default: COUNTS_CACHE_DIR,
+            or next to the alignment)
+
+    Returns:
+        numpy.ndarray: (L, N_SYMBOLS) int32 counts
+    """
+    cache_path = counts_cache_path(filepath, exclude, cache_dir or COUNTS_CACHE_DIR)
+    if cache and os.path.exists(cache_path):
+        try:
+            return np.load(cache_path)
+        except (OSError, ValueError, EOFError) as e:
+            print(f"Warning: ignoring unreadable count cache {cache_path}: {e}")
+    counts = streamed_group_counts(filepath, lambda ids: np.zeros(len(ids), dtype=np.intp), 1, exclude)[0].astype(np.int32)
+    if cache:
+        save_counts_cache(cache_path, counts)
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-column conservation scores of aligned FASTA files")
+    parser.add_argument("alignments", nargs="+", help="Aligned FASTA files")
+    parser.add_argument("--exclude", default=None, help="File with record IDs/accessions to leave out, one per line")
+    parser.add_argument("-o", "--output-dir", default=None,
+                        help="Write <alignment>_conservation.tsv and <alignment>_consensus.fasta here")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directory for cached count tables (default: next to each alignment)")
+    parser.add_argument("-k", "--top-k", type=int, default=3, help="Most common residues reported per column")
+    args = parser.parse_args()
+
+    exclude = None
+    if args.exclude:
+        with open(args.exclude) as f:
+            exclude = {line.strip() for line in f if line.strip()}
+
+    for filepath in args.alignments:
+        counts = alignment_counts(filepath, exclude, cache_dir=args.cache_dir)
+        scores = column_scores(counts, args.top_k)
+        print(f"{filepath}: {len(scores)} columns, mean max frequency {scores['max_frequency'].mean():.3f}")
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+            name = os.path.splitext(os.path.basename(filepath))[0]
+            scores.to_csv(os.path.join(args.output_dir, f"{name}_conservation.tsv"), sep="\t", float_format="%.4f")
+            with open(os.path.join(args.output_dir, f"{name}_consensus.fasta"), "w") as f:
+                f.write(f">{name}_consensus\n{consensus_sequence(counts)}\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,156 @@
 import os
 import glob
 import numpy as np
-from Bio import AlignIO
 import seaborn as sns
+import pandas as pd
 import matplotlib.pyplot as plt
-from collections import Counter
-from tqdm import tqdm
-from numba import jit
+from conservation import (alignment_counts, max_frequency, gap_fraction, consensus_sequence,
+                          streamed_group_counts, accession_of)
 
+def calculate_conservation(alignment_file, outliers=None):
+    """
+    Conservation score for each position in an alignment, excluding outliers.
 
-@jit(nopython=True)
-def calculate_column_conservation(column) -> float:
-    """Calculate conservation score for a single column using Numba"""
-    counts = np.zeros(26, dtype=np.int32)  # 26 for A-Z plus 1 for gap
-    total = 0
-    
-    # Count occurrences of each amino acid and gaps
-    for aa in column:
-        if 65 <= aa <= 90:  # ASCII values for A-Z
-            counts[aa - 65] += 1
-    total = len(column)
-
-    
-    # Return frequency of most common character (including gaps)
-    return float(np.max(counts)) / total if total > 0 else 0.0
-
-@jit(nopython=True)
-def calculate_all_conservation_scores(alignment_array):
-    """Calculate conservation scores for all positions using Numba"""
-    num_positions = alignment_array.shape[1]
-    conservation_scores = np.zeros(num_positions)
-    
-    for i in range(num_positions):
-        conservation_scores[i] = calculate_column_conservation(alignment_array[:, i])
-    
-    return conservation_scores
+    The score is the frequency of the most common residue with gaps counted
+    in the denominator, read from the alignment's cached count table.
+    """
+    counts = alignment_counts(alignment_file, outliers)
 
-def calculate_conservation(alignment, outliers):
-    """Calculate conservation scores for each position in alignment, excluding outliers"""
-    
-    # Filter out outlier sequences
-    filtered_alignment = [record for record in alignment if record.id not in outliers]
-    
     # If all sequences are outliers, return an empty list
-    if not filtered_alignment:
+    if len(counts) == 0 or counts[0].sum() == 0:
         print("Warning: All sequences in alignment are outliers. Returning empty conservation scores.")
         return []
-    
-    # Convert alignment to numpy array of ASCII values
-    alignment_array = np.array([[ord(aa) for aa in str(record.seq)] 
-                              for record in filtered_alignment], dtype=np.int32)
-    
-    # Calculate conservation using numba-optimized function
-    return calculate_all_conservation_scores(alignment_array).tolist()
+
+    return max_frequency(counts, count_gaps=True).tolist()
+
+def window_means(scores, window):
+    """
+    Mean score of every full window of consecutive positions, via a cumulative sum.
+
+    Args:
+        scores (numpy.ndarray): Per-position scores
+        window (int): Window length
+
+    Returns:
+        numpy.ndarray: len(scores) - window + 1 means; entry i covers scores[i:i + window]
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    if window > len(scores):
+        return np.empty(0)
+    cumulative = np.concatenate(([0.0], np.cumsum(scores)))
+    return (cumulative[window:] - cumulative[:-window]) / window
+
+def call_regions(scores, window=10, threshold=0.8, min_length=None):
+    """
+    Contiguous segments covered by windows whose mean score reaches a threshold.
+
+    Every passing window covers [i, i + window); overlapping or touching
+    windows are merged into one segment, also when failing windows lie
+    between their starts.
+
+    Args:
+        scores (numpy.ndarray): Per-position scores
+        window (int): Window length
+        threshold (float): Minimum window mean
+        min_length (int): Shortest segment reported (default: window)
+
+    Returns:
+        numpy.ndarray: (n_regions, 2) 0-based [start, stop) bounds
+
+    Example:
+        >>> call_regions([1, 0, 1, 1, 0, 1, 0, 0, 0, 0], window=4, threshold=0.75).tolist()
+        [[0, 6]]
+    """
+    starts = np.flatnonzero(window_means(scores, window) >= threshold)
+    stops = starts + window
+    if len(starts) == 0:
+        return np.empty((0, 2), dtype=np.intp)
+    # A window opens a new segment when it starts after every earlier window has ended
+    opens = np.ones(len(starts), dtype=bool)
+    opens[1:] = starts[1:] > np.maximum.accumulate(stops)[:-1]
+    first = np.flatnonzero(opens)
+    bounds = np.column_stack((starts[first], np.maximum.reduceat(stops, first)))
+    return bounds[bounds[:, 1] - bounds[:, 0] >= (min_length or window)]
+
+def detect_regions(counts, window=10, threshold=0.8, max_gap=0.5, min_length=None):
+    """
+    Conserved regions of one count table (one gene, or one phylum subset of it).
+
+    Columns with more than max_gap gaps, such as insertions carried by a few
+    sequences in untrimmed alignments, are left out before windowing so they
+    neither dilute nor split a motif. Scores are the frequency of the most
+    common residue among all sequences, as in the heatmaps.
+
+    Args:
+        counts (numpy.ndarray): (L, N_SYMBOLS) column count table
+        window (int): Window length, in retained columns
+        threshold (float): Minimum window mean score
+        max_gap (float): Largest gap fraction of a retained column
+        min_length (int): Shortest region reported, in retained columns (default: window)
+
+    Returns:
+        pandas.DataFrame: One row per region with 1-based inclusive alignment
+            start/end columns, retained column count, mean/min score and consensus
+    """
+    columns = np.flatnonzero(gap_fraction(counts) <= max_gap)
+    scores = max_frequency(counts[columns], count_gaps=True)
+    rows = []
+    for start, stop in call_regions(scores, window, threshold, min_length):
+        kept = columns[start:stop]
+        rows.append({
+            'start': kept[0] + 1,
+            'end': kept[-1] + 1,
+            'n_columns': stop - start,
+            'mean_score': scores[start:stop].mean(),
+            'min_score': scores[start:stop].min(),
+            'consensus': consensus_sequence(counts[kept]),
+        })
+    return pd.DataFrame(rows, columns=['start', 'end', 'n_columns', 'mean_score', 'min_score', 'consensus'])
+
+def gene_regions(alignment_file, accession_to_phylum=None, outliers=None, min_sequences=10, **region_kwargs):
+    """
+    Conserved regions of one alignment, for all sequences and for every phylum subset.
+
+    The alignment is streamed once into per-phylum count tables, so no
+    per-record objects or full code matrix are held; the "All" table is
+    their sum.
+
+    Args:
+        alignment_file (str): Aligned FASTA file (trimmed or untrimmed)
+        accession_to_phylum (dict): Accession -> phylum; None reports "All" only
+        outliers (set): Record IDs or accessions to leave out
+        min_sequences (int): Smallest phylum subset reported
+        **region_kwargs: Passed to detect_regions
+
+    Returns:
+        pandas.DataFrame: detect_regions rows with 'subset' and 'n_sequences' columns
+    """
+    accession_to_phylum = accession_to_phylum or {}
+    phyla = sorted(set(accession_to_phylum.values())) + ["Unknown"]
+    phylum_index = {phylum: i for i, phylum in enumerate(phyla)}
+
+    def groups_of(ids):
+        return [phylum_index[accession_to_phylum.get(accession_of(rid), "Unknown")] for rid in ids]
+
+    counts = streamed_group_counts(alignment_file, groups_of, len(phyla), outliers)
+    # Every sequence contributes exactly one symbol per column
+    subsets = [("All", counts.sum(axis=0))]
+    if accession_to_phylum:
+        subsets += [(phylum, counts[i]) for i, phylum in enumerate(phyla)]
+
+    results = []
+    for subset, subset_counts in subsets:
+        n_sequences = int(subset_counts[0].sum()) if len(subset_counts) else 0
+        if n_sequences == 0 or (subset != "All" and n_sequences < min_sequences):
+            continue
+        regions = detect_regions(subset_counts, **region_kwargs)
+        regions.insert(0, 'n_sequences', n_sequences)
+        regions.insert(0, 'subset', subset)
+        results.append(regions)
+    if not results:
+        return pd.DataFrame(columns=['subset', 'n_sequences', 'start', 'end', 'n_columns',
+                                     'mean_score', 'min_score', 'consensus'])
+    return pd.concat(results, ignore_index=True)
 
 def plot_conservation_heatmaps(all_scores, all_filenames, output_dir):
     """Create a figure with multiple heatmaps of conservation scores"""
@@ -145,9 +243,7 @@ def main():
         if gene in file_dict:
             file_path = file_dict[gene]
             try:
-                alignment = AlignIO.read(file_path, 'fasta')
-                
-                conservation_scores = calculate_conservation(alignment, outliers)
+                conservation_scores = calculate_conservation(file_path, outliers)
                 
                 # Only append if conservation scores are not empty
                 if conservation_scores:
@@ -164,5 +260,33 @@ def main():
     # Create and save combined heatmap
     plot_conservation_heatmaps(all_scores, all_filenames, output_dir)
 
+    # Detect conserved regions per gene and phylum on the untrimmed alignments
+    find_regions = True
+    if find_regions:
+        taxa_file = '/zhome/85/8/203063/a3_fungi/data_out/taxa_clean_0424.csv'
+        taxa = pd.read_csv(taxa_file)
+        accession_to_phylum = dict(zip(taxa['Accession'], taxa['Phylum']))
+        untrimmed_files = glob.glob('/work3/s233201/enzyme_out_6/alignments/*aln')
+        untrimmed_dict = {os.path.basename(f).split('.')[0]: f for f in untrimmed_files}
+
+        all_regions = []
+        for gene in gene_order:
+            if gene not in untrimmed_dict:
+                print(f"Warning: {gene} not found in untrimmed alignment files")
+                continue
+            try:
+                regions = gene_regions(untrimmed_dict[gene], accession_to_phylum, outliers,
+                                       window=10, threshold=0.8, max_gap=0.5)
+                regions.insert(0, 'gene', gene)
+                all_regions.append(regions)
+                print(f"{gene}: {(regions['subset'] == 'All').sum()} conserved regions across all sequences")
+            except Exception as e:
+                print(f"Error detecting regions for {gene}: {str(e)}")
+
+        if all_regions:
+            regions_path = os.path.join(output_dir, 'conserved_regions.csv')
+            pd.concat(all_regions, ignore_index=True).to_csv(regions_path, index=False, float_format='%.4f')
+            print(f"Saved conserved regions to {regions_path}")
+
 if __name__ == "__main__":
     main()
@@ -1,73 +1,137 @@
 import os
 import glob
-import numpy as np
-from Bio import AlignIO, SeqIO
-from collections import defaultdict
-import re
 import json
+import numpy as np
 import shutil
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 
-# Define accession ID and species name as global variables
+# Organism whose 3Dmol JSON files are copied to the Mol* conservation directory
 ACCESSION = "GCF_000002855.4"
 SPECIES_NAME = "A. niger"
 
-# Mapping of accessions to species names (for reference)
-# "GCF_000146045.2": "S. cerevisiae"
-# "GCF_000002855.4": "A. niger"
-# "GCF_000002655.1": "A. fumigatus"
-# "GCF_000182895.1": "C. cinerea"
-# "GCF_000149305.1": "R. delemar"
-# "GCF_028827035.1": "P. chrysogenum"
+# Reference organisms exported in batch mode
+ORGANISMS = {
+    "GCF_000146045.2": "S. cerevisiae",
+    "GCF_000002855.4": "A. niger",
+    "GCF_000002655.1": "A. fumigatus",
+    "GCF_000182895.1": "C. cinerea",
+    "GCF_000149305.1": "R. delemar",
+    "GCF_028827035.1": "P. chrysogenum",
+}
 
-# Import conservation calculation functions from existing script
-from conserved_regions import calculate_conservation
+# Import conservation calculation functions from the shared module
+from conservation import alignment_counts, alignment_rows, max_frequency, residue_numbers
+
+def extract_conservation_scores(alignment_file, accessions):
+    """
+    Residue-level conservation scores of several accessions, read from one cached count table.
 
-def extract_conservation_scores_for_accession(alignment, accession=ACCESSION):
+    Scores (frequency of the most common residue, gaps counted) come from
+    the alignment's cached count table, and only the accessions' own rows
+    are read; their alignment columns are mapped to ungapped residue
+    numbers with a cumulative sum over each row.
+
+    Args:
+        alignment_file (str): Path to the aligned FASTA file
+        accessions (iterable): Accession IDs to extract scores for
+
+    Returns:
+        dict: Accession -> {residue position (1-based): score}; accessions
+            missing from the alignment are left out
+    """
+    scores = max_frequency(alignment_counts(alignment_file), count_gaps=True)
+    rows = alignment_rows(alignment_file, accessions)
+    if not rows:
+        return {}
+
+    order = list(rows)
+    numbers = residue_numbers(np.stack([rows[acc] for acc in order]))
+    scores_maps = {}
+    for acc, row_numbers in zip(order, numbers):
+        residues = row_numbers > 0
+        scores_maps[acc] = dict(zip(row_numbers[residues].tolist(), scores[residues].tolist()))
+    return scores_maps
+
+def extract_conservation_scores_for_accession(alignment_file, accession=ACCESSION):
     """
     Extract conservation scores for a specific accession, excluding gaps
     
     Parameters:
-    alignment -- BioPython multiple sequence alignment
+    alignment_file -- Path to the aligned FASTA file
     accession -- Accession ID to extract conservation scores for
     
     Returns:
     Dictionary mapping amino acid positions (1-based) to conservation scores
     """
-    # Calculate conservation scores for the entire alignment
-    conservation_scores = calculate_conservation(alignment)
-    
-    # Find the sequence with the specified accession
-    target_seq = None
-    target_idx = -1
-    
-    for i, record in enumerate(alignment):
-        if accession in record.id:
-            target_seq = str(record.seq)
-            target_idx = i
-            break
-    
-    if target_seq is None:
+    scores_maps = extract_conservation_scores(alignment_file, [accession])
+    if accession not in scores_maps:
         raise ValueError(f"Accession {accession} not found in alignment")
-    
-    # Map alignment positions to sequence positions (excluding gaps)
-    position_map = {}  # Maps non-gap positions in target_seq to their alignment positions
-    seq_pos = 0
-    
-    for aln_pos, aa in enumerate(target_seq):
-        if aa != "-":  # Skip gaps
-            seq_pos += 1
-            position_map[seq_pos] = conservation_scores[aln_pos]
-    
-    return position_map
+    return scores_maps[accession]
+
+def read_sequences(input_file, accessions):
+    """
+    First sequence of each accession in a FASTA file, stopping once all are found.
+
+    Returns:
+        dict: Accession -> sequence string
+    """
+    sequences = {}
+    with open(input_file) as handle:
+        for title, seq in SimpleFastaParser(handle):
+            record_id = title.split(None, 1)[0] if title else ""
+            for acc in accessions:
+                if acc not in sequences and acc in record_id:
+                    sequences[acc] = seq
+            if len(sequences) == len(accessions):
+                break
+    return sequences
+
+def write_score_files(scores_map, gene, accession, output_dir):
+    """
+    Write one gene's residue scores as text, Chimera .defattr and 3Dmol.js JSON files.
+
+    Returns:
+        tuple: (text file, Chimera attribute file, 3Dmol.js JSON file)
+    """
+    positions = sorted(scores_map)
+
+    # Save to text file (original format)
+    output_file = os.path.join(output_dir, f"{gene}_conservation_scores.txt")
+    with open(output_file, 'w') as f:
+        f.write(f"# Conservation scores for {gene}, accession {accession}\n")
+        f.write("# Position\tConservation_Score\n")
+        f.writelines(f"{pos}\t{scores_map[pos]:.4f}\n" for pos in positions)
+
+    # Create Chimera attribute file (.defattr format)
+    chimera_file = os.path.join(output_dir, f"{gene}_conservation.defattr")
+    with open(chimera_file, 'w') as f:
+        # Header for attribute definition
+        f.write(f"# Chimera attribute definition for {gene} conservation scores\n")
+        f.write("attribute: conservation\n")
+        f.write("match mode: 1-to-1\n")
+        f.write("recipient: residues\n")
+        f.writelines(f"\t:{pos}\t{scores_map[pos]:.4f}\n" for pos in positions)
+
+    # Format for 3Dmol.js - mapping of residue numbers to conservation scores
+    threejs_file = os.path.join(output_dir, f"{gene}_conservation_3dmol.json")
+    with open(threejs_file, 'w') as f:
+        json.dump({str(pos): float(scores_map[pos]) for pos in positions}, f, indent=2)
+
+    return output_file, chimera_file, threejs_file
 
 def main():
+    # Export every organism in ORGANISMS in one pass, or only ACCESSION
+    batch = True
+    organisms = ORGANISMS if batch else {ACCESSION: SPECIES_NAME}
+
     # Create base output directory
     base_output_dir = '/zhome/85/8/203063/a3_fungi/conservation_scores'
     os.makedirs(base_output_dir, exist_ok=True)
     
-    # Create organism-specific output directory
-    output_dir = os.path.join(base_output_dir, SPECIES_NAME)
-    os.makedirs(output_dir, exist_ok=True)
+    # Create organism-specific output directories
+    output_dirs = {acc: os.path.join(base_output_dir, name) for acc, name in organisms.items()}
+    for output_dir in output_dirs.values():
+        os.makedirs(output_dir, exist_ok=True)
     
     # Directory for Mol* conservation JSON files (keep this at root level)
     molstar_conservation_dir = '/zhome/85/8/203063/a3_fungi/html_molstar_only/conservation_data'
@@ -80,23 +144,25 @@ def main():
     all_files = glob.glob('/work3/s233201/enzyme_out_6/alignments/*aln')
     file_dict = {os.path.basename(f).split('.')[0]: f for f in all_files}
     
-    # Create a FASTA file for the target sequences
-    fasta_output = os.path.join(output_dir, f'{ACCESSION}_{SPECIES_NAME}_sequences.fasta')
-    with open(fasta_output, 'w') as fasta_file:
-        for gene in gene_order:
-            input_file = f'/zhome/85/8/203063/a3_fungi/inputs_new/{gene.upper()}.fasta'
-            try:
-                for record in SeqIO.parse(input_file, 'fasta'):
-                    if ACCESSION in record.id:
-                        # Get sequence and write to file
-                        seq = str(record.seq)
-                        fasta_file.write(f">{gene}\n{seq}\n")
-                        break
-            except Exception as e:
-                print(f"Warning: Could not process {gene}: {str(e)}")
-                continue
+    # Collect the target sequences with one scan of each input FASTA
+    gene_sequences = {}
+    for gene in gene_order:
+        input_file = f'/zhome/85/8/203063/a3_fungi/inputs_new/{gene.upper()}.fasta'
+        try:
+            gene_sequences[gene] = read_sequences(input_file, list(organisms))
+        except Exception as e:
+            print(f"Warning: Could not process {gene}: {str(e)}")
+
+    # Create a FASTA file of the target sequences for each organism
+    for acc, name in organisms.items():
+        fasta_output = os.path.join(output_dirs[acc], f'{acc}_{name}_sequences.fasta')
+        with open(fasta_output, 'w') as fasta_file:
+            for gene in gene_order:
+                seq = gene_sequences.get(gene, {}).get(acc)
+                if seq is not None:
+                    fasta_file.write(f">{gene}\n{seq}\n")
     
-    # Process each gene for conservation scores
+    # Process each gene for conservation scores, all organisms at once
     for gene in gene_order:
         if gene not in file_dict:
             print(f"Warning: {gene} not found in alignment files")
@@ -104,50 +170,23 @@ def main():
             
         try:
             print(f"Processing {gene}...")
-            alignment = AlignIO.read(file_dict[gene], 'fasta')
-            
-            # Extract conservation scores for the target accession
-            scores_map = extract_conservation_scores_for_accession(alignment)
-            
-            # Save to text file (original format)
-            output_file = os.path.join(output_dir, f"{gene}_conservation_scores.txt")
-            with open(output_file, 'w') as f:
-                f.write(f"# Conservation scores for {gene}, accession GCF_000146045.2\n")
-                f.write("# Position\tConservation_Score\n")
-                
-                for pos in sorted(scores_map.keys()):
-                    f.write(f"{pos}\t{scores_map[pos]:.4f}\n")
-            
-            # Create Chimera attribute file (.defattr format)
-            chimera_file = os.path.join(output_dir, f"{gene}_conservation.defattr")
-            with open(chimera_file, 'w') as f:
-                # Header for attribute definition
-                f.write(f"# Chimera attribute definition for {gene} conservation scores\n")
-                f.write("attribute: conservation\n")
-                f.write("match mode: 1-to-1\n")
-                f.write("recipient: residues\n")
-                
-                # Write each residue's conservation score
-                for pos in sorted(scores_map.keys()):
-                    f.write(f"\t:{pos}\t{scores_map[pos]:.4f}\n")
-            
-            # Create 3Dmol.js compatible JSON file
-            threejs_file = os.path.join(output_dir, f"{gene}_conservation_3dmol.json")
-            
-            # Format for 3Dmol.js - mapping of residue numbers to conservation scores
-            threejs_data = {str(pos): float(scores_map[pos]) for pos in sorted(scores_map.keys())}
-            
-            with open(threejs_file, 'w') as f:
-                json.dump(threejs_data, f, indent=2)
-            # Copy JSON file to Mol* conservation directory
-            shutil.copy(threejs_file, os.path.join(molstar_conservation_dir, f"{gene}_conservation_3dmol.json"))
-            
-            print(f"Saved conservation scores for {gene} to {output_file}")
-            print(f"Saved Chimera attribute file to {chimera_file}")
-            print(f"Saved 3Dmol.js compatible file to {threejs_file}")
-            
+            scores_maps = extract_conservation_scores(file_dict[gene], organisms)
         except Exception as e:
             print(f"Error processing {gene}: {str(e)}")
+            continue
+
+        for acc, name in organisms.items():
+            if acc not in scores_maps:
+                print(f"Warning: {acc} ({name}) not found in {gene} alignment")
+                continue
+            try:
+                output_file, chimera_file, threejs_file = write_score_files(scores_maps[acc], gene, acc, output_dirs[acc])
+                # Copy JSON file to Mol* conservation directory
+                if acc == ACCESSION:
+                    shutil.copy(threejs_file, os.path.join(molstar_conservation_dir, f"{gene}_conservation_3dmol.json"))
+                print(f"Saved {name} conservation scores for {gene} to {output_file}, {chimera_file} and {threejs_file}")
+            except Exception as e:
+                print(f"Error writing {gene} scores for {name}: {str(e)}")
 
 if __name__ == "__main__":
     main()
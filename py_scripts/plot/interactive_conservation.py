@@ -2,11 +2,11 @@ import os
 import glob
 import numpy as np
 import pandas as pd
-from Bio import AlignIO, SeqIO
-from collections import defaultdict
+from Bio import SeqIO
 import matplotlib.pyplot as plt
 from tqdm import tqdm
-from numba import jit
+from conservation import (alignment_counts, max_frequency, streamed_group_counts,
+                          column_scores, accession_of, N_LETTERS)
 
 # Keep only needed Bokeh imports
 from bokeh.plotting import figure, save, output_file
@@ -20,61 +20,22 @@ from bokeh.palettes import RdBu11
 from bokeh.models import Tabs
 from bokeh.models.layouts import TabPanel
 
-@jit(nopython=True)
-def calculate_column_conservation(column) -> float:
-    """Calculate conservation score for a single column using Numba"""
-    counts = np.zeros(26, dtype=np.int32)  # 26 for A-Z
-    total = 0
-    
-    # Count occurrences of each amino acid (excluding gaps)
-    for aa in column:
-        if 65 <= aa <= 90:  # ASCII values for A-Z
-            counts[aa - 65] += 1
-            total += 1
-    
-    # Return frequency of most common character
-    return float(np.max(counts)) / total if total > 0 else 0.0
+def calculate_conservation(alignment_file, outliers):
+    """
+    Conservation score for each position in an alignment, excluding outliers.
 
-@jit(nopython=True)
-def calculate_all_conservation_scores(alignment_array):
-    """Calculate conservation scores for all positions using Numba"""
-    num_positions = alignment_array.shape[1]
-    conservation_scores = np.zeros(num_positions)
-    
-    for i in range(num_positions):
-        conservation_scores[i] = calculate_column_conservation(alignment_array[:, i])
-    
-    return conservation_scores
+    The score is the frequency of the most common residue among the
+    residues present (gaps excluded), read from the alignment's cached
+    count table.
+    """
+    counts = alignment_counts(alignment_file, outliers)
 
-def calculate_conservation(alignment, outliers):
-    """Calculate conservation scores for each position in alignment, excluding outliers"""
-    
-    # Filter out outlier sequences - check both full ID and accession part
-    filtered_alignment = []
-    removed_count = 0
-    
-    for record in alignment:
-        # Extract accession (part before | if present)
-        accession = record.id.split('|')[0] if '|' in record.id else record.id
-        # Keep sequence if neither full ID nor accession is in outliers
-        if record.id not in outliers and accession not in outliers:
-            filtered_alignment.append(record)
-        else:
-            removed_count += 1
-    
-    print(f"Removed {removed_count} outlier sequences out of {len(alignment)} total sequences")
-    
     # If all sequences are outliers, return an empty list
-    if not filtered_alignment:
+    if len(counts) == 0 or counts[0].sum() == 0:
         print("Warning: All sequences in alignment are outliers. Returning empty conservation scores.")
         return []
-    
-    # Convert alignment to numpy array of ASCII values
-    alignment_array = np.array([[ord(aa) for aa in str(record.seq)] 
-                              for record in filtered_alignment], dtype=np.int32)
-    
-    # Calculate conservation using numba-optimized function
-    return calculate_all_conservation_scores(alignment_array).tolist()
+
+    return max_frequency(counts, count_gaps=False).tolist()
 
 def load_phylum_data(taxa_file):
     """Load the phylum information for sequences"""
@@ -82,16 +43,53 @@ def load_phylum_data(taxa_file):
     # Create a mapping from accession to phylum
     return dict(zip(phylum_data['Accession'], phylum_data['Phylum']))
 
-def get_most_common_aa(alignment, position):
-    """Get most common amino acid at a given position"""
-    aa_counts = {}
-    for record in alignment:
-        aa = record.seq[position]
-        if aa != '-':  # Skip gaps
-            aa_counts[aa] = aa_counts.get(aa, 0) + 1
-    return max(aa_counts.items(), key=lambda x: x[1])[0] if aa_counts else '-'
+def phylum_count_tables(alignment_file, accession_to_phylum, outliers=None):
+    """
+    Symbol counts per phylum and column, streamed from the alignment without loading it.
+
+    Args:
+        alignment_file (str): Aligned FASTA file
+        accession_to_phylum (dict): Accession -> phylum (others count as "Unknown")
+        outliers (set): Record IDs or accessions to leave out
+
+    Returns:
+        tuple: (phyla present, in checkbox order; (len(phyla), L, N_SYMBOLS) counts)
+    """
+    # Missing phyla (NaN in the taxa table) count as "Unknown"
+    phyla = sorted({phylum for phylum in accession_to_phylum.values() if isinstance(phylum, str)} | {"Unknown"})
+    phylum_index = {phylum: i for i, phylum in enumerate(phyla)}
+    unknown = phylum_index["Unknown"]
+
+    def groups_of(ids):
+        return [phylum_index.get(accession_to_phylum.get(accession_of(rid)), unknown) for rid in ids]
+
+    counts = streamed_group_counts(alignment_file, groups_of, len(phyla), outliers)
+    # Every sequence has one symbol per column, so column 0 counts the sequences
+    present = counts[:, 0].sum(axis=1) > 0 if counts.shape[1] else np.zeros(len(phyla), dtype=bool)
+    return [phylum for phylum, keep in zip(phyla, present) if keep], counts[present]
+
+def pack_phylum_counts(counts):
+    """
+    Residue counts of phylum_count_tables packed for the browser.
 
-def create_interactive_plot(gene_alignments, gene_scores, accession_to_phylum, output_dir):
+    Returns:
+        tuple: (flat uint16/uint32 array indexed [phylum, position, letter],
+            number of letters kept per position)
+    """
+    counts = counts[:, :, :N_LETTERS]
+    # Letters that never occur in the alignment are left out of the page
+    letters = np.flatnonzero(counts.any(axis=(0, 1)))
+    dtype = np.uint16 if counts.max(initial=0) <= np.iinfo(np.uint16).max else np.uint32
+    return np.ascontiguousarray(counts[:, :, letters], dtype=dtype).ravel(), len(letters)
+
+def top_residue_labels(stats, top_k=3):
+    """Hover text such as 'L 0.62, I 0.21, V 0.08' from the top-k columns of column_scores."""
+    letters = stats[[f'top{k + 1}' for k in range(top_k)]].to_numpy()
+    frequencies = stats[[f'top{k + 1}_frequency' for k in range(top_k)]].to_numpy()
+    return [', '.join(f"{aa} {freq:.2f}" for aa, freq in zip(row_aas, row_freqs) if aa != '-') or '-'
+            for row_aas, row_freqs in zip(letters, frequencies)]
+
+def create_interactive_plot(gene_alignments, gene_scores, output_dir):
     """Create an interactive conservation plot with phylum filtering"""
     
     print(f"Creating interactive plot with {len(gene_alignments)} genes...")
@@ -99,34 +97,19 @@ def create_interactive_plot(gene_alignments, gene_scores, accession_to_phylum, o
     # Create tabs for each gene
     tabs = []
     
-    for gene_name, alignment in gene_alignments.items():
+    for gene_name, (valid_phyla, counts) in gene_alignments.items():
         print(f"Processing {gene_name} for plot creation...")
         
-        # Get accessions and their phyla for this alignment (these are already filtered alignments)
-        seq_accessions = [record.id.split('|')[0] if '|' in record.id else record.id for record in alignment]
-        seq_phyla = [accession_to_phylum.get(acc, "Unknown") for acc in seq_accessions]
-        
-        print(f"  - {gene_name}: {len(alignment)} sequences, phyla: {set(seq_phyla)}")
+        print(f"  - {gene_name}: {int(counts[:, 0].sum())} sequences, phyla: {set(valid_phyla)}")
         
-        # Group sequences by phylum
-        phylum_indices = defaultdict(list)
-        for idx, phylum in enumerate(seq_phyla):
-            phylum_indices[phylum].append(idx)
+        # Residue counts of every phylum are precomputed; the page only sums the selected ones
+        phylum_counts, n_letters = pack_phylum_counts(counts)
         
-        # Get unique phyla and prepare sequence data for JavaScript
-        valid_phyla = sorted(set(seq_phyla))
-        
-        # Prepare sequence data for JavaScript - store actual sequences grouped by phylum
-        phylum_sequences = {}
-        for phylum in valid_phyla:
-            if phylum in phylum_indices:
-                phylum_seqs = []
-                for idx in phylum_indices[phylum]:
-                    phylum_seqs.append(str(alignment[idx].seq))
-                phylum_sequences[phylum] = phylum_seqs
+        # Consensus, top residues and gap fraction of every column in one pass over the summed counts
+        stats = column_scores(counts.sum(axis=0), top_k=3)
         
         # Prepare data for Bokeh
-        alignment_length = len(alignment[0].seq)
+        alignment_length = counts.shape[1]
         positions = list(range(1, alignment_length + 1))
         
         print(f"  - {gene_name}: alignment length = {alignment_length}")
@@ -167,16 +150,15 @@ def create_interactive_plot(gene_alignments, gene_scores, accession_to_phylum, o
         )
         p.add_layout(color_bar, 'right')
         
-        # Get most common amino acid for each position
-        most_common_aas = [get_most_common_aa(alignment, i) for i in range(alignment_length)]
-        
         # Create a data source for the combined conservation scores
         combined_data = ColumnDataSource(data=dict(
             x=positions,
             y=[1] * alignment_length,
             conservation=gene_scores[gene_name],
             phylum=['All'] * alignment_length,
-            amino_acid=most_common_aas
+            amino_acid=stats['consensus'].tolist(),
+            top_residues=top_residue_labels(stats, top_k=3),
+            gap_fraction=stats['gap_fraction'].tolist()
         ))
         
         # Add hover tool
@@ -185,6 +167,8 @@ def create_interactive_plot(gene_alignments, gene_scores, accession_to_phylum, o
                 ("Position", "@x"),
                 ("Conservation", "@conservation{0.00}"),
                 ("Most Common AA", "@amino_acid"),
+                ("Top Residues", "@top_residues"),
+                ("Gap Fraction", "@gap_fraction{0.00}"),
                 ("Phylum", "@phylum")
             ]
         )
@@ -201,45 +185,19 @@ def create_interactive_plot(gene_alignments, gene_scores, accession_to_phylum, o
         # Create checkbox group for phyla filtering - only include valid phyla
         checkbox = CheckboxGroup(labels=valid_phyla, active=list(range(len(valid_phyla))))
         
-        # Simplified JavaScript callback to avoid potential errors
+        # The callback sums the precomputed counts of the selected phyla, so no
+        # sequences are embedded in the page
         callback = CustomJS(
             args=dict(
                 source=combined_data,
-                phylum_sequences=phylum_sequences,
+                phylum_counts=phylum_counts,
+                n_letters=n_letters,
                 checkbox=checkbox,
                 phyla=valid_phyla,
-                positions=positions,
+                n_positions=alignment_length,
                 original_scores=gene_scores[gene_name]
             ), 
             code="""
-            // Function to calculate conservation score for a position
-            function calculateConservation(sequences, position) {
-                if (!sequences || sequences.length === 0) return 0;
-                
-                const aaCounts = {};
-                let total = 0;
-                
-                for (let seq of sequences) {
-                    if (position < seq.length) {
-                        const aa = seq[position];
-                        if (aa !== '-' && aa !== 'X') {  // Skip gaps and unknown
-                            aaCounts[aa] = (aaCounts[aa] || 0) + 1;
-                            total++;
-                        }
-                    }
-                }
-                
-                if (total === 0) return 0;
-                
-                // Find the most common amino acid
-                let maxCount = 0;
-                for (let count of Object.values(aaCounts)) {
-                    if (count > maxCount) maxCount = count;
-                }
-                
-                return maxCount / total;
-            }
-            
             const active = checkbox.active;
             const selected_phyla = active.map(i => phyla[i]);
             
@@ -247,32 +205,38 @@ def create_interactive_plot(gene_alignments, gene_scores, accession_to_phylum, o
             
             if (selected_phyla.length === 0) {
                 // If no phyla selected, show empty data
-                const empty_data = new Array(positions.length).fill(0);
+                const empty_data = new Array(n_positions).fill(0);
                 source.data['conservation'] = empty_data;
-                source.data['phylum'] = new Array(positions.length).fill('None');
+                source.data['phylum'] = new Array(n_positions).fill('None');
             } else if (selected_phyla.length === phyla.length) {
                 // If ALL phyla are selected, use the original scores
                 source.data['conservation'] = [...original_scores];
-                source.data['phylum'] = new Array(positions.length).fill('All');
+                source.data['phylum'] = new Array(n_positions).fill('All');
             } else {
-                // Combine sequences from selected phyla
-                let combined_sequences = [];
-                for (let phylum of selected_phyla) {
-                    if (phylum in phylum_sequences) {
-                        combined_sequences = combined_sequences.concat(phylum_sequences[phylum]);
+                // Sum the residue counts of the selected phyla
+                const block = n_positions * n_letters;
+                const sums = new Float64Array(block);
+                for (const i of active) {
+                    const offset = i * block;
+                    for (let k = 0; k < block; k++) {
+                        sums[k] += phylum_counts[offset + k];
                     }
                 }
                 
-                console.log('Combined sequences count:', combined_sequences.length);
-                
-                // Calculate conservation scores from scratch for the combined sequences
-                const conservation_scores = [];
-                for (let pos = 0; pos < positions.length; pos++) {
-                    conservation_scores.push(calculateConservation(combined_sequences, pos));
+                // Conservation is the most common residue's share of the residues present
+                const conservation_scores = new Array(n_positions);
+                for (let pos = 0; pos < n_positions; pos++) {
+                    let maxCount = 0;
+                    let total = 0;
+                    for (let k = pos * n_letters; k < (pos + 1) * n_letters; k++) {
+                        total += sums[k];
+                        if (sums[k] > maxCount) maxCount = sums[k];
+                    }
+                    conservation_scores[pos] = total > 0 ? maxCount / total : 0;
                 }
                 
                 source.data['conservation'] = conservation_scores;
-                source.data['phylum'] = new Array(positions.length).fill(selected_phyla.join(', '));
+                source.data['phylum'] = new Array(n_positions).fill(selected_phyla.join(', '));
             }
             
             source.change.emit();
@@ -346,21 +310,16 @@ def main():
     for gene in gene_order:
         if gene in file_dict:
             try:
-                alignment = AlignIO.read(file_dict[gene], 'fasta')
-                print(f"\nProcessing {gene} with {len(alignment)} sequences...")
-                conservation_scores = calculate_conservation(alignment, outliers)
+                print(f"\nProcessing {gene}...")
+                conservation_scores = calculate_conservation(file_dict[gene], outliers)
                 
                 if conservation_scores:
-                    # Filter the alignment to remove outliers for the interactive plot
-                    filtered_alignment = []
-                    for record in alignment:
-                        accession = record.id.split('|')[0] if '|' in record.id else record.id
-                        if record.id not in outliers and accession not in outliers:
-                            filtered_alignment.append(record)
+                    # Outlier-free per-phylum counts for the interactive plot, streamed in one pass
+                    phyla, counts = phylum_count_tables(file_dict[gene], accession_to_phylum, outliers)
                     
-                    gene_alignments[gene] = filtered_alignment
+                    gene_alignments[gene] = (phyla, counts)
                     gene_scores[gene] = conservation_scores
-                    print(f"Successfully processed {gene} with {len(filtered_alignment)} sequences after outlier removal")
+                    print(f"Successfully processed {gene} with {int(counts[:, 0].sum())} sequences after outlier removal")
                 else:
                     print(f"Skipping {gene} due to all sequences being outliers.")
                     continue
@@ -370,7 +329,7 @@ def main():
             print(f"Warning: {gene} not found in alignment files")
     
     # Create interactive plot
-    create_interactive_plot(gene_alignments, gene_scores, accession_to_phylum, output_dir)
+    create_interactive_plot(gene_alignments, gene_scores, output_dir)
     
     print("Interactive conservation plots created successfully.")
 
@@ -9,6 +9,7 @@ from numba import types
 from numba.typed import Dict, List
 import matplotlib.colors as mcolors
 import os
+import sys
 import datashader as ds
 from datashader.colors import colormap_select, Greys9
 from datashader.utils import export_image
@@ -17,6 +18,9 @@ import holoviews as hv
 from holoviews.operation.datashader import datashade, shade
 hv.extension('bokeh')
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dist_matrix import open_distance_matrix, align_matrices, matrix_values
+
 matplotlib.use('Agg')
 
 @nb.njit
@@ -42,76 +46,11 @@ def get_colors_numba(rows, cols, phyla_indices, pair_to_color_idx):
 
 
 def plot_dms(dm1, dm2, dm1_name='dm1', dm2_name='dm2', to_remove=None):
-    # Clean up and standardize accession IDs
-    dm1.iloc[:, 0] = dm1.iloc[:, 0].str[:15]
-    dm2.iloc[:, 0] = dm2.iloc[:, 0].str[:15]
-    
-    dm1_order = dm1.iloc[:, 0].tolist()
-    dm2_order = dm2.iloc[:, 0].tolist()
-    
-    # Find common entries between dm1 and dm2
-    common_entries = list(set(dm1_order) & set(dm2_order))
-    missing_entries = set(dm1_order) - set(dm2_order)
-    if missing_entries:
-        print(f"Warning: Following entries are missing from {dm2_name}:")
-        print(missing_entries)
-        print("Removing these entries from both matrices...")
-    
-    # Filter rows and corresponding columns for both matrices
-    keep_indices_dm1 = [i for i, acc in enumerate(dm1_order) if acc in common_entries]
-    keep_indices_dm2 = [i for i, acc in enumerate(dm2_order) if acc in common_entries]
-    
-    # Filter rows
-    dm1 = dm1.iloc[keep_indices_dm1].reset_index(drop=True)
-    dm2 = dm2.iloc[keep_indices_dm2].reset_index(drop=True)
-    
-    # Filter columns (excluding first column which contains accessions)
-    col_indices_dm1 = [0] + [i + 1 for i in keep_indices_dm1]
-    col_indices_dm2 = [0] + [i + 1 for i in keep_indices_dm2]
-    
-    dm1 = dm1.iloc[:, col_indices_dm1]
-    dm2 = dm2.iloc[:, col_indices_dm2]
-    
-    # Update orders after filtering
-    dm1_order = dm1.iloc[:, 0].tolist()
-    dm2_order = dm2.iloc[:, 0].tolist()
-    
-    # Create mapping for reordering dm2
-    order_mapping = [dm2_order.index(x) for x in dm1_order]
-    
-    # Reorder dm2 to match dm1's order
-    dm2 = dm2.iloc[order_mapping]
-    dm2_cols = dm2.columns.tolist()
-    dm2 = dm2[[dm2_cols[0]] + [dm2_cols[i+1] for i in order_mapping]]
-
-    # Remove specified accessions if to_remove is provided
-    if to_remove is not None:
-        # Clean up the accessions to remove (remove newlines and whitespace)
-        to_remove = [acc.strip() for acc in to_remove]
-        
-        # Create mask for rows to keep
-        keep_mask = ~dm1.iloc[:, 0].isin(to_remove)
-        
-        # Get integer indices from boolean mask
-        keep_indices = np.where(keep_mask)[0]
-        
-        # Filter both matrices
-        dm1 = dm1.iloc[keep_indices].reset_index(drop=True)
-        dm2 = dm2.iloc[keep_indices].reset_index(drop=True)
-        
-        # Filter columns (excluding first column which contains accessions)
-        col_indices = [0] + [i + 1 for i in keep_indices]  # +1 because first column is accessions
-        dm1 = dm1.iloc[:, col_indices]
-        dm2 = dm2.iloc[:, col_indices]
-
-    # Continue with numerical part extraction
-    accessions = dm1.iloc[:, 0].tolist()  # Save accessions before removing the column
-    dm1 = dm1.iloc[:, 1:]
-    dm2 = dm2.iloc[:, 1:]
-
-    # Convert to numpy arrays
-    dm1_array = dm1.to_numpy()
-    dm2_array = dm2.to_numpy()
+    # Align both matrices on their common 15-character accessions, dropping to_remove
+    accessions, (idx1, idx2) = align_matrices([dm1, dm2], names=[dm1_name, dm2_name], exclude=to_remove)
+    accessions = accessions.tolist()
+    dm1_array = matrix_values(dm1, idx1)
+    dm2_array = matrix_values(dm2, idx2)
     
     # Load taxa information to get phyla
     taxa_df = pd.read_csv('/zhome/85/8/203063/a3_fungi/data_out/taxa_no_missing_after_interpro.csv')
@@ -327,10 +266,10 @@ if __name__ == '__main__':
     dm2_path = '/zhome/85/8/203063/a3_fungi/full_dist_mats/phyl_busco_4_correct.csv'
     dm2_name = 'BUSCO Phylogenetic'
     
-    dm1 = pd.read_csv(dm1_path, sep=r'\s+', header=None, skiprows=1)
-    dm2 = pd.read_csv(dm2_path, sep=r'\s+', header=None, skiprows=1)
+    dm1 = open_distance_matrix(dm1_path)
+    dm2 = open_distance_matrix(dm2_path)
 
     print(dm1.shape)
-    print(dmdshape)
+    print(dm2.shape)
 
     plot_dms(dm1, dm2, dm1_name, dm2_name, to_remove=to_remove)
\ No newline at end of file
@@ -1,5 +1,8 @@
-from ete3 import Tree
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
+from taxa_io import read_taxa_file
+from tree_arrays import FlatTree, prune_leaves, write_newick
 
 # Define the base directory
 base_dir = "/work3/s233201/output_phyl_busco_4"
@@ -9,22 +12,75 @@ tree_file = os.path.join(base_dir, "tree_iq_LGI_refactored.treefile")
 outlier_file = "/zhome/85/8/203063/a3_fungi/data/outliers_set.txt"
 output_file = os.path.join(base_dir, "tree_iq_LGI_no_outliers.treefile")
 
-# Read outlier names from the file
-with open(outlier_file, "r") as f:
-    outlier_names = [line.strip() for line in f]
+ENZYME_TREE_DIR = "/work3/s233201/enzyme_out_6/enzyme_trees"
+GENE_NAMES = ["LYS20", "ACO2", "LYS4", "LYS12", "ARO8", "LYS2", "LYS9", "LYS1"]
 
-# Load the tree
-t = Tree(tree_file)
+def prune_tree_file(task):
+    """
+    Prune the outliers (or everything outside a keep-set) from one tree file.
 
-# Remove outlier nodes from the tree
-for outlier in outlier_names:
-    try:
-        node = t.search_nodes(name=outlier)[0]
-        node.delete()
-    except IndexError:
-        print(f"Warning: Outlier '{outlier}' not found in the tree.")
+    Args:
+        task (tuple): (tree_file, output_file, outliers, keep), where outliers
+            and keep are sets of accessions or None
 
-# Write the modified tree to a new file
-t.write(outfile=output_file)
+    Returns:
+        tuple: (output_file, leaves before, leaves after, names not found in the tree)
+    """
+    tree_file, output_file, outliers, keep = task
+    tree = FlatTree.from_file(tree_file)
+    pruned = prune_leaves(tree, remove=outliers, keep=keep)
+    write_newick(pruned, output_file)
 
-print(f"Tree with outliers removed saved to {output_file}")
+    leaf_keys = {name[:15] for name in tree.leaf_names}
+    missing = sorted(name for name in outliers or () if name[:15] not in leaf_keys)
+    return output_file, len(tree), len(pruned), missing
+
+def pruned_path(tree_file, suffix="_no_outliers"):
+    """Output path next to the input: tree.treefile -> tree<suffix>.treefile."""
+    stem, ext = os.path.splitext(tree_file[:-3] if tree_file.endswith(".gz") else tree_file)
+    return f"{stem}{suffix}{ext}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Remove outlier leaves from one or more trees")
+    parser.add_argument("trees", nargs="*", default=None,
+                        help=f"Tree files (default: {tree_file})")
+    parser.add_argument("--enzymes", action="store_true",
+                        help=f"Prune the eight enzyme trees in {ENZYME_TREE_DIR}")
+    parser.add_argument("--outliers", default=None,
+                        help=f"Accessions to remove, .txt or .csv with an Accession column (default: {outlier_file})")
+    parser.add_argument("--keep", default=None,
+                        help="Keep only these accessions, e.g. taxa_present_in_all_fastas.csv")
+    parser.add_argument("-o", "--output", default=None, help="Output tree (single input only)")
+    parser.add_argument("--suffix", default="_no_outliers", help="Output name suffix for multiple inputs")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args()
+
+    trees = list(args.trees or [])
+    if args.enzymes:
+        trees += [os.path.join(ENZYME_TREE_DIR, gene, "tree_iq_multi_LGI.treefile") for gene in GENE_NAMES]
+    if not trees:
+        trees = [tree_file]
+    if args.output and len(trees) > 1:
+        parser.error("--output can only be used with a single tree")
+
+    if args.keep is None and args.outliers is None:
+        args.outliers = outlier_file
+    outliers = read_taxa_file(args.outliers) if args.outliers else None
+    keep = read_taxa_file(args.keep) if args.keep else None
+
+    if args.output:
+        outputs = [args.output]
+    elif trees == [tree_file]:
+        outputs = [output_file]
+    else:
+        outputs = [pruned_path(t, args.suffix) for t in trees]
+
+    tasks = [(t, out, outliers, keep) for t, out in zip(trees, outputs)]
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for out, n_before, n_after, missing in executor.map(prune_tree_file, tasks):
+            for name in missing:
+                print(f"Warning: Outlier '{name}' not found in the tree.")
+            print(f"Tree with outliers removed saved to {out} ({n_before} -> {n_after} leaves)")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,21 @@
-from ete3 import Tree
 import pandas as pd
 import numpy as np
 import gzip
 import pickle
-from tqdm import tqdm
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tree_arrays import tree_distance_frame
 
 def get_distance_matrix(tree_file):
     """
     Extract pairwise distances from an IQ-TREE generated tree file.
     Can handle both plain and gzipped tree files.
+
+    The tree is parsed once into flat arrays and the patristic distances are
+    computed in row blocks (see tree_arrays.py); the result is cached as a
+    float32 store next to the tree file.
     
     Args:
         tree_file (str): Path to the tree file in Newick format (plain or gzipped)
@@ -16,31 +23,7 @@ def get_distance_matrix(tree_file):
     Returns:
         pd.DataFrame: Distance matrix with species names as index and columns
     """
-    # Handle gzipped tree files
-    if tree_file.endswith('.gz'):
-        with gzip.open(tree_file, 'rt') as f:  # 'rt' mode for text reading
-            newick_str = f.read()
-        tree = Tree(newick_str)
-    else:
-        tree = Tree(tree_file)
-    
-    # Get all leaf names
-    leaves = tree.get_leaf_names()
-    
-    # Initialize distance matrix
-    n_species = len(leaves)
-    dist_matrix = np.zeros((n_species, n_species))
-    
-    # Calculate pairwise distances
-    for i, sp1 in enumerate(tqdm(leaves, desc="Calculating distances")):
-        for j, sp2 in enumerate(leaves):
-            if i != j:
-                dist_matrix[i, j] = tree.get_distance(sp1, sp2)
-    
-    # Create DataFrame with species names
-    dm_df = pd.DataFrame(dist_matrix, index=leaves, columns=leaves)
-    
-    return dm_df
+    return tree_distance_frame(tree_file)
 
 def load_pickled_matrix(pickle_file):
     """
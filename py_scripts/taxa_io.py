@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+
+import csv
+
+def read_taxa_file(filepath):
+    """Read accessions from a CSV with an `Accession` column or a one-per-line text file."""
+    if filepath.endswith(".csv"):
+        with open(filepath) as f:
+            return {row["Accession"].strip() for row in csv.DictReader(f)}
+    with open(filepath) as f:
+        return {line.strip() for line in f if line.strip()}
@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+
+import argparse
+import gzip
+import os
+import re
+from os import path
+import numpy as np
+import pandas as pd
+from dist_matrix import DistanceMatrix, store_paths
+
+NEWICK_TOKEN = re.compile(r"'(?:[^']|'')*'|[(),;]|:[^(),;:]*|[^(),;:]+")
+
+def read_newick(tree_file):
+    """Read a Newick string from a plain or gzipped tree file."""
+    opener = gzip.open if tree_file.endswith('.gz') else open
+    with opener(tree_file, 'rt') as f:
+        return f.read().strip()
+
+class FlatTree:
+    """
+    Rooted tree stored as flat arrays in pre-order.
+
+    Node 0 is the root and every node's parent has a smaller index, so one
+    forward pass over the arrays visits parents before children and one
+    backward pass visits children before parents. The leaves of every clade
+    occupy a contiguous range of the leaf order (`leaf_lo`, `leaf_hi`), which
+    is the same order ete3's `get_leaf_names()` returns.
+    """
+
+    def __init__(self, parent, length, names):
+        """
+        Args:
+            parent (numpy.ndarray): Parent index of every node (-1 for the root)
+            length (numpy.ndarray): Branch length to the parent (0 when missing)
+            names (list): Node labels ('' when unnamed; support values for internal nodes)
+        """
+        self.parent = np.asarray(parent, dtype=np.int32)
+        self.length = np.asarray(length, dtype=np.float64)
+        self.names = list(names)
+        self.n_nodes = len(self.parent)
+
+        n_children = np.bincount(self.parent[1:], minlength=self.n_nodes)
+        self.is_leaf = n_children == 0
+        self.leaves = np.flatnonzero(self.is_leaf).astype(np.int32)
+        self.leaf_names = [self.names[i] for i in self.leaves]
+
+        # Root-to-node distance, parents first
+        self.depth = np.zeros(self.n_nodes, dtype=np.float64)
+        for v in range(1, self.n_nodes):
+            self.depth[v] = self.depth[self.parent[v]] + self.length[v]
+
+        # Clade sizes, children first; clade v spans pre-order nodes [v, v + size)
+        self.size = np.ones(self.n_nodes, dtype=np.int64)
+        n_leaves = self.is_leaf.astype(np.int64)
+        for v in range(self.n_nodes - 1, 0, -1):
+            self.size[self.parent[v]] += self.size[v]
+            n_leaves[self.parent[v]] += n_leaves[v]
+        leaves_before = np.concatenate([[0], np.cumsum(self.is_leaf)])[:-1]
+        self.leaf_lo = leaves_before
+        self.leaf_hi = leaves_before + n_leaves
+
+        # Children in pre-order, as CSR slices of `children`
+        order = np.argsort(self.parent[1:], kind="stable") + 1
+        self.children = order.astype(np.int32)
+        self.child_ptr = np.zeros(self.n_nodes + 1, dtype=np.int64)
+        self.child_ptr[1:] = np.cumsum(n_children)
+
+    @classmethod
+    def from_newick(cls, newick):
+        """Parse a Newick string (one tree, optional quoted labels and branch lengths)."""
+        parent, length, names = [-1], [0.0], ['']
+        current = 0
+        for token in NEWICK_TOKEN.findall(newick):
+            if token == '(':
+                parent.append(current)
+                length.append(0.0)
+                names.append('')
+                current = len(parent) - 1
+            elif token == ',':
+                parent.append(parent[current])
+                length.append(0.0)
+                names.append('')
+                current = len(parent) - 1
+            elif token == ')':
+                current = parent[current]
+            elif token == ';':
+                break
+            elif token.startswith(':'):
+                length[current] = float(token[1:])
+            elif token.startswith("'"):
+                names[current] = token[1:-1].replace("''", "'")
+            elif token.strip():
+                names[current] = token.strip()
+        return cls(parent, length, names)
+
+    @classmethod
+    def from_file(cls, tree_file):
+        """Parse a plain or gzipped Newick tree file."""
+        return cls.from_newick(read_newick(tree_file))
+
+    def __len__(self):
+        return len(self.leaves)
+
+    def node_children(self, v):
+        """Child node indices of node v."""
+        return self.children[self.child_ptr[v]:self.child_ptr[v + 1]]
+
+class IndexedTree(FlatTree):
+    """
+    FlatTree with constant-time LCA, distance and clade queries.
+
+    The Euler tour of the tree is indexed with a sparse table of range
+    minima over node levels, so the lowest common ancestor of any two nodes
+    is two table lookups. All queries take index arrays and are vectorized,
+    which makes millions of pair queries cheap without a dense matrix.
+    """
+
+    def __init__(self, parent, length, names, key_len=15):
+        """
+        Args:
+            parent, length, names: As for FlatTree
+            key_len (int): Leaf names are looked up on their first key_len
+                characters (None for full names)
+        """
+        super().__init__(parent, length, names)
+        self.key_len = key_len
+
+        # Number of edges from the root
+        self.level = np.zeros(self.n_nodes, dtype=np.int32)
+        for v in range(1, self.n_nodes):
+            self.level[v] = self.level[self.parent[v]] + 1
+
+        # Euler tour: every node is listed on entry and after each child returns
+        euler = np.empty(2 * self.n_nodes - 1, dtype=np.int32)
+        first = np.empty(self.n_nodes, dtype=np.int64)
+        stack = [(0, 0)]
+        pos = 0
+        while stack:
+            v, k = stack.pop()
+            euler[pos] = v
+            if k == 0:
+                first[v] = pos
+            pos += 1
+            kids = self.node_children(v)
+            if k < len(kids):
+                stack.append((v, k + 1))
+                stack.append((kids[k], 0))
+        self.euler = euler
+        self.first = first
+
+        # sparse[k][i]: Euler position of the shallowest node in euler[i:i + 2**k]
+        levels = self.level[euler]
+        sparse = [np.arange(len(euler), dtype=np.int32)]
+        span = 1
+        while 2 * span <= len(euler):
+            prev = sparse[-1]
+            left, right = prev[:len(prev) - span], prev[span:]
+            sparse.append(np.where(levels[left] <= levels[right], left, right))
+            span *= 2
+        self.sparse = sparse
+        self._euler_levels = levels
+
+        self.leaf_index = {}
+        for i, name in enumerate(self.leaf_names):
+            self.leaf_index.setdefault(self.leaf_key(name), i)
+
+    def leaf_key(self, name):
+        """Lookup key of a leaf name."""
+        return name if self.key_len is None else name[:self.key_len]
+
+    def leaf_positions(self, names):
+        """Leaf-order positions of leaf names (-1 when a name is not in the tree)."""
+        return np.array([self.leaf_index.get(self.leaf_key(name), -1) for name in names], dtype=np.int64)
+
+    def _range_min(self, lo, hi):
+        """Euler position of the shallowest node in euler[lo:hi + 1], vectorized."""
+        k = np.floor(np.log2(hi - lo + 1)).astype(np.int64)
+        out = np.empty(len(lo), dtype=np.int64)
+        for level in np.unique(k):
+            sel = k == level
+            table = self.sparse[level]
+            a, b = table[lo[sel]], table[hi[sel] - (1 << level) + 1]
+            out[sel] = np.where(self._euler_levels[a] <= self._euler_levels[b], a, b)
+        return out
+
+    def lca(self, u, v):
+        """Lowest common ancestors of node index arrays u and v."""
+        fu, fv = self.first[np.atleast_1d(u)], self.first[np.atleast_1d(v)]
+        return self.euler[self._range_min(np.minimum(fu, fv), np.maximum(fu, fv))]
+
+    def leaf_lca(self, i, j):
+        """Lowest common ancestors of leaf-order positions i and j."""
+        return self.lca(self.leaves[np.atleast_1d(i)], self.leaves[np.atleast_1d(j)])
+
+    def mrca(self, leaf_positions):
+        """Most recent common ancestor of a set of leaves."""
+        f = self.first[self.leaves[np.asarray(leaf_positions)]]
+        return int(self.euler[self._range_min(np.array([f.min()]), np.array([f.max()]))[0]])
+
+    def distance(self, i, j):
+        """Patristic distances between leaf-order positions i and j."""
+        i, j = np.atleast_1d(i), np.atleast_1d(j)
+        u, v = self.leaves[i], self.leaves[j]
+        return self.depth[u] + self.depth[v] - 2 * self.depth[self.lca(u, v)]
+
+    def name_distance(self, names1, names2):
+        """Patristic distances between paired leaf names (NaN when a name is missing)."""
+        i, j = self.leaf_positions(names1), self.leaf_positions(names2)
+        out = np.full(len(i), np.nan)
+        ok = (i >= 0) & (j >= 0)
+        out[ok] = self.distance(i[ok], j[ok])
+        return out
+
+    def in_clade(self, i, v):
+        """Whether leaf-order positions i lie in the clade(s) rooted at node(s) v."""
+        i = np.asarray(i)
+        return (self.leaf_lo[v] <= i) & (i < self.leaf_hi[v])
+
+    def clade_leaves(self, v):
+        """Leaf-order positions of the leaves below node v."""
+        return np.arange(self.leaf_lo[v], self.leaf_hi[v])
+
+    def adjacent_leaf_pairs(self):
+        """
+        Neighbouring leaves in leaf order and how many clades contain both.
+
+        Listing consecutive leaves of every internal node's `get_leaves()`
+        yields each neighbouring pair once per internal node above their LCA
+        (LCA included); this returns those pairs and multiplicities directly.
+
+        Returns:
+            tuple: (left positions, right positions, multiplicities)
+        """
+        left = np.arange(len(self) - 1)
+        right = left + 1
+        return left, right, self.level[self.leaf_lca(left, right)] + 1
+
+def tree_edge_collection(tree_file, name_to_idx, embedding, color="gray", linewidth=0.5):
+    """
+    Tree edges to overlay on a 2-D embedding, as a matplotlib LineCollection.
+
+    Neighbouring leaves of every clade are joined once, with the alpha that
+    one faint line per containing clade would accumulate to.
+
+    Args:
+        tree_file (str): Newick tree file (plain or .gz)
+        name_to_idx (dict): Accession (first 15 characters) -> embedding row
+        embedding (numpy.ndarray): (n, 2) coordinates
+        color (str): Line colour
+        linewidth (float): Line width
+
+    Returns:
+        matplotlib.collections.LineCollection
+    """
+    from matplotlib.collections import LineCollection
+    from matplotlib.colors import to_rgba
+
+    tree = IndexedTree.from_file(tree_file)
+    left, right, clades = tree.adjacent_leaf_pairs()
+    leaf_idx = np.array([name_to_idx.get(tree.leaf_key(name), -1) for name in tree.leaf_names])
+    idx1, idx2 = leaf_idx[left], leaf_idx[right]
+    present = (idx1 >= 0) & (idx2 >= 0)
+    segments = np.stack([embedding[idx1[present]], embedding[idx2[present]]], axis=1)
+    colors = np.tile(to_rgba(color), (len(segments), 1))
+    colors[:, 3] = 1 - 0.9 ** clades[present]
+    return LineCollection(segments, colors=colors, linewidths=linewidth)
+
+def prune_leaves(tree, remove=None, keep=None, key_len=15):
+    """
+    Remove many leaves at once, collapsing the unary nodes left behind.
+
+    A post-order pass counts the surviving leaves below every node; a
+    pre-order pass then drops empty clades and splices out nodes left with a
+    single child, adding their branch length to that child. If the root is
+    left with one child, that child becomes the new root.
+
+    Args:
+        tree (FlatTree): Tree to prune (not modified)
+        remove (iterable): Leaf names to remove, e.g. an outlier set
+        keep (iterable): Leaf names to keep; all others are removed
+        key_len (int): Names are matched on their first key_len characters (None for full names)
+
+    Returns:
+        FlatTree: Pruned tree
+    """
+    key = (lambda name: name) if key_len is None else (lambda name: name[:key_len])
+    alive = np.ones(len(tree), dtype=bool)
+    if keep is not None:
+        keep = {key(name) for name in keep}
+        alive &= np.array([key(name) in keep for name in tree.leaf_names], dtype=bool)
+    if remove is not None:
+        remove = {key(name) for name in remove}
+        alive &= np.array([key(name) not in remove for name in tree.leaf_names], dtype=bool)
+
+    # Post-order: surviving leaves and surviving children per node
+    n_alive = np.zeros(tree.n_nodes, dtype=np.int64)
+    n_alive[tree.leaves] = alive
+    alive_children = np.zeros(tree.n_nodes, dtype=np.int64)
+    for v in range(tree.n_nodes - 1, 0, -1):
+        if n_alive[v]:
+            n_alive[tree.parent[v]] += n_alive[v]
+            alive_children[tree.parent[v]] += 1
+
+    # Pre-order: unary nodes pass their parent and branch length on to their child
+    new_id = np.full(tree.n_nodes, -1, dtype=np.int64)
+    attach = np.full(tree.n_nodes, -1, dtype=np.int64)
+    carried = np.zeros(tree.n_nodes, dtype=np.float64)
+    parent, length, names = [], [], []
+    for v in range(tree.n_nodes):
+        if not n_alive[v]:
+            continue
+        p = tree.parent[v]
+        if p >= 0:
+            attach[v] = new_id[p] if new_id[p] >= 0 else attach[p]
+            carried[v] = tree.length[v] + (carried[p] if new_id[p] < 0 else 0.0)
+        if not tree.is_leaf[v] and alive_children[v] == 1:
+            continue
+        new_id[v] = len(parent)
+        parent.append(attach[v])
+        length.append(carried[v] if attach[v] >= 0 else 0.0)
+        names.append(tree.names[v])
+    return FlatTree(parent, length, names)
+
+def to_newick(tree, precision=10):
+    """Newick string of a tree with internal labels and branch lengths (ete3 format 1)."""
+    parts = [None] * tree.n_nodes
+    for v in range(tree.n_nodes - 1, -1, -1):
+        label = tree.names[v]
+        if not tree.is_leaf[v]:
+            label = "(" + ",".join(parts[c] for c in tree.node_children(v)) + ")" + label
+        if v:
+            label += f":{tree.length[v]:.{precision}g}"
+        parts[v] = label
+        for c in tree.node_children(v):
+            parts[c] = None
+    return parts[0] + ";"
+
+def write_newick(tree, output_file):
+    """Write a tree as a one-line Newick file."""
+    with open(output_file, "w") as f:
+        f.write(to_newick(tree) + "\n")
+
+def patristic_rows(tree, start, stop):
+    """
+    Patristic distances from leaves start..stop-1 to all leaves.
+
+    For every internal node v, leaf pairs split between two of its children
+    have v as their lowest common ancestor. Because clades are contiguous in
+    leaf order, each such set of pairs is a rectangle of the matrix filled
+    with depth[i] + depth[j] - 2 * depth[v], so the block costs O(rows * n)
+    array work and one small slice assignment per child.
+
+    Args:
+        tree (FlatTree): Parsed tree
+        start (int): First leaf row
+        stop (int): One past the last leaf row
+
+    Returns:
+        numpy.ndarray: (stop - start, n_leaves) float64 block
+    """
+    leaf_depth = tree.depth[tree.leaves]
+    block = np.zeros((stop - start, len(tree)), dtype=np.float64)
+    # Only ancestors of the block's leaves contribute
+    internal = np.flatnonzero(~tree.is_leaf & (tree.leaf_lo < stop) & (tree.leaf_hi > start))
+    for v in internal:
+        kids = tree.node_children(v)
+        lo_v = tree.leaf_lo[v]
+        for c in kids[1:]:
+            # Pairs between child c and all earlier children of v
+            lo_c, hi_c = tree.leaf_lo[c], tree.leaf_hi[c]
+            offset = leaf_depth - 2 * tree.depth[v]
+            r0, r1 = max(lo_v, start), min(lo_c, stop)
+            if r0 < r1:
+                block[r0 - start:r1 - start, lo_c:hi_c] = \
+                    leaf_depth[r0:r1, None] + offset[None, lo_c:hi_c]
+            r0, r1 = max(lo_c, start), min(hi_c, stop)
+            if r0 < r1:
+                block[r0 - start:r1 - start, lo_v:lo_c] = \
+                    leaf_depth[r0:r1, None] + offset[None, lo_v:lo_c]
+    return block
+
+def write_patristic_store(tree, prefix, block_rows=1024):
+    """
+    Write all-pairs patristic distances of a tree as a dist_matrix store.
+
+    Rows are computed in blocks and their upper-triangle parts written
+    straight into the memory-mapped condensed float32 array, so the dense
+    matrix is never held in memory.
+
+    Args:
+        tree (FlatTree): Parsed tree
+        prefix (str): Store prefix
+        block_rows (int): Leaves per block
+
+    Returns:
+        str: Store prefix
+    """
+    npy_path, acc_path = store_paths(prefix)
+    npy_tmp, acc_tmp = f"{npy_path}.part", f"{acc_path}.part"
+    n = len(tree)
+    condensed = np.lib.format.open_memmap(npy_tmp, mode="w+", dtype=np.float32,
+                                          shape=(n * (n - 1) // 2,))
+    offset = 0
+    for start in range(0, n, block_rows):
+        stop = min(start + block_rows, n)
+        block = patristic_rows(tree, start, stop)
+        upper = np.arange(n)[None, :] > np.arange(start, stop)[:, None]
+        values = block[upper]
+        condensed[offset:offset + len(values)] = values
+        offset += len(values)
+    condensed.flush()
+    del condensed
+
+    with open(acc_tmp, "w") as f:
+        f.write("\n".join(tree.leaf_names) + "\n")
+    # Accessions first, .npy last: a store is only complete once both exist
+    os.replace(acc_tmp, acc_path)
+    os.replace(npy_tmp, npy_path)
+    return prefix
+
+def tree_distance_matrix(tree_file, prefix=None, block_rows=1024):
+    """
+    Open the patristic distance matrix of a tree, computing it on first use.
+
+    Args:
+        tree_file (str): Newick tree file (plain or .gz)
+        prefix (str): Store prefix (default: <tree_file>.dmat)
+        block_rows (int): Leaves per block when computing
+
+    Returns:
+        DistanceMatrix
+    """
+    prefix = prefix or f"{tree_file}.dmat"
+    npy_path, acc_path = store_paths(prefix)
+    stale = not (path.exists(npy_path) and path.exists(acc_path)) or \
+        min(path.getmtime(npy_path), path.getmtime(acc_path)) < path.getmtime(tree_file)
+    if stale:
+        print(f"Computing patristic distances of {tree_file}...")
+        write_patristic_store(FlatTree.from_file(tree_file), prefix, block_rows)
+    return DistanceMatrix(prefix)
+
+def tree_distance_frame(tree_file):
+    """Patristic distances as a DataFrame with leaf names as index and columns."""
+    dm = tree_distance_matrix(tree_file)
+    names = dm.accessions.tolist()
+    return pd.DataFrame(dm.square(dtype=np.float64), index=names, columns=names)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute all-pairs patristic distances of Newick trees")
+    parser.add_argument("inputs", nargs="+", help="Tree files (plain or .gz)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Store prefix (single input only; default: <input>.dmat)")
+    parser.add_argument("-b", "--block-rows", type=int, default=1024, help="Leaves per block")
+    args = parser.parse_args()
+
+    if args.output and len(args.inputs) > 1:
+        parser.error("--output can only be used with a single input")
+
+    for tree_file in args.inputs:
+        tree = FlatTree.from_file(tree_file)
+        prefix = write_patristic_store(tree, args.output or f"{tree_file}.dmat", args.block_rows)
+        print(f"Wrote {prefix} ({len(tree)} leaves)")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,43 @@
-from ete3 import Tree
 import csv
 import colorsys
+import glob
+import os
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from tree_arrays import FlatTree, write_newick
+
+# Define colors for phyla
+PHYLUM_COLORS = {
+    'Ascomycota': '#377eb8',        # Blue
+    'Basidiomycota': '#e41a1c',     # Red
+    'Mucoromycota': '#4daf4a',      # Green
+    'Zoopagomycota': '#984ea3',     # Purple
+    'Chytridiomycota': '#ff7f00',   # Orange
+    'Blastocladiomycota': '#ffff33',# Yellow
+    'Cryptomycota': '#a65628',      # Brown
+    'Other': '#cccccc'              # Default Grey for Other
+}
+
+# Colors for DeepLoc localizations (ColorBrewer Set2)
+LOCALIZATION_COLORS = {
+    'Cytoplasm': '#66c2a5',
+    'Nucleus': '#fc8d62',
+    'Extracellular': '#8da0cb',
+    'Cell membrane': '#a6d854',
+    'Mitochondrion': '#ffd92f',
+    'Plastid': '#e5c494',
+    'Endoplasmic reticulum': '#b3b3b3',
+    'Lysosome/Vacuole': '#1b9e77',
+    'Golgi apparatus': '#d95f02',
+    'Peroxisome': '#7570b3',
+}
+
+def load_truncated_tree(input_path):
+    """Parse a tree once and truncate all node names to 15 characters."""
+    tree = FlatTree.from_file(input_path)
+    tree.names = [name[:15] for name in tree.names]
+    tree.leaf_names = [tree.names[i] for i in tree.leaves]
+    return tree
 
 def modify_tree(input_path, output_path, taxon_map):
     """
@@ -16,34 +52,15 @@ def modify_tree(input_path, output_path, taxon_map):
     Returns:
         list: A list of tuples, where each tuple is (truncated_node_name, taxon_label).
     """
-    annotations = [] # List to store annotations
     try:
-        # Load the tree
-        tree = Tree(input_path, format=1) # Assuming format 1, adjust if needed
-
-        # Iterate through all nodes and truncate names, collect annotations
-        for node in tree.traverse():
-            if node.name:
-                original_name = node.name
-                truncated_name = original_name[:15]
-                node.name = truncated_name # Apply truncation
-
-                # Check if the truncated name is in the taxon map and collect annotation
-                if truncated_name in taxon_map:
-                    taxon_label = taxon_map[truncated_name]
-                    annotations.append((truncated_name, taxon_label))
-
-        # Write the modified tree (with truncated names only) to the output file
-        # format=1 corresponds to the standard Newick format with internal node names
-        tree.write(outfile=output_path, format=1)
+        tree = load_truncated_tree(input_path)
+        write_newick(tree, output_path)
         print(f"Successfully processed tree and saved truncated version to {output_path}")
-
     except Exception as e:
         print(f"An error occurred during tree processing: {e}")
-        # Optionally re-raise or return empty list depending on desired error handling
         return [] # Return empty list on error
 
-    return annotations
+    return [(name, taxon_map[name]) for name in tree.leaf_names if name in taxon_map]
 
 def generate_distinct_colors(n):
     """Generate n distinct colors using HSV color space."""
@@ -71,148 +88,196 @@ def get_top_classes(class_map, n=15):
     top_classes = [class_name for class_name, count in class_counts.most_common(n)]
     return top_classes
 
+def load_annotation_map(csv_path, value_column=1, key_column=0, default="Other"):
+    """
+    Load an accession-keyed annotation table.
+
+    Args:
+        csv_path (str): CSV file with a header row
+        value_column (int or str): Column index or name holding the annotation
+        key_column (int or str): Column index or name holding the accession
+        default (str): Label used for empty values (None keeps them empty)
+
+    Returns:
+        dict: 15-character accession -> annotation
+    """
+    annotation_map = {}
+    with open(csv_path, mode='r', newline='') as infile:
+        reader = csv.reader(infile)
+        header = next(reader)
+        key_idx = header.index(key_column) if isinstance(key_column, str) else key_column
+        value_idx = header.index(value_column) if isinstance(value_column, str) else value_column
+        for row in reader:
+            if len(row) > max(key_idx, value_idx):
+                value = row[value_idx]
+                annotation_map[row[key_idx][:15]] = value if value or default is None else default
+    return annotation_map
+
+def category_colors(annotation_map, top_n=15):
+    """Colors for the top_n most common labels, with the rest grouped as 'Other'."""
+    top = get_top_classes(annotation_map, n=top_n)
+    colors = dict(zip(top, generate_distinct_colors(len(top))))
+    colors['Other'] = '#cccccc'
+    return colors
+
+def colorstrip_lines(dataset, leaf_names):
+    """DATASET_COLORSTRIP: one color per leaf from a categorical annotation."""
+    values = dataset['values']
+    colors = dataset.get('colors') or category_colors(values, dataset.get('top_n', 15))
+    yield "DATASET_COLORSTRIP"
+    yield "SEPARATOR TAB"
+    yield f"DATASET_LABEL\t{dataset['label']}"
+    yield f"LEGEND_TITLE\t{dataset.get('legend_title', dataset['label'])}"
+    yield "LEGEND_SHAPES\t" + '\t'.join(['1'] * len(colors))
+    yield "LEGEND_COLORS\t" + '\t'.join(colors.values())
+    yield "LEGEND_LABELS\t" + '\t'.join(colors.keys())
+    yield "DATA"
+    other = colors.get('Other', '#cccccc')
+    for name in leaf_names:
+        if name in values:
+            yield f"{name}\t{colors.get(values[name], other)}"
+
+def binary_lines(dataset, leaf_names):
+    """DATASET_BINARY: one filled/empty shape per category, multi-labels split on '|'."""
+    values = dataset['values']
+    fields = dataset.get('fields') or sorted({label for v in values.values() for label in v.split('|') if label})
+    colors = dataset.get('colors') or dict(zip(fields, generate_distinct_colors(len(fields))))
+    yield "DATASET_BINARY"
+    yield "SEPARATOR TAB"
+    yield f"DATASET_LABEL\t{dataset['label']}"
+    yield "COLOR\t#000000"
+    yield "FIELD_SHAPES\t" + '\t'.join(['1'] * len(fields))
+    yield "FIELD_LABELS\t" + '\t'.join(fields)
+    yield "FIELD_COLORS\t" + '\t'.join(colors.get(field, '#cccccc') for field in fields)
+    yield "DATA"
+    for name in leaf_names:
+        if name in values:
+            labels = set(values[name].split('|'))
+            yield name + '\t' + '\t'.join('1' if field in labels else '0' for field in fields)
+
+def simplebar_lines(dataset, leaf_names):
+    """DATASET_SIMPLEBAR: one numeric value per leaf."""
+    values = dataset['values']
+    yield "DATASET_SIMPLEBAR"
+    yield "SEPARATOR TAB"
+    yield f"DATASET_LABEL\t{dataset['label']}"
+    yield f"COLOR\t{dataset.get('color', '#377eb8')}"
+    yield "DATA"
+    for name in leaf_names:
+        if values.get(name):
+            yield f"{name}\t{values[name]}"
+
+DATASET_WRITERS = {
+    'COLORSTRIP': colorstrip_lines,
+    'BINARY': binary_lines,
+    'SIMPLEBAR': simplebar_lines,
+}
+
+def annotate_tree(task):
+    """
+    Truncate one tree's names and write all of its iTOL datasets.
+
+    The tree is parsed once; every dataset is then produced from the same
+    leaf list.
+
+    Args:
+        task (tuple): (input_path, output_tree_path, datasets, output_prefix),
+            where each dataset is a dict with 'name', 'type' (COLORSTRIP,
+            BINARY or SIMPLEBAR), 'label' and 'values' (accession -> value)
+            plus optional 'colors', 'legend_title', 'fields', 'top_n' and
+            'path' (output file; default <output_prefix>_<name>_<type>.txt)
+
+    Returns:
+        list: Paths of the files written
+    """
+    input_path, output_tree_path, datasets, output_prefix = task
+    written = []
+    try:
+        tree = load_truncated_tree(input_path)
+        write_newick(tree, output_tree_path)
+        written.append(output_tree_path)
+
+        for dataset in datasets:
+            lines = DATASET_WRITERS[dataset['type']](dataset, tree.leaf_names)
+            out_path = dataset.get('path') or f"{output_prefix}_{dataset['name']}_{dataset['type'].lower()}.txt"
+            with open(out_path, 'w') as outfile:
+                outfile.write('\n'.join(lines) + '\n')
+            written.append(out_path)
+    except Exception as e:
+        print(f"An error occurred while annotating {input_path}: {e}")
+    return written
+
+def latest_deeploc_results(gene_name, deeploc_dir="data_out/deeploc_output"):
+    """Most recent DeepLoc results CSV for a gene, or None."""
+    results = sorted(glob.glob(os.path.join(deeploc_dir, gene_name.lower(), "results_*.csv")))
+    return results[-1] if results else None
+
 if __name__ == "__main__":
     # Define the input and output file paths here
     input_file_path = "/work3/s233201/output_phyl_busco_4/tree_iq_LGI.treefile"
     output_tree_path = "/work3/s233201/output_phyl_busco_4/tree_iq_LGI_refactored.treefile"
+    enzyme_tree_dir = "/work3/s233201/enzyme_out_6/enzyme_trees"
+    cluster_dir = "/zhome/85/8/203063/a3_fungi/clusters/5_20_05_leaf"
     phylum_csv_path = "data_out/taxa_clean_0424.csv"
     class_csv_path = "data_out/class_non_filtered.csv"
+    busco_csv_path = "data_out/busco_results.csv"
     output_phylum_path = "/work3/s233201/enzyme_out_6/tree_iq_LGI_phylum_aaa_colorstrip.txt"
     output_class_path = "data/tree_iq_LGI_class_aaa_colorstrip.txt"
+    gene_names = ["LYS20", "ACO2", "LYS4", "LYS12", "ARO8", "LYS2", "LYS9", "LYS1"]
 
-    # Create both phylum and class maps
-    phylum_map = {}
-    class_map = {}
-    
-    # Load phylum map
+    # Annotation tables shared by all trees are loaded once
     try:
-        with open(phylum_csv_path, mode='r', newline='') as infile:
-            reader = csv.reader(infile)
-            header = next(reader) # Skip header row
-            for row in reader:
-                if len(row) >= 2: # Ensure row has at least two columns
-                    accession, phylum = row[0], row[1]
-                    truncated_accession = accession[:15] # Ensure keys match truncated names
-                    # Use "Other" instead of "Unknown"
-                    phylum_label = phylum if phylum else "Other"
-                    phylum_map[truncated_accession] = phylum_label
+        phylum_map = load_annotation_map(phylum_csv_path)
         print(f"Successfully loaded phylum map from {phylum_csv_path}")
-    except FileNotFoundError:
-        print(f"Error: Phylum CSV file not found at {phylum_csv_path}")
+        class_map = load_annotation_map(class_csv_path)
+        print(f"Successfully loaded class map from {class_csv_path}")
+    except FileNotFoundError as e:
+        print(f"Error: Annotation CSV file not found: {e.filename}")
         exit(1) # Exit if the mapping file is crucial and not found
-    except Exception as e:
-        print(f"An error occurred while reading the phylum CSV: {e}")
-        exit(1)
+    busco_map = load_annotation_map(busco_csv_path, value_column='complete_buscos',
+                                    key_column='organism', default=None) if os.path.exists(busco_csv_path) else {}
 
-    # Load class map
-    try:
-        with open(class_csv_path, mode='r', newline='') as infile:
-            reader = csv.reader(infile)
-            header = next(reader)  # Skip header row
-            for row in reader:
-                if len(row) >= 2:
-                    accession, class_name = row[0], row[1]
-                    truncated_accession = accession[:15]
-                    # Use "Other" instead of "Unknown"
-                    class_label = class_name if class_name else "Other"
-                    class_map[truncated_accession] = class_label
-        print(f"Successfully loaded class map from {class_csv_path}")
-    except FileNotFoundError:
-        print(f"Error: Class CSV file not found at {class_csv_path}")
-        exit(1)
-    except Exception as e:
-        print(f"An error occurred while reading the class CSV: {e}")
-        exit(1)
-
-    # Call the function to modify the tree and get annotations
-    collected_phylum_annotations = modify_tree(input_file_path, output_tree_path, phylum_map)
-    collected_class_annotations = modify_tree(input_file_path, output_tree_path, class_map)
-
-    # Define colors for phyla
-    PHYLUM_COLORS = {
-        'Ascomycota': '#377eb8',        # Blue
-        'Basidiomycota': '#e41a1c',     # Red
-        'Mucoromycota': '#4daf4a',      # Green
-        'Zoopagomycota': '#984ea3',     # Purple
-        'Chytridiomycota': '#ff7f00',   # Orange
-        'Blastocladiomycota': '#ffff33',# Yellow
-        'Cryptomycota': '#a65628',      # Brown
-        'Other': '#cccccc'              # Default Grey for Other
-    }
-
-    # Write phylum annotations to iTOL COLORSTRIP file
-    if collected_phylum_annotations:
-        try:
-            with open(output_phylum_path, 'w') as outfile:
-                # Write iTOL specific header for COLORSTRIP
-                outfile.write("DATASET_COLORSTRIP\n")
-                outfile.write("SEPARATOR TAB\n")
-                outfile.write("DATASET_LABEL\tPhylum Distribution\n") # Label for the dataset
-
-                # Write Legend using the predefined PHYLUM_COLORS order
-                outfile.write("LEGEND_TITLE\tPhylum\n") # Title for the legend
-                legend_shapes = '\t'.join(['1'] * len(PHYLUM_COLORS)) # 1 is rectangle
-                outfile.write(f"LEGEND_SHAPES\t{legend_shapes}\n")
-                legend_colors_str = '\t'.join(PHYLUM_COLORS.values())
-                outfile.write(f"LEGEND_COLORS\t{legend_colors_str}\n")
-                legend_labels_str = '\t'.join(PHYLUM_COLORS.keys())
-                outfile.write(f"LEGEND_LABELS\t{legend_labels_str}\n")
-
-                # Write DATA header
-                outfile.write("DATA\n")
-                # Write the actual data (Node ID <TAB> Color)
-                for node_id, label in collected_phylum_annotations:
-                    # Get the color from PHYLUM_COLORS, defaulting to 'Other' color if not found
-                    color = PHYLUM_COLORS.get(label, PHYLUM_COLORS['Other'])
-                    outfile.write(f"{node_id}\t{color}\n")
-
-
-            print(f"Successfully wrote phylum COLORSTRIP annotations to {output_phylum_path}")
-        except Exception as e:
-            print(f"An error occurred while writing the phylum annotation file: {e}")
-    else:
-        print("No phylum annotations were generated (possibly due to errors or no matching nodes).")
-
-    # Instead of using all classes, get the top 15
-    top_classes = get_top_classes(class_map, n=15)
-    
-    # Generate colors for the top classes
-    class_colors = generate_distinct_colors(len(top_classes))
-    
-    # Create the color map for top classes
-    CLASS_COLORS = dict(zip(top_classes, class_colors))
-    CLASS_COLORS['Other'] = '#cccccc'  # Add Other with grey color
-
-    # Modify class map to replace rare classes with 'Other'
-    for acc in class_map:
-        if class_map[acc] not in CLASS_COLORS:
-            class_map[acc] = 'Other'
-
-    # Write class annotations to iTOL COLORSTRIP file
-    if collected_class_annotations:
-        try:
-            with open(output_class_path, 'w') as outfile:
-                outfile.write("DATASET_COLORSTRIP\n")
-                outfile.write("SEPARATOR TAB\n")
-                outfile.write("DATASET_LABEL\tClass Distribution\n")
-
-                # Write Legend using the predefined CLASS_COLORS order
-                outfile.write("LEGEND_TITLE\tClass\n") # Title for the legend
-                legend_shapes = '\t'.join(['1'] * len(CLASS_COLORS)) # 1 is rectangle
-                outfile.write(f"LEGEND_SHAPES\t{legend_shapes}\n")
-                outfile.write(f"LEGEND_COLORS\t{'\t'.join(CLASS_COLORS.values())}\n")
-                outfile.write(f"LEGEND_LABELS\t{'\t'.join(CLASS_COLORS.keys())}\n")
-
-                # Write DATA header
-                outfile.write("DATA\n")
-                # Write the actual data (Node ID <TAB> Color)
-                for node_id, label in collected_class_annotations:
-                    # Get the color from CLASS_COLORS, defaulting to 'Other' color if not found
-                    color = CLASS_COLORS.get(label, CLASS_COLORS['Other'])
-                    outfile.write(f"{node_id}\t{color}\n")
-
-            print(f"Successfully wrote class COLORSTRIP annotations to {output_class_path}")
-        except Exception as e:
-            print(f"An error occurred while writing the class annotation file: {e}")
-    else:
-        print("No class annotations were generated (possibly due to errors or no matching nodes).")
+    # Replace rare classes with 'Other' so the legend stays readable
+    class_colors = category_colors(class_map, top_n=15)
+    class_map = {acc: label if label in class_colors else 'Other' for acc, label in class_map.items()}
+
+    shared_datasets = [
+        {'name': 'phylum', 'type': 'COLORSTRIP', 'label': 'Phylum Distribution',
+         'legend_title': 'Phylum', 'values': phylum_map, 'colors': PHYLUM_COLORS},
+        {'name': 'class', 'type': 'COLORSTRIP', 'label': 'Class Distribution',
+         'legend_title': 'Class', 'values': class_map, 'colors': class_colors},
+    ]
+    if busco_map:
+        shared_datasets.append({'name': 'busco', 'type': 'SIMPLEBAR',
+                                'label': 'BUSCO Complete', 'values': busco_map})
+
+    # The species tree keeps its established phylum/class COLORSTRIP paths
+    legacy_paths = {'phylum': output_phylum_path, 'class': output_class_path}
+    species_datasets = [dict(dataset, path=legacy_paths[dataset['name']]) if dataset['name'] in legacy_paths
+                        else dataset for dataset in shared_datasets]
+    tasks = [(input_file_path, output_tree_path, species_datasets,
+              os.path.splitext(output_tree_path)[0])]
+    for gene in gene_names:
+        gene_tree = os.path.join(enzyme_tree_dir, gene, "tree_iq_multi_LGI.treefile")
+        gene_datasets = list(shared_datasets)
+        cluster_csv = os.path.join(cluster_dir, f"{gene.lower()}_dm_clusters.csv")
+        if os.path.exists(cluster_csv):
+            gene_datasets.append({'name': 'hdbscan', 'type': 'COLORSTRIP',
+                                  'label': f'{gene} HDBSCAN Clusters', 'legend_title': 'Cluster',
+                                  'values': load_annotation_map(cluster_csv), 'top_n': 20})
+        deeploc_csv = latest_deeploc_results(gene)
+        if deeploc_csv:
+            gene_datasets.append({'name': 'localization', 'type': 'BINARY',
+                                  'label': f'{gene} Subcellular Localization',
+                                  'values': load_annotation_map(deeploc_csv, value_column='Localizations'),
+                                  'colors': LOCALIZATION_COLORS})
+        output_path = os.path.join(enzyme_tree_dir, gene, "tree_iq_multi_LGI_refactored.treefile")
+        tasks.append((gene_tree, output_path, gene_datasets, os.path.splitext(output_path)[0]))
+
+    # All nine trees are annotated in parallel
+    with ProcessPoolExecutor() as executor:
+        for (input_path, _, _, _), written in zip(tasks, executor.map(annotate_tree, tasks)):
+            if written:
+                print(f"Successfully annotated {input_path}: wrote {len(written)} files")
+            else:
+                print(f"No annotations were generated for {input_path}.")
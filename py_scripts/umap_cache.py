@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
+from sklearn.utils import check_random_state
+from umap import UMAP, AlignedUMAP
+from umap.umap_ import (INT32_MAX, INT32_MIN, compute_membership_strengths, find_ab_params,
+                        init_graph_transform, make_epochs_per_sample, optimize_layout_euclidean,
+                        smooth_knn_dist)
+from dist_matrix import DistanceMatrix, open_distance_matrix, align_matrices, matrix_keys, matrix_values
+from knn_graph import block_knn, streamed_knn, knn_to_sparse, save_knn, load_knn
+
+UMAP_DEFAULTS = {"n_neighbors": 100, "min_dist": 0.1, "random_state": 42}
+
+def default_cache_dir(dm):
+    """Cache directory next to the distance matrix store."""
+    return f"{dm.prefix}.umap"
+
+def embedding_key(digest, params):
+    """Cache key of an embedding: matrix content hash plus all UMAP parameters."""
+    blob = json.dumps({"matrix": digest, **params}, sort_keys=True, default=str)
+    return hashlib.blake2b(blob.encode(), digest_size=16).hexdigest()
+
+def knn_path(cache_dir, digest, n_neighbors):
+    return os.path.join(cache_dir, f"knn_{digest}_k{n_neighbors}.npz")
+
+def load_cached_knn(cache_dir, digest, n_neighbors):
+    """Cached kNN graph with at least n_neighbors neighbours, pruned to n_neighbors, or None."""
+    best = None
+    for candidate in glob.glob(os.path.join(cache_dir, f"knn_{digest}_k*.npz")):
+        k = int(re.search(r"_k(\d+)\.npz$", candidate).group(1))
+        if k >= n_neighbors and (best is None or k < best[0]):
+            best = (k, candidate)
+    if best is None:
+        return None
+    return load_knn(best[1], n_neighbors)
+
+def knn_graph(dm, n_neighbors, cache_dir=None, digest=None):
+    """
+    kNN graph of a distance matrix, computed once per matrix content.
+
+    Args:
+        dm (DistanceMatrix): Distance matrix, read in row blocks
+        n_neighbors (int): Number of neighbours (including the point itself)
+        cache_dir (str): Cache directory (default: next to the store)
+        digest (str): Precomputed dm.digest()
+
+    Returns:
+        tuple: (int32 indices, float32 distances)
+    """
+    cache_dir = cache_dir or default_cache_dir(dm)
+    digest = digest or dm.digest()
+    cached = load_cached_knn(cache_dir, digest, n_neighbors)
+    if cached is not None:
+        return cached
+    indices, distances = streamed_knn(dm, n_neighbors)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_knn(knn_path(cache_dir, digest, n_neighbors), indices, distances)
+    return indices, distances
+
+def fit_embedding(dm, params, cache_dir, digest):
+    """Fit UMAP on a matrix and cache the embedding and its parameters."""
+    # UMAP only sees the kNN graph, so memory stays O(n * k) instead of O(n^2)
+    indices, distances = knn_graph(dm, params["n_neighbors"], cache_dir, digest)
+    reducer = UMAP(metric="precomputed", precomputed_knn=(indices, distances), **params)
+    embedding = reducer.fit_transform(knn_to_sparse(indices, distances)).astype(np.float32)
+
+    key = embedding_key(digest, params)
+    emb_path = os.path.join(cache_dir, f"emb_{key}.npy")
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(emb_path, embedding)
+    with open(emb_path[:-4] + ".json", "w") as f:
+        json.dump({"matrix": digest, **params}, f, default=str)
+    return embedding
+
+def umap_embedding(src, n_components=2, cache_dir=None, **umap_kwargs):
+    """
+    UMAP embedding of a precomputed distance matrix, cached on disk.
+
+    Embeddings are keyed on the matrix content hash and every UMAP
+    parameter, so repeated runs return instantly. The kNN graph is cached
+    separately, keyed on the matrix and n_neighbors only, so changing
+    n_components, min_dist or the seed reuses it.
+
+    Args:
+        src (str or DistanceMatrix): Text matrix, store prefix or open matrix
+        n_components (int): Embedding dimension
+        cache_dir (str): Cache directory (default: <store>.umap)
+        **umap_kwargs: Further UMAP parameters (default n_neighbors=100,
+            min_dist=0.1, random_state=42)
+
+    Returns:
+        tuple: (accessions, float32 embedding of shape (n, n_components))
+    """
+    dm = src if isinstance(src, DistanceMatrix) else open_distance_matrix(src)
+    cache_dir = cache_dir or default_cache_dir(dm)
+    params = {**UMAP_DEFAULTS, **umap_kwargs, "n_components": n_components}
+    digest = dm.digest()
+    emb_path = os.path.join(cache_dir, f"emb_{embedding_key(digest, params)}.npy")
+    if os.path.exists(emb_path):
+        return dm.accessions, np.load(emb_path)
+    return dm.accessions, fit_embedding(dm, params, cache_dir, digest)
+
+def place_points(embedding, indices, distances, params):
+    """
+    Place new points into a fixed embedding from their neighbours among its points.
+
+    Follows UMAP's transform(): each new point starts at the membership-weighted
+    mean of its neighbours and is then optimised against the original points,
+    which do not move.
+
+    Args:
+        embedding (numpy.ndarray): (n, n_components) embedding of the original points
+        indices (numpy.ndarray): (m, k) neighbours of the new points among the original ones
+        distances (numpy.ndarray): (m, k) distances to those neighbours
+        params (dict): UMAP parameters the embedding was fitted with
+
+    Returns:
+        numpy.ndarray: float32 (m, n_components) coordinates of the new points
+    """
+    settings = UMAP(metric="precomputed", **params)
+    a, b = settings.a, settings.b
+    if a is None or b is None:
+        a, b = find_ab_params(settings.spread, settings.min_dist)
+    distances = np.ascontiguousarray(distances, dtype=np.float32)
+    sigmas, rhos = smooth_knn_dist(distances, float(indices.shape[1]),
+                                   local_connectivity=max(0.0, settings.local_connectivity - 1.0))
+    rows, cols, vals, _ = compute_membership_strengths(indices, distances, sigmas, rhos, bipartite=True)
+    graph = sparse.coo_matrix((vals, (rows, cols)), shape=(len(indices), len(embedding)))
+    csr_graph = graph.tocsr()
+    csr_graph.eliminate_zeros()
+    placed = init_graph_transform(csr_graph, embedding)
+
+    if settings.n_epochs is None:
+        n_epochs = 100 if len(indices) <= 10000 else 30
+    else:
+        n_epochs = int(settings.n_epochs // 3.0)
+    graph.data[graph.data < graph.data.max() / float(n_epochs)] = 0.0
+    graph.eliminate_zeros()
+    rng_state = check_random_state(settings.transform_seed).randint(INT32_MIN, INT32_MAX, 3).astype(np.int64)
+    placed = optimize_layout_euclidean(
+        placed, embedding.astype(np.float32, copy=True), graph.row, graph.col, n_epochs,
+        len(embedding), make_epochs_per_sample(graph.data, n_epochs), a, b, rng_state,
+        settings.repulsion_strength, settings.learning_rate / 4.0, settings.negative_sample_rate,
+        settings.random_state is None)
+    return placed.astype(np.float32)
+
+def append_embedding(base_src, new_src, n_components=2, cache_dir=None, **umap_kwargs):
+    """
+    Place sequences added since an embedding was fitted into that embedding.
+
+    The cached embedding of base_src is loaded and the accessions of new_src
+    that base_src lacks are placed into it as UMAP's transform() would, from
+    their nearest neighbours in their block of distances to the original
+    accessions. The original points keep their coordinates.
+
+    Args:
+        base_src (str or DistanceMatrix): Matrix the embedding was fitted on
+        new_src (str or DistanceMatrix): Rebuilt matrix holding all base
+            accessions plus the new ones
+        n_components (int): Embedding dimension
+        cache_dir (str): Cache directory of the base embedding (default: <base store>.umap)
+        **umap_kwargs: UMAP parameters of the base embedding
+
+    Returns:
+        tuple: (accessions, float32 embedding, boolean mask of appended rows),
+            base accessions first
+    """
+    base = base_src if isinstance(base_src, DistanceMatrix) else open_distance_matrix(base_src)
+    new = new_src if isinstance(new_src, DistanceMatrix) else open_distance_matrix(new_src)
+    params = {**UMAP_DEFAULTS, **umap_kwargs, "n_components": n_components}
+    accessions, embedding = umap_embedding(base, n_components, cache_dir, **umap_kwargs)
+
+    base_keys, new_keys = matrix_keys(base), matrix_keys(new)
+    uniq, first = np.unique(new_keys, return_index=True)
+    pos = np.minimum(np.searchsorted(uniq, base_keys), len(uniq) - 1)
+    found = uniq[pos] == base_keys
+    if not found.all():
+        raise ValueError(f"{(~found).sum()} accessions of {base.prefix} are missing from {new.prefix}")
+    added = np.flatnonzero(~np.isin(new_keys, base_keys))
+    if len(added) == 0:
+        return accessions, embedding, np.zeros(len(accessions), dtype=bool)
+
+    # Columns in the order of the original points
+    block = new.block(added, first[pos])
+    indices, distances = block_knn(block, None, min(params["n_neighbors"], len(accessions)))
+    placed = place_points(embedding, indices, distances, params)
+    is_new = np.r_[np.zeros(len(accessions), dtype=bool), np.ones(len(added), dtype=bool)]
+    return np.concatenate([accessions, new.accessions[added]]), np.vstack([embedding, placed]), is_new
+
+def fit_with_init(task):
+    """Fit one UMAP on a dense precomputed matrix from given initial coordinates."""
+    square, init, params = task
+    params = {**params, "n_neighbors": min(params["n_neighbors"], len(square))}
+    indices, distances = block_knn(square, 0, params["n_neighbors"])
+    reducer = UMAP(metric="precomputed", precomputed_knn=(indices, distances), init=init, **params)
+    return reducer.fit_transform(knn_to_sparse(indices, distances)).astype(np.float32)
+
+def aligned_embeddings(sources, n_components=2, cache_dir=None, mode="aligned",
+                       reference=None, exclude=None, workers=None, **umap_kwargs):
+    """
+    Joint UMAP embeddings of several matrices on their common accessions.
+
+    mode="aligned" fits UMAP's AlignedUMAP over all matrices at once, with
+    every accession related to itself in the neighbouring panels, so the
+    panels share one coordinate frame. mode="reference" embeds the
+    reference matrix (e.g. the BUSCO tree) and fits each matrix from those
+    coordinates as initialisation; these fits are independent and run in a
+    process pool. Pass random_state=None to let numba run in parallel.
+
+    Args:
+        sources (list): Text matrices, store prefixes or open matrices
+        n_components (int): Embedding dimension
+        cache_dir (str): Cache directory (default: next to the first store)
+        mode (str): "aligned" or "reference"
+        reference (str or DistanceMatrix): Reference matrix for mode="reference"
+        exclude (iterable): Accessions to leave out, e.g. outliers
+        workers (int): Worker processes for mode="reference"
+        **umap_kwargs: Further UMAP/AlignedUMAP parameters
+
+    Returns:
+        tuple: (common accessions, [float32 embedding per source])
+    """
+    dms = [src if isinstance(src, DistanceMatrix) else open_distance_matrix(src) for src in sources]
+    if mode == "reference":
+        if reference is None:
+            raise ValueError("mode='reference' needs a reference matrix")
+        ref = reference if isinstance(reference, DistanceMatrix) else open_distance_matrix(reference)
+        accessions, indices = align_matrices([ref] + dms, exclude=exclude)
+    elif mode == "aligned":
+        accessions, indices = align_matrices(dms, exclude=exclude)
+    else:
+        raise ValueError(f"Unknown mode: {mode}")
+
+    cache_dir = cache_dir or default_cache_dir(dms[0])
+    params = {**UMAP_DEFAULTS, **umap_kwargs, "n_components": n_components}
+    matrices = ([ref] if mode == "reference" else []) + dms
+    key = embedding_key(",".join(dm.digest() for dm in matrices),
+                        {**params, "mode": mode, "accessions": hashlib.blake2b(
+                            "\n".join(accessions.tolist()).encode(), digest_size=16).hexdigest()})
+    out_path = os.path.join(cache_dir, f"aligned_{key}.npz")
+    if os.path.exists(out_path):
+        with np.load(out_path) as npz:
+            return accessions, list(npz["embeddings"])
+
+    squares = [matrix_values(dm, idx) for dm, idx in zip(matrices, indices)]
+    if mode == "aligned":
+        relations = [{i: i for i in range(len(accessions))}] * (len(squares) - 1)
+        reducer = AlignedUMAP(metric="precomputed", **params)
+        embeddings = [e.astype(np.float32) for e in reducer.fit(squares, relations=relations).embeddings_]
+    else:
+        init = fit_with_init((squares[0], "spectral", params))
+        # Forking after numba has started its threads can deadlock the workers
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            embeddings = list(executor.map(fit_with_init, [(sq, init, params) for sq in squares[1:]]))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(out_path, embeddings=np.stack(embeddings), accessions=accessions)
+    return accessions, embeddings
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute cached UMAP embeddings of distance matrices")
+    parser.add_argument("inputs", nargs="+", help="Text distance matrices or store prefixes")
+    parser.add_argument("-c", "--components", type=int, nargs="+", default=[2],
+                        help="Embedding dimensions to compute (default: 2)")
+    parser.add_argument("-k", "--n-neighbors", type=int, default=UMAP_DEFAULTS["n_neighbors"])
+    parser.add_argument("--min-dist", type=float, default=UMAP_DEFAULTS["min_dist"])
+    parser.add_argument("--cache-dir", default=None, help="Cache directory (default: <store>.umap)")
+    args = parser.parse_args()
+
+    for src in args.inputs:
+        for n_components in args.components:
+            accessions, embedding = umap_embedding(src, n_components, args.cache_dir,
+                                                   n_neighbors=args.n_neighbors, min_dist=args.min_dist)
+            print(f"{src}: {embedding.shape[1]}-D embedding of {len(accessions)} accessions")
+
+if __name__ == "__main__":
+    main()